@@ -0,0 +1,1101 @@
+"""Reproducible end-to-end load test for the MediVision API.
+
+Boots ``server:app`` in-process against local stand-ins (mongomock or a local
+mongod; MOCK_AI or a fake OpenAI server), seeds synthetic users, scans and
+images, runs scripted mixed workloads and records throughput, latency
+percentiles and memory as JSON. With ``--baseline`` the run is diffed against
+a previous result and the exit status is 1 on a regression.
+
+    pip install -r requirements.bench.txt
+    python benchmark_suite.py --scale small --output bench_results/baseline.json
+    python benchmark_suite.py --scale small --baseline bench_results/baseline.json
+
+Baselines are only comparable on the same machine and configuration; the
+diff refuses to compare runs whose ``config`` differs.
+
+Single components (``stats``, ``similarity``, ``reports``, ``local-analysis``,
+``inference``, ``validate-inference``, ``upload``, ``workers``) are benchmarked
+against the configured environment instead:
+
+    python benchmark_suite.py stats --scans 10000
+    python benchmark_suite.py inference --backends eager,torchscript
+"""
+import argparse
+import asyncio
+import gzip
+import io
+import json
+import logging
+import os
+import platform
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from datetime import datetime, timezone, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Optional
+
+import numpy as np
+from PIL import Image
+
+ROOT_DIR = Path(__file__).parent
+
+SCALES = {
+    "small": {"users": 5, "scans_per_user": 200, "images": 20, "requests": 500, "concurrency": 8},
+    "medium": {"users": 20, "scans_per_user": 1000, "images": 50, "requests": 2000, "concurrency": 16},
+    "large": {"users": 100, "scans_per_user": 5000, "images": 100, "requests": 10000, "concurrency": 32},
+}
+
+# workload -> {operation: weight}
+WORKLOADS = {
+    "browse": {"list_scans": 40, "get_scan": 30, "get_stats": 20, "me": 10},
+    "mixed": {"list_scans": 25, "get_scan": 20, "get_stats": 15, "me": 20, "upload": 15, "login": 5},
+    "upload": {"upload": 80, "get_scan": 20},
+    "auth": {"login": 50, "me": 50},
+}
+
+PASSWORD = "benchmark-password"
+
+# ================== Stand-ins ==================
+
+class FakeOpenAIHandler(BaseHTTPRequestHandler):
+    """Minimal ``POST /v1/responses`` that answers with a fixed analysis after ``latency`` seconds."""
+
+    latency = 0.0
+    analysis = json.dumps({
+        "doctor_view": {"summary": "Synthetic cloud analysis.", "findings": ["No findings (benchmark)."]},
+        "patient_view": {"summary": "Synthetic cloud analysis.", "next_steps": ["None (benchmark)."]},
+    })
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        time.sleep(self.latency)
+        body = json.dumps({
+            "id": "resp_benchmark", "object": "response", "created_at": 0, "model": "benchmark",
+            "status": "completed", "parallel_tool_calls": False, "tool_choice": "auto", "tools": [],
+            "output": [{
+                "id": "msg_benchmark", "type": "message", "role": "assistant", "status": "completed",
+                "content": [{"type": "output_text", "text": self.analysis, "annotations": []}],
+            }],
+        }).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+def start_fake_openai(latency_ms: float) -> ThreadingHTTPServer:
+    FakeOpenAIHandler.latency = latency_ms / 1000.0
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), FakeOpenAIHandler)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    return httpd
+
+def configure_environment(args, blob_dir: str):
+    """Point the server at the stand-ins; must run before ``server`` is imported."""
+    os.environ["DB_NAME"] = args.db_name
+    os.environ["BLOB_STORE"] = "local"
+    os.environ["BLOB_STORE_PATH"] = blob_dir
+    os.environ["USE_LOCAL_ML"] = "true" if args.local_ml else "false"
+    os.environ["BCRYPT_ROUNDS"] = str(args.bcrypt_rounds)
+    os.environ.setdefault("JWT_SECRET", "benchmark")
+    # Seeded scans are old enough to archive; keep the background lifecycle out of the measurements.
+    os.environ["LIFECYCLE_INTERVAL_SECONDS"] = "0"
+    if args.mongo_url:
+        os.environ["MONGO_URL"] = args.mongo_url
+    else:
+        try:
+            import mongomock_motor
+            import motor.motor_asyncio
+        except ImportError:
+            raise SystemExit("mongomock-motor is required without --mongo-url (pip install -r requirements.bench.txt)")
+        os.environ["MONGO_URL"] = "mongodb://mongomock"
+        motor.motor_asyncio.AsyncIOMotorClient = mongomock_motor.AsyncMongoMockClient
+
+    if args.ai == "fake-openai":
+        httpd = start_fake_openai(args.ai_latency_ms)
+        os.environ["MOCK_AI"] = "false"
+        os.environ["OPENAI_API_KEY"] = "benchmark"
+        os.environ["OPENAI_BASE_URL"] = f"http://127.0.0.1:{httpd.server_address[1]}/v1"
+    else:
+        os.environ["MOCK_AI"] = "true"
+
+# ================== Data ==================
+
+class Fixture:
+    """Synthetic users, scans and upload images, reproducible from ``seed``."""
+
+    def __init__(self, server, config: dict, seed: int):
+        self.server = server
+        self.config = config
+        self.rng = random.Random(seed)
+        self.seed = seed
+        self.users = []
+        self.tokens = {}
+        self.scan_ids = {}
+        self.images = []
+        self.analysis_tiers = {}
+
+    def _uuid(self) -> str:
+        return str(uuid.UUID(int=self.rng.getrandbits(128), version=4))
+
+    async def seed_data(self):
+        server = self.server
+        password_hash = server.hash_password(PASSWORD)
+        now = datetime(2024, 1, 1, tzinfo=timezone.utc)
+        scan_types = ("xray", "mri", "ct_scan")
+        statuses = ("completed",) * 8 + ("failed", "processing")
+
+        for u in range(self.config["users"]):
+            user = {
+                "id": self._uuid(),
+                "email": f"bench{u}-{self.seed}@example.com",
+                "name": f"Benchmark User {u}",
+                "password_hash": password_hash,
+                "created_at": now.isoformat(),
+            }
+            await server.db.users.delete_many({"email": user["email"]})
+            await server.db.users.insert_one(dict(user))
+            self.users.append(user)
+            self.tokens[user["id"]] = server.create_token(user["id"], user["email"], user["name"], user["created_at"])
+
+            scans = []
+            for i in range(self.config["scans_per_user"]):
+                status = statuses[self.rng.randrange(len(statuses))]
+                scan_type = scan_types[self.rng.randrange(len(scan_types))]
+                scan = {
+                    "id": self._uuid(),
+                    "user_id": user["id"],
+                    "scan_type": scan_type,
+                    "file_name": f"scan-{i}.png",
+                    "image_sha256": f"{self.rng.getrandbits(256):064x}",
+                    "dhash": f"{self.rng.getrandbits(64):016x}",
+                    "status": status,
+                    "attempts": 1,
+                    "created_at": (now - timedelta(minutes=i)).isoformat(),
+                }
+                if status == "completed":
+                    scan["analysis_tier"] = "local"
+                    scan["analysis_model"] = server.LOCAL_PIL_MODEL_ID
+                    scan["report"] = {"template": "quality:v1", "params": {
+                        "metrics": {
+                            "mean_brightness": self.rng.uniform(30, 220),
+                            "std_dev": self.rng.uniform(10, 80),
+                            "edge_density": self.rng.uniform(0.01, 0.3),
+                            "sharpness": self.rng.uniform(1, 500),
+                        },
+                        "scan_kind": scan_type,
+                    }}
+                scans.append(scan)
+            for start in range(0, len(scans), 1000):
+                await server.db.scans.insert_many(scans[start:start + 1000])
+            self.scan_ids[user["id"]] = [scan["id"] for scan in scans if scan["status"] == "completed"]
+            await server.rebuild_user_stats(user["id"])
+
+        self.images = synthetic_scan_images(self.config["images"], seed=self.seed)
+
+    async def cleanup(self):
+        for user in self.users:
+            await self.server.db.scans.delete_many({"user_id": user["id"]})
+            await self.server.db.user_stats.delete_many({"user_id": user["id"]})
+            await self.server.db.users.delete_many({"id": user["id"]})
+
+# ================== Operations ==================
+
+async def op_list_scans(http, fixture, user, rng):
+    return await http.get("/api/scans", headers=auth(fixture, user), params={"limit": 20})
+
+async def op_get_scan(http, fixture, user, rng):
+    scan_ids = fixture.scan_ids[user["id"]]
+    scan_id = scan_ids[rng.randrange(len(scan_ids))] if scan_ids else "missing"
+    return await http.get(f"/api/scans/{scan_id}", headers=auth(fixture, user))
+
+async def op_get_stats(http, fixture, user, rng):
+    return await http.get("/api/stats", headers=auth(fixture, user))
+
+async def op_me(http, fixture, user, rng):
+    return await http.get("/api/auth/me", headers=auth(fixture, user))
+
+async def op_login(http, fixture, user, rng):
+    return await http.post("/api/auth/login", json={"email": user["email"], "password": PASSWORD})
+
+async def op_upload(http, fixture, user, rng):
+    image = fixture.images[rng.randrange(len(fixture.images))]
+    response = await http.post(
+        "/api/process-medical-image",
+        headers=auth(fixture, user),
+        files={"file": ("bench.png", image, "image/png")},
+        data={"scan_type": ("xray", "mri", "ct_scan")[rng.randrange(3)]},
+    )
+    if response.status_code == 200:
+        scan = response.json()
+        fixture.scan_ids[user["id"]].append(scan["id"])
+        tier = scan.get("analysis_tier") or "none"
+        fixture.analysis_tiers[tier] = fixture.analysis_tiers.get(tier, 0) + 1
+    return response
+
+OPERATIONS = {
+    "list_scans": op_list_scans,
+    "get_scan": op_get_scan,
+    "get_stats": op_get_stats,
+    "me": op_me,
+    "login": op_login,
+    "upload": op_upload,
+}
+
+def auth(fixture, user) -> dict:
+    return {"Authorization": f"Bearer {fixture.tokens[user['id']]}"}
+
+# ================== Runner ==================
+
+def percentile(sorted_values: list, q: float) -> float:
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * q))]
+
+def latency_summary(latencies: list) -> dict:
+    latencies = sorted(latencies)
+    return {
+        "mean_ms": round(sum(latencies) / len(latencies) * 1000, 3) if latencies else 0.0,
+        "p50_ms": round(percentile(latencies, 0.50) * 1000, 3),
+        "p95_ms": round(percentile(latencies, 0.95) * 1000, 3),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 3),
+    }
+
+def memory_mb() -> dict:
+    """Current and peak RSS of this process (client and server share it)."""
+    current = 0.0
+    try:
+        for line in Path("/proc/self/status").read_text().splitlines():
+            if line.startswith("VmRSS:"):
+                current = int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024  # KiB on Linux
+    return {"rss": round(current, 1), "peak_rss": round(peak, 1)}
+
+async def run_workload(http, fixture, name: str, requests: int, concurrency: int, warmup: int, seed: int) -> dict:
+    weights = WORKLOADS[name]
+    rng = random.Random(f"{seed}:{name}")
+    plan = [
+        (rng.choices(list(weights), weights=list(weights.values()))[0], fixture.users[rng.randrange(len(fixture.users))])
+        for _ in range(warmup + requests)
+    ]
+    samples = {op: [] for op in weights}
+    errors = {op: 0 for op in weights}
+    position = 0
+
+    async def worker(worker_rng):
+        nonlocal position
+        while position < len(plan):
+            index = position
+            position += 1
+            op, user = plan[index]
+            started = time.perf_counter()
+            try:
+                response = await OPERATIONS[op](http, fixture, user, worker_rng)
+                ok = response.status_code < 400
+            except Exception:
+                ok = False
+            elapsed = time.perf_counter() - started
+            if index < warmup:
+                continue
+            samples[op].append(elapsed)
+            if not ok:
+                errors[op] += 1
+
+    fixture.analysis_tiers = {}
+    memory_before = memory_mb()
+    started = time.perf_counter()
+    await asyncio.gather(*(worker(random.Random(f"{seed}:{name}:{w}")) for w in range(concurrency)))
+    duration = time.perf_counter() - started
+    memory_after = memory_mb()
+
+    everything = [value for values in samples.values() for value in values]
+    return {
+        "requests": requests,
+        "duration_s": round(duration, 3),
+        "throughput_rps": round(len(everything) / duration, 2) if duration else 0.0,
+        "errors": sum(errors.values()),
+        "latency": latency_summary(everything),
+        "ops": {
+            op: {"count": len(values), "errors": errors[op], **latency_summary(values)}
+            for op, values in samples.items() if values
+        },
+        "memory_mb": {
+            "rss_start": memory_before["rss"],
+            "rss_end": memory_after["rss"],
+            "peak_rss": memory_after["peak_rss"],
+        },
+        # Which tier served uploads, so a silent fallback (e.g. cloud -> local) is visible.
+        "analysis_tiers": dict(fixture.analysis_tiers),
+    }
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=ROOT_DIR, capture_output=True, text=True, timeout=5
+        ).stdout.strip()
+    except (OSError, subprocess.SubprocessError):
+        return ""
+
+async def run_suite(args, config: dict) -> dict:
+    import httpx
+    import server
+
+    results = {
+        "meta": {
+            "timestamp": datetime.now(timezone.utc).isoformat(),
+            "git_commit": git_commit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+        },
+        "config": config,
+        "workloads": {},
+    }
+    async with server.app.router.lifespan_context(server.app):
+        fixture = Fixture(server, config, args.seed)
+        try:
+            started = time.perf_counter()
+            await fixture.seed_data()
+            results["meta"]["seed_seconds"] = round(time.perf_counter() - started, 3)
+            transport = httpx.ASGITransport(app=server.app)
+            async with httpx.AsyncClient(transport=transport, base_url="http://benchmark", timeout=600) as http:
+                for name in config["workloads"]:
+                    results["workloads"][name] = await run_workload(
+                        http, fixture, name, config["requests"], config["concurrency"], args.warmup, args.seed
+                    )
+                    print(f"{name}: {results['workloads'][name]['throughput_rps']} req/s", file=sys.stderr)
+        finally:
+            await fixture.cleanup()
+    return results
+
+# ================== Baseline Diff ==================
+
+def compare(current: dict, baseline: dict, latency_tolerance: float, throughput_tolerance: float,
+            memory_tolerance: float, min_latency_ms: float) -> list:
+    """Rows of ``(metric, baseline, current, change, regressed)`` for every shared workload.
+
+    Latency increases below ``min_latency_ms`` are treated as noise.
+    """
+    rows = []
+
+    def check(metric, old, new, higher_is_worse, tolerance, floor=0.0):
+        change = (new - old) / old if old else 0.0
+        worse = (new - old) if higher_is_worse else (old - new)
+        regressed = bool(old) and worse > old * tolerance and worse > floor
+        rows.append((metric, old, new, change, regressed))
+
+    for name, new in current["workloads"].items():
+        old = baseline["workloads"].get(name)
+        if old is None:
+            continue
+        check(f"{name}.throughput_rps", old["throughput_rps"], new["throughput_rps"], False, throughput_tolerance)
+        check(f"{name}.p95_ms", old["latency"]["p95_ms"], new["latency"]["p95_ms"], True, latency_tolerance, min_latency_ms)
+        for op, stats in new["ops"].items():
+            if op in old["ops"]:
+                check(f"{name}.{op}.p95_ms", old["ops"][op]["p95_ms"], stats["p95_ms"], True,
+                      latency_tolerance, min_latency_ms)
+        rows.append((f"{name}.errors", old["errors"], new["errors"], 0.0, new["errors"] > old["errors"]))
+        check(f"{name}.peak_rss_mb", old["memory_mb"]["peak_rss"], new["memory_mb"]["peak_rss"], True, memory_tolerance)
+    return rows
+
+def print_comparison(rows: list):
+    width = max(len(row[0]) for row in rows) if rows else 10
+    print(f"{'metric':{width}s} {'baseline':>12s} {'current':>12s} {'change':>8s}")
+    for metric, old, new, change, regressed in rows:
+        flag = "  REGRESSION" if regressed else ""
+        print(f"{metric:{width}s} {old:12.3f} {new:12.3f} {change:+8.1%}{flag}")
+
+# ================== Component Benchmarks ==================
+
+def benchmark_reports(iterations: int = 2000) -> dict:
+    """Stored bytes per scan and ``GET /scans/{id}`` serialization cost, inline views vs compact reports.
+
+    The cloud sample is a local report stripped of its template, i.e. the
+    same text stored as a compressed free-form blob.
+    """
+    import bson
+    import orjson
+    from fastapi.encoders import jsonable_encoder
+    import server
+
+    image = synthetic_scan_images(1, seed=0)[0]
+    probs = np.random.default_rng(0).random(18)
+    pathologies = [f"Pathology {i}" for i in range(18)]
+    quality = server.analyze_locally_with_pil(image, "mri")
+    xray = server.build_xray_report(probs, pathologies)
+    xray["report"] = {
+        "template": "xray:v1",
+        "params": {"probs": [float(p) for p in probs], "pathologies": pathologies, "backend": server.XRAY_INFERENCE_BACKEND},
+    }
+    cloud = {"doctor_view": quality["doctor_view"], "patient_view": quality["patient_view"]}
+    base = server.new_scan_doc("user", "mri", "scan.png", len(image), "0" * 64, None, "0" * 16, background=False)
+    base.update(status="completed", analysis_tier="local", analysis_model=server.LOCAL_PIL_MODEL_ID)
+
+    results = {}
+    for kind, analysis in (("quality", quality), ("xray", xray), ("cloud", cloud)):
+        legacy = {**base, "doctor_view": analysis["doctor_view"], "patient_view": analysis["patient_view"]}
+        compact = {**base, "report": server.compact_report(analysis)}
+
+        def legacy_read():
+            # What FastAPI does for a ``response_model`` route returning the model.
+            return json.dumps(jsonable_encoder(server.ScanResponse(**dict(legacy))), separators=(",", ":")).encode()
+
+        def compact_read():
+            scan = dict(compact)
+            return orjson.dumps({field: None for field in server.ScanResponse.model_fields} | server.expand_scan(scan))
+
+        timings = {}
+        for name, read in (("legacy", legacy_read), ("compact", compact_read)):
+            started = time.perf_counter()
+            for _ in range(iterations):
+                body = read()
+            timings[name] = (time.perf_counter() - started) / iterations
+        results[kind] = {
+            "legacy_bson_bytes": len(bson.encode(legacy)),
+            "compact_bson_bytes": len(bson.encode(compact)),
+            "response_bytes": len(body),
+            "response_gzip_bytes": len(gzip.compress(body, compresslevel=server.RESPONSE_COMPRESSION_LEVEL)),
+            "legacy_read_us": round(timings["legacy"] * 1e6, 1),
+            "compact_read_us": round(timings["compact"] * 1e6, 1),
+        }
+    return results
+
+def benchmark_similarity(size: int = 100000, queries: int = 1000, max_distance: int = 8) -> dict:
+    """Time ``HammingIndex`` lookups against a numpy linear scan over ``size`` hashes.
+
+    A tenth of the queries are perturbed copies of indexed hashes, the rest
+    are random, so both the hit and the miss path are measured.
+    """
+    import server
+
+    rng = np.random.default_rng(0)
+    hashes = [int(value) for value in rng.integers(0, 2 ** 64, size=size, dtype=np.uint64)]
+    index = server.HammingIndex()
+    started = time.perf_counter()
+    for i, value in enumerate(hashes):
+        index.add(str(i), value)
+    build_seconds = time.perf_counter() - started
+
+    probes = []
+    for q in range(queries):
+        if q % 10 == 0:
+            value = hashes[int(rng.integers(size))]
+            for bit in rng.choice(64, size=int(rng.integers(0, max_distance + 1)), replace=False):
+                value ^= 1 << int(bit)
+            probes.append(value)
+        else:
+            probes.append(int(rng.integers(0, 2 ** 64, dtype=np.uint64)))
+
+    latencies = []
+    found = 0
+    for value in probes:
+        started = time.perf_counter()
+        found += bool(index.search(value, max_distance))
+        latencies.append(time.perf_counter() - started)
+    latencies.sort()
+
+    packed = np.array(hashes, dtype=np.uint64)
+    linear = []
+    for value in probes[:50]:
+        started = time.perf_counter()
+        distances = np.unpackbits((packed ^ np.uint64(value)).view(np.uint8)).reshape(-1, 64).sum(axis=1)
+        np.flatnonzero(distances <= max_distance)
+        linear.append(time.perf_counter() - started)
+    linear.sort()
+
+    return {
+        "indexed": size,
+        "queries": queries,
+        "max_distance": max_distance,
+        "build_seconds": round(build_seconds, 3),
+        "queries_with_matches": found,
+        "index_p50_ms": round(latencies[len(latencies) // 2] * 1000, 4),
+        "index_p95_ms": round(latencies[int(len(latencies) * 0.95)] * 1000, 4),
+        "linear_scan_p50_ms": round(linear[len(linear) // 2] * 1000, 4),
+    }
+
+async def benchmark_stats(scan_count: int = 10000, iterations: int = 50) -> dict:
+    """Time the old three-query /stats path against the user_stats point read.
+
+    Seeds ``scan_count`` synthetic scans under a throwaway user id and removes
+    them (and the user's stats document) afterwards.
+    """
+    import server
+
+    user_id = f"stats-benchmark-{uuid.uuid4()}"
+    created_at = datetime.now(timezone.utc)
+    scan_types = ("xray", "mri", "ct", "ultrasound")
+    statuses = ("completed", "completed", "completed", "failed", "processing")
+    try:
+        for start in range(0, scan_count, 1000):
+            await server.db.scans.insert_many([
+                {
+                    "id": str(uuid.uuid4()),
+                    "user_id": user_id,
+                    "scan_type": scan_types[i % len(scan_types)],
+                    "status": statuses[i % len(statuses)],
+                    "created_at": (created_at - timedelta(seconds=i)).isoformat(),
+                }
+                for i in range(start, min(start + 1000, scan_count))
+            ])
+        await server.rebuild_user_stats(user_id)
+
+        async def legacy():
+            await server.db.scans.count_documents({"user_id": user_id})
+            await server.db.scans.count_documents({"user_id": user_id, "status": "completed"})
+            await server.db.scans.aggregate([
+                {"$match": {"user_id": user_id}},
+                {"$group": {"_id": "$scan_type", "count": {"$sum": 1}}}
+            ]).to_list(10)
+
+        async def point_read():
+            await server.db.user_stats.find_one({"user_id": user_id}, {"_id": 0})
+
+        results = {"scans": scan_count, "iterations": iterations}
+        for name, fn in (("three_queries", legacy), ("point_read", point_read)):
+            latencies = []
+            for _ in range(iterations):
+                started = time.perf_counter()
+                await fn()
+                latencies.append(time.perf_counter() - started)
+            latencies.sort()
+            results[name] = {
+                "p50_ms": round(latencies[len(latencies) // 2] * 1000, 3),
+                "p95_ms": round(latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))] * 1000, 3),
+            }
+        return results
+    finally:
+        await server.db.scans.delete_many({"user_id": user_id})
+        await server.db.user_stats.delete_one({"user_id": user_id})
+
+async def benchmark_local_analysis(images: int = 50, concurrency: int = 1, scan_types: tuple = ("xray", "mri")) -> dict:
+    """End-to-end local analysis latency: per-analyzer decoding vs the shared ``AnalysisPipeline``.
+
+    Inputs are preprocessed synthetic uploads (what analysis sees in
+    production). Without the X-ray model installed the xray runs measure the
+    model-failure fallback, which is where the old path decoded twice.
+    """
+    import server
+
+    async def per_analyzer(image_bytes: bytes, scan_kind: str) -> tuple:
+        # The path before the pipeline: each analyzer decodes the image itself.
+        try:
+            if server._env_flag("USE_LOCAL_ML", "true"):
+                if scan_kind != "xray":
+                    raise RuntimeError("Local ML model currently supports xray only.")
+                xray_input = await server.analysis_executor.run(server.prepare_xray_input, image_bytes)
+                return server.xray_analysis(*await server.xray_batcher.infer(xray_input)), server.local_ml_model_id()
+        except Exception:
+            pass
+        return await server.analysis_executor.run(server.analyze_locally_with_pil, image_bytes, scan_kind), server.LOCAL_PIL_MODEL_ID
+
+    inputs = [server.preprocess_image(image)[0] for image in synthetic_scan_images(images, seed=3, size=1024)]
+    stage_totals = {}
+
+    async def pipelined(image_bytes: bytes, scan_kind: str) -> tuple:
+        pipeline = server.AnalysisPipeline(image_bytes)
+        try:
+            return await server.analyze_locally(image_bytes, scan_kind, pipeline)
+        finally:
+            for stage, seconds in pipeline.timings.items():
+                stage_totals.setdefault(scan_kind, {}).setdefault(stage, []).append(seconds)
+
+    results = {"images": images, "concurrency": concurrency, "executor": server.analysis_executor.kind}
+    logging.disable(logging.WARNING)  # the fallback warning would otherwise fire per image
+    try:
+        for scan_kind in scan_types:
+            # One unmeasured pass each so model loading / import failures aren't timed.
+            await per_analyzer(inputs[0], scan_kind)
+            await server.analyze_locally(inputs[0], scan_kind)
+            for name, fn in (("per_analyzer", per_analyzer), ("pipeline", pipelined)):
+                latencies = []
+                semaphore = asyncio.Semaphore(concurrency)
+                served = set()
+
+                async def one(image_bytes):
+                    async with semaphore:
+                        started = time.perf_counter()
+                        _, model_id = await fn(image_bytes, scan_kind)
+                        latencies.append(time.perf_counter() - started)
+                        served.add(model_id)
+
+                started = time.perf_counter()
+                await asyncio.gather(*(one(image_bytes) for image_bytes in inputs))
+                elapsed = time.perf_counter() - started
+                latencies.sort()
+                results.setdefault(scan_kind, {})[name] = {
+                    "served_by": sorted(served),
+                    "p50_ms": round(latencies[len(latencies) // 2] * 1000, 3),
+                    "p95_ms": round(latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))] * 1000, 3),
+                    "images_per_second": round(len(inputs) / elapsed, 2),
+                }
+            results[scan_kind]["pipeline_stage_ms"] = {
+                stage: round(sum(values) / len(values) * 1000, 3) for stage, values in stage_totals.get(scan_kind, {}).items()
+            }
+        return results
+    finally:
+        logging.disable(logging.NOTSET)
+
+def synthetic_scan_images(count: int, seed: int, size: int = 512) -> list:
+    """Distinct PNG images, so the analysis cache can't serve one run from another."""
+    rng = np.random.default_rng(seed)
+    gradient = np.linspace(0, 200, size, dtype=np.float32)[None, :]
+    images = []
+    for _ in range(count):
+        pixels = np.clip(gradient + rng.normal(0, 20, (size, size)), 0, 255).astype(np.uint8)
+        buffer = io.BytesIO()
+        Image.fromarray(pixels, mode="L").save(buffer, format="PNG")
+        images.append(buffer.getvalue())
+    return images
+
+async def benchmark_upload(url: str, token: str, count: int, scan_type: str, concurrency: int) -> dict:
+    """Time ``count`` single uploads against one batch upload on a running server.
+
+    Scans created by the benchmark are deleted afterwards.
+    """
+    import httpx
+
+    headers = {"Authorization": f"Bearer {token}"}
+    created = []
+    results = {"images": count, "scan_type": scan_type, "single_concurrency": concurrency}
+    async with httpx.AsyncClient(base_url=url.rstrip("/"), headers=headers, timeout=600) as http:
+        try:
+            limit = asyncio.Semaphore(concurrency)
+
+            async def single(index: int, data: bytes):
+                async with limit:
+                    response = await http.post(
+                        "/api/process-medical-image",
+                        files={"file": (f"single-{index}.png", data, "image/png")},
+                        data={"scan_type": scan_type, "background": "false"},
+                    )
+                response.raise_for_status()
+                created.append(response.json()["id"])
+
+            images = synthetic_scan_images(count, seed=1)
+            started = time.perf_counter()
+            await asyncio.gather(*(single(i, data) for i, data in enumerate(images)))
+            elapsed = time.perf_counter() - started
+            results["single"] = {"seconds": round(elapsed, 3), "images_per_second": round(count / elapsed, 2)}
+
+            images = synthetic_scan_images(count, seed=2)
+            started = time.perf_counter()
+            response = await http.post(
+                "/api/process-medical-images",
+                files=[("files", (f"batch-{i}.png", data, "image/png")) for i, data in enumerate(images)],
+                data={"scan_type": scan_type, "background": "false"},
+            )
+            elapsed = time.perf_counter() - started
+            response.raise_for_status()
+            items = response.json()["items"]
+            created.extend(item["scan"]["id"] for item in items if item["scan"])
+            results["batch"] = {
+                "seconds": round(elapsed, 3),
+                "images_per_second": round(count / elapsed, 2),
+                "failed": sum(item["status"] != "completed" for item in items),
+            }
+            results["speedup"] = round(results["single"]["seconds"] / results["batch"]["seconds"], 2)
+        finally:
+            for scan_id in created:
+                await http.delete(f"/api/scans/{scan_id}")
+    return results
+
+def _process_tree_memory(root_pid: int) -> dict:
+    """RSS and PSS (shared pages split between sharers) of a process and its children, Linux only."""
+    children = {}
+    for entry in Path("/proc").iterdir():
+        if entry.name.isdigit():
+            try:
+                ppid = int((entry / "stat").read_text().rsplit(")", 1)[1].split()[1])
+            except (OSError, IndexError, ValueError):
+                continue
+            children.setdefault(ppid, []).append(int(entry.name))
+
+    pids, stack = [], [root_pid]
+    while stack:
+        pid = stack.pop()
+        pids.append(pid)
+        stack.extend(children.get(pid, []))
+
+    rss_kb = pss_kb = 0
+    for pid in pids:
+        try:
+            for line in Path(f"/proc/{pid}/smaps_rollup").read_text().splitlines():
+                if line.startswith("Rss:"):
+                    rss_kb += int(line.split()[1])
+                elif line.startswith("Pss:"):
+                    pss_kb += int(line.split()[1])
+        except OSError:
+            continue
+    return {"processes": len(pids), "rss_mb": round(rss_kb / 1024, 1), "pss_mb": round(pss_kb / 1024, 1)}
+
+async def benchmark_workers(token: str, max_workers: int, requests: int, concurrency: int,
+                            scan_type: str, port: int) -> list:
+    """Start gunicorn with 1..``max_workers`` workers and measure throughput and memory.
+
+    Each run serves ``requests`` uploads of distinct synthetic images; total
+    PSS shows how much of the model memory the workers actually share.
+    Scans created by the benchmark are deleted afterwards.
+    """
+    import httpx
+
+    results = []
+    base_url = f"http://127.0.0.1:{port}"
+    for worker_count in range(1, max_workers + 1):
+        env = {**os.environ, "WEB_CONCURRENCY": str(worker_count), "PORT": str(port)}
+        for name in ("XRAY_INTRA_OP_THREADS", "OMP_NUM_THREADS", "MKL_NUM_THREADS", "ANALYSIS_LOCAL_WORKERS"):
+            env.pop(name, None)  # let gunicorn.conf.py split the CPU for this worker count
+        proc = subprocess.Popen(
+            [sys.executable, "-m", "gunicorn", "-c", "gunicorn.conf.py", "server:app"],
+            cwd=str(ROOT_DIR), env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+        )
+        created = []
+        try:
+            async with httpx.AsyncClient(base_url=base_url, timeout=600,
+                                         headers={"Authorization": f"Bearer {token}"}) as http:
+                started = time.monotonic()
+                while True:
+                    try:
+                        if (await http.get("/api/health/ready")).status_code == 200:
+                            break
+                    except httpx.TransportError:
+                        pass
+                    if proc.poll() is not None or time.monotonic() - started > 300:
+                        raise RuntimeError(f"gunicorn with {worker_count} workers did not become ready")
+                    await asyncio.sleep(0.5)
+                # Give every worker a moment to finish its own startup warmup.
+                await asyncio.sleep(2)
+                idle = _process_tree_memory(proc.pid)
+
+                images = synthetic_scan_images(requests, seed=100 + worker_count)
+                limit = asyncio.Semaphore(concurrency)
+                latencies = []
+
+                async def upload(index: int, data: bytes):
+                    async with limit:
+                        begun = time.perf_counter()
+                        response = await http.post(
+                            "/api/process-medical-image",
+                            files={"file": (f"bench-{index}.png", data, "image/png")},
+                            data={"scan_type": scan_type, "background": "false"},
+                        )
+                        latencies.append(time.perf_counter() - begun)
+                    response.raise_for_status()
+                    created.append(response.json()["id"])
+
+                began = time.perf_counter()
+                await asyncio.gather(*(upload(i, data) for i, data in enumerate(images)))
+                elapsed = time.perf_counter() - began
+                loaded = _process_tree_memory(proc.pid)
+                latencies.sort()
+                results.append({
+                    "workers": worker_count,
+                    "requests_per_second": round(requests / elapsed, 2),
+                    "p50_ms": round(latencies[len(latencies) // 2] * 1000, 1),
+                    "p95_ms": round(latencies[int(len(latencies) * 0.95)] * 1000, 1),
+                    "idle_memory": idle,
+                    "loaded_memory": loaded,
+                })
+                for scan_id in created:
+                    await http.delete(f"/api/scans/{scan_id}")
+        finally:
+            proc.terminate()
+            try:
+                proc.wait(timeout=30)
+            except subprocess.TimeoutExpired:
+                proc.kill()
+    return results
+
+def xray_validation_inputs(image_dir: Optional[str], count: int = 8) -> np.ndarray:
+    """Fixed X-ray input set: images from ``image_dir`` or a seeded synthetic batch."""
+    if image_dir:
+        import server
+
+        paths = sorted(p for p in Path(image_dir).iterdir() if p.suffix.lower() in (".jpg", ".jpeg", ".png", ".webp"))
+        if not paths:
+            raise SystemExit(f"No images found in {image_dir}")
+        return np.stack([server.prepare_xray_input(p.read_bytes()) for p in paths])
+    return np.random.default_rng(0).random((count, 224, 224), dtype=np.float32)
+
+def validate_xray_backends(backends: list, inputs: np.ndarray, tolerance: float) -> dict:
+    """Compare each backend's per-pathology probabilities with the float32 eager baseline."""
+    import server
+
+    model = server.load_xray_base_model({})
+    baseline_runner = server.build_xray_runner(model, "eager")
+    baseline = baseline_runner(inputs)
+    report = {}
+    for backend in backends:
+        deviation = np.abs(server.build_xray_runner(model, backend)(inputs) - baseline).max(axis=0)
+        worst = int(np.argmax(deviation))
+        report[backend] = {
+            "max_abs_diff": float(deviation[worst]),
+            "worst_pathology": baseline_runner.pathologies[worst],
+            "per_pathology": {name: float(d) for name, d in zip(baseline_runner.pathologies, deviation)},
+            "passed": bool(deviation[worst] <= tolerance),
+        }
+    return report
+
+def benchmark_xray_backend(backend: str, batch_size: int, iterations: int) -> dict:
+    """Latency, throughput and peak RSS of one backend (run it in a fresh process)."""
+    import server
+
+    timings = {}
+    model = server.load_xray_base_model(timings)
+    started = time.perf_counter()
+    runner = server.build_xray_runner(model, backend)
+    build_seconds = time.perf_counter() - started
+    batch = np.random.default_rng(0).random((batch_size, 224, 224), dtype=np.float32)
+
+    started = time.perf_counter()
+    runner(batch)
+    first_batch_seconds = time.perf_counter() - started
+    for _ in range(2):
+        runner(batch)
+
+    latencies = []
+    for _ in range(iterations):
+        started = time.perf_counter()
+        runner(batch)
+        latencies.append(time.perf_counter() - started)
+    latencies.sort()
+
+    return {
+        "backend": backend,
+        "batch_size": batch_size,
+        "iterations": iterations,
+        "build_seconds": round(build_seconds, 3),
+        "first_batch_seconds": round(first_batch_seconds, 3),
+        "p50_ms": round(latencies[len(latencies) // 2] * 1000, 2),
+        "p95_ms": round(latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))] * 1000, 2),
+        "images_per_second": round(batch_size * iterations / sum(latencies), 2),
+        "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        "load_timings": timings,
+    }
+
+def _parse_backends(value: str) -> list:
+    import server
+
+    if not value:
+        return list(server.XRAY_INFERENCE_BACKENDS)
+    backends = [b.strip().lower() for b in value.split(",") if b.strip()]
+    unknown = set(backends) - set(server.XRAY_INFERENCE_BACKENDS)
+    if unknown:
+        raise SystemExit(f"Unknown backends: {', '.join(sorted(unknown))}")
+    return backends
+
+# ================== CLI ==================
+
+def add_component_commands(commands):
+    validate = commands.add_parser("validate-inference", help="check X-ray backends against the float32 baseline")
+    validate.add_argument("--backends", default="torchscript,int8,onnx")
+    validate.add_argument("--images", help="directory of X-ray images (default: seeded synthetic set)")
+    validate.add_argument("--tolerance", type=float, default=0.02)
+
+    bench = commands.add_parser("inference", help="latency/throughput/memory of X-ray backends")
+    bench.add_argument("--backends", help="comma-separated (default: every backend)")
+    bench.add_argument("--batch-size", type=int, default=8)
+    bench.add_argument("--iterations", type=int, default=20)
+    bench.add_argument("--json", action="store_true", help="print raw JSON results")
+
+    bench_stats = commands.add_parser("stats", help="compare /stats query strategies on synthetic scans")
+    bench_stats.add_argument("--scans", type=int, default=10000)
+    bench_stats.add_argument("--iterations", type=int, default=50)
+
+    bench_upload = commands.add_parser("upload", help="single vs batch upload throughput on a running server")
+    bench_upload.add_argument("--url", default="http://localhost:8001")
+    bench_upload.add_argument("--token", default=os.environ.get("MEDIVISION_TOKEN"), help="bearer token (or MEDIVISION_TOKEN)")
+    bench_upload.add_argument("--images", type=int, default=50)
+    bench_upload.add_argument("--scan-type", default="xray")
+    bench_upload.add_argument("--concurrency", type=int, default=1, help="parallel single uploads")
+
+    bench_similar = commands.add_parser("similarity", help="near-duplicate lookup latency on synthetic hashes")
+    bench_similar.add_argument("--size", type=int, default=100000)
+    bench_similar.add_argument("--queries", type=int, default=1000)
+    bench_similar.add_argument("--max-distance", type=int, default=8)
+
+    bench_reports = commands.add_parser("reports", help="storage and serialization cost of scan reports")
+    bench_reports.add_argument("--iterations", type=int, default=2000)
+
+    bench_local = commands.add_parser("local-analysis", help="local analysis latency with and without the shared pipeline")
+    bench_local.add_argument("--images", type=int, default=50)
+    bench_local.add_argument("--concurrency", type=int, default=1)
+    bench_local.add_argument("--scan-types", default="xray,mri", help="comma-separated")
+
+    bench_workers = commands.add_parser("workers", help="throughput and memory for 1..N gunicorn workers")
+    bench_workers.add_argument("--token", default=os.environ.get("MEDIVISION_TOKEN"), help="bearer token (or MEDIVISION_TOKEN)")
+    bench_workers.add_argument("--max-workers", type=int, default=os.cpu_count() or 1)
+    bench_workers.add_argument("--requests", type=int, default=100)
+    bench_workers.add_argument("--concurrency", type=int, default=16)
+    bench_workers.add_argument("--scan-type", default="xray")
+    bench_workers.add_argument("--port", type=int, default=8765)
+
+async def run_component(args) -> int:
+    """Run one component benchmark against the configured environment (``.env``, MONGO_URL)."""
+    try:
+        if args.command == "stats":
+            print(json.dumps(await benchmark_stats(args.scans, args.iterations), indent=2))
+        elif args.command == "upload":
+            if not args.token:
+                print("upload needs --token or MEDIVISION_TOKEN")
+                return 2
+            results = await benchmark_upload(args.url, args.token, args.images, args.scan_type, args.concurrency)
+            print(json.dumps(results, indent=2))
+        elif args.command == "similarity":
+            print(json.dumps(benchmark_similarity(args.size, args.queries, args.max_distance), indent=2))
+        elif args.command == "reports":
+            print(json.dumps(benchmark_reports(args.iterations), indent=2))
+        elif args.command == "local-analysis":
+            scan_types = tuple(s.strip() for s in args.scan_types.split(",") if s.strip())
+            print(json.dumps(await benchmark_local_analysis(args.images, args.concurrency, scan_types), indent=2))
+        elif args.command == "workers":
+            if not args.token:
+                print("workers needs --token or MEDIVISION_TOKEN")
+                return 2
+            results = await benchmark_workers(
+                args.token, args.max_workers, args.requests, args.concurrency, args.scan_type, args.port
+            )
+            for r in results:
+                print(
+                    f"{r['workers']:2d} workers  {r['requests_per_second']:8.2f} req/s  "
+                    f"p95 {r['p95_ms']:8.1f} ms  RSS {r['loaded_memory']['rss_mb']:8.1f} MB  "
+                    f"PSS {r['loaded_memory']['pss_mb']:8.1f} MB"
+                )
+        elif args.command == "validate-inference":
+            report = validate_xray_backends(
+                _parse_backends(args.backends), xray_validation_inputs(args.images), args.tolerance
+            )
+            for backend, result in report.items():
+                verdict = "ok" if result["passed"] else "FAILED"
+                print(f"{backend:12s} max |dp| = {result['max_abs_diff']:.5f} ({result['worst_pathology']}) {verdict}")
+            return 0 if all(result["passed"] for result in report.values()) else 1
+        elif args.command == "inference":
+            backends = _parse_backends(args.backends)
+            if len(backends) == 1:
+                results = [benchmark_xray_backend(backends[0], args.batch_size, args.iterations)]
+            else:
+                # One process per backend so peak RSS isn't shared between them.
+                results = []
+                for backend in backends:
+                    proc = subprocess.run(
+                        [sys.executable, __file__, "inference", "--backends", backend,
+                         "--batch-size", str(args.batch_size), "--iterations", str(args.iterations), "--json"],
+                        capture_output=True, text=True
+                    )
+                    if proc.returncode != 0:
+                        results.append({"backend": backend, "error": proc.stderr.strip().splitlines()[-1:]})
+                        continue
+                    results.extend(json.loads(proc.stdout.strip().splitlines()[-1]))
+            if args.json:
+                print(json.dumps(results))
+            else:
+                for r in results:
+                    if "error" in r:
+                        print(f"{r['backend']:12s} error: {r['error']}")
+                        continue
+                    print(
+                        f"{r['backend']:12s} p50 {r['p50_ms']:8.2f} ms  p95 {r['p95_ms']:8.2f} ms  "
+                        f"{r['images_per_second']:8.2f} img/s  peak RSS {r['peak_rss_mb']:8.1f} MB"
+                    )
+        return 0
+    finally:
+        if "server" in sys.modules:
+            sys.modules["server"].client.close()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="MediVision API benchmark and load-test suite")
+    parser.add_argument("--scale", choices=sorted(SCALES), default="small")
+    parser.add_argument("--users", type=int, help="override the scale's user count")
+    parser.add_argument("--scans-per-user", type=int)
+    parser.add_argument("--images", type=int, help="distinct upload images")
+    parser.add_argument("--requests", type=int, help="measured requests per workload")
+    parser.add_argument("--concurrency", type=int)
+    parser.add_argument("--workloads", default=",".join(WORKLOADS), help="comma-separated: " + ", ".join(WORKLOADS))
+    parser.add_argument("--warmup", type=int, default=20, help="unmeasured requests before each workload")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--mongo-url", help="use a local mongod instead of mongomock")
+    parser.add_argument("--db-name", default="medivision_benchmark")
+    parser.add_argument("--ai", choices=("mock", "fake-openai"), default="mock",
+                        help="MOCK_AI local analysis, or a fake OpenAI server exercising the cloud path")
+    parser.add_argument("--ai-latency-ms", type=float, default=200.0, help="fake OpenAI response delay")
+    parser.add_argument("--local-ml", action="store_true", help="enable the local X-ray model (needs torch)")
+    parser.add_argument("--bcrypt-rounds", type=int, default=12)
+    parser.add_argument("--output", default=str(ROOT_DIR / "bench_results" / "latest.json"))
+    parser.add_argument("--baseline", help="previous result to diff against; exit 1 on regression")
+    parser.add_argument("--latency-tolerance", type=float, default=0.25)
+    parser.add_argument("--throughput-tolerance", type=float, default=0.20)
+    parser.add_argument("--memory-tolerance", type=float, default=0.25)
+    parser.add_argument("--min-latency-ms", type=float, default=2.0, help="ignore p95 increases smaller than this")
+    add_component_commands(parser.add_subparsers(
+        dest="command", metavar="COMPONENT", help="benchmark one component instead of running the load suite"
+    ))
+    args = parser.parse_args(argv)
+    if args.command:
+        return asyncio.run(run_component(args))
+
+    workloads = [w.strip() for w in args.workloads.split(",") if w.strip()]
+    unknown = set(workloads) - set(WORKLOADS)
+    if unknown:
+        parser.error(f"unknown workloads: {', '.join(sorted(unknown))}")
+    config = dict(SCALES[args.scale])
+    for key in ("users", "scans_per_user", "images", "requests", "concurrency"):
+        if getattr(args, key) is not None:
+            config[key] = getattr(args, key)
+    config.update(
+        scale=args.scale, workloads=workloads, seed=args.seed, ai=args.ai,
+        ai_latency_ms=args.ai_latency_ms if args.ai == "fake-openai" else None,
+        mongo="mongod" if args.mongo_url else "mongomock", local_ml=args.local_ml, bcrypt_rounds=args.bcrypt_rounds,
+    )
+
+    baseline = None
+    if args.baseline:
+        baseline = json.loads(Path(args.baseline).read_text())
+        if baseline.get("config") != config:
+            print(f"Baseline config differs from this run; not comparable:\n  {baseline.get('config')}\n  {config}")
+            return 2
+
+    with tempfile.TemporaryDirectory(prefix="medivision-bench-") as blob_dir:
+        configure_environment(args, blob_dir)
+        sys.path.insert(0, str(ROOT_DIR))
+        results = asyncio.run(run_suite(args, config))
+
+    output = Path(args.output)
+    output.parent.mkdir(parents=True, exist_ok=True)
+    output.write_text(json.dumps(results, indent=2) + "\n")
+    print(f"Results written to {output}")
+
+    if baseline is None:
+        for name, result in results["workloads"].items():
+            latency = result["latency"]
+            print(
+                f"{name:8s} {result['throughput_rps']:8.2f} req/s  p50 {latency['p50_ms']:8.2f} ms  "
+                f"p95 {latency['p95_ms']:8.2f} ms  p99 {latency['p99_ms']:8.2f} ms  errors {result['errors']}  "
+                f"peak RSS {result['memory_mb']['peak_rss']:.1f} MB"
+            )
+        return 0
+
+    rows = compare(
+        results, baseline, args.latency_tolerance, args.throughput_tolerance,
+        args.memory_tolerance, args.min_latency_ms
+    )
+    print_comparison(rows)
+    regressions = [row[0] for row in rows if row[4]]
+    if regressions:
+        print(f"{len(regressions)} regression(s): " + ", ".join(regressions))
+        return 1
+    print("No regressions against baseline")
+    return 0
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,40 @@
+"""Gunicorn settings for multi-worker serving.
+
+    gunicorn -c gunicorn.conf.py server:app
+
+The app is imported once in the master (``preload_app``) and the local
+models are loaded there before forking, so workers share the weights
+copy-on-write instead of each loading their own DenseNet. CPU threads are
+split between workers so they don't oversubscribe the machine.
+"""
+import os
+
+workers = int(os.environ.get("WEB_CONCURRENCY", "2"))
+worker_class = "uvicorn.workers.UvicornWorker"
+bind = f"0.0.0.0:{os.environ.get('PORT', '8001')}"
+preload_app = True
+timeout = int(os.environ.get("GUNICORN_TIMEOUT", "120"))
+graceful_timeout = int(os.environ.get("GUNICORN_GRACEFUL_TIMEOUT", "30"))
+keepalive = 5
+
+# Must be set before server.py (and torch) are imported by preload_app.
+# Each worker's share of the CPUs is split between analysis executor threads
+# and the intra-op threads each of them runs inference with, so their product
+# (not each of them) matches the share.
+_cpus_per_worker = max(1, (os.cpu_count() or 1) // workers)
+os.environ.setdefault("ANALYSIS_LOCAL_WORKERS", str(min(2, _cpus_per_worker)))
+_intra_op_threads = str(max(1, _cpus_per_worker // int(os.environ["ANALYSIS_LOCAL_WORKERS"])))
+for _name in ("XRAY_INTRA_OP_THREADS", "OMP_NUM_THREADS", "MKL_NUM_THREADS"):
+    os.environ.setdefault(_name, _intra_op_threads)
+
+
+def on_starting(arbiter):
+    import server
+
+    server.preload_models_for_fork()
+
+
+def post_fork(arbiter, worker):
+    import server
+
+    server.configure_worker_process()
@@ -1,29 +1,54 @@
-from fastapi import FastAPI, APIRouter, HTTPException, Depends, UploadFile, File, Form
+from fastapi import FastAPI, APIRouter, HTTPException, Depends, UploadFile, File, Form, Query, Request
+from fastapi.responses import JSONResponse, Response, StreamingResponse
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
-from motor.motor_asyncio import AsyncIOMotorClient
+from motor.motor_asyncio import AsyncIOMotorClient, AsyncIOMotorGridFSBucket
+from pymongo import UpdateOne, IndexModel, ReturnDocument, ASCENDING, DESCENDING, monitoring
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+from gridfs.errors import NoFile
+import bson
 import os
 import logging
 import base64
+import asyncio
+import bisect
+import contextlib
+import cProfile
+import functools
+import gc
+import random
+import threading
+import json
+import re
+import sys
+import time
+import hashlib
+import gzip
+import zlib
+import itertools
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 from pathlib import Path
 from pydantic import BaseModel, Field, ConfigDict, EmailStr
 from typing import List, Optional
 import uuid
-from datetime import datetime, timezone
+from datetime import datetime, timezone, timedelta
 import jwt
 import bcrypt
-from PIL import Image, ImageFilter, ImageStat
+from PIL import Image
+import numpy as np
+import orjson
+
+try:
+    import brotli
+except ImportError:  # optional: enables br response compression
+    brotli = None
 import io
 
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
 
-# MongoDB connection
-mongo_url = os.environ['MONGO_URL']
-client = AsyncIOMotorClient(mongo_url)
-db = client[os.environ['DB_NAME']]
-
 # JWT Configuration
 JWT_SECRET = os.environ.get('JWT_SECRET', 'medivision_secret')
 JWT_ALGORITHM = "HS256"
@@ -44,6 +69,293 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# ================== Helpers ==================
+
+def _env_flag(name: str, default: str = "false") -> bool:
+    return os.environ.get(name, default).lower() in ("1", "true", "yes")
+
+class TTLCache:
+    """Bounded LRU with a per-entry TTL and an optional size budget."""
+
+    def __init__(self, max_entries: int, ttl_seconds: float, max_bytes: int = 0, clock=time.monotonic):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.max_bytes = max_bytes
+        self._clock = clock
+        self._data = OrderedDict()  # key -> (expires_at, size, value)
+        self.bytes = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def get(self, key, default=None):
+        item = self._data.get(key)
+        if item is None:
+            return default
+        expires_at, _, value = item
+        if expires_at <= self._clock():
+            self.pop(key)
+            self.expirations += 1
+            return default
+        self._data.move_to_end(key)
+        return value
+
+    def set(self, key, value, size: int = 0, ttl: Optional[float] = None):
+        self.pop(key)
+        if self.max_bytes and size > self.max_bytes:
+            return
+        ttl = self.ttl_seconds if ttl is None else ttl
+        self._data[key] = (self._clock() + ttl, size, value)
+        self.bytes += size
+        while len(self._data) > self.max_entries or (self.max_bytes and self.bytes > self.max_bytes):
+            _, (_, evicted_size, _) = self._data.popitem(last=False)
+            self.bytes -= evicted_size
+            self.evictions += 1
+
+    def pop(self, key, default=None):
+        item = self._data.pop(key, None)
+        if item is None:
+            return default
+        self.bytes -= item[1]
+        return item[2]
+
+    def clear(self):
+        self._data.clear()
+        self.bytes = 0
+
+# ================== Metrics ==================
+
+# Prometheus-format instrumentation. With METRICS_ENABLED=false the timers
+# are a shared no-op, nothing is registered with pymongo and the loop lag
+# monitor never starts.
+METRICS_ENABLED = _env_flag("METRICS_ENABLED", "true")
+METRICS_TOKEN = os.environ.get("METRICS_TOKEN")
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+def _escape_label(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def _format_labels(names: tuple, values: tuple, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape_label(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+class Histogram:
+    """Thread-safe labelled histogram (observations come from executor and pymongo threads too)."""
+
+    def __init__(self, name: str, help: str, labelnames: tuple = (), buckets: tuple = DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self.buckets = tuple(sorted(buckets))
+        self._series = {}  # label values -> [per-bucket counts, sum, count]
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, *labels):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [[0] * len(self.buckets), 0.0, 0]
+            if index < len(self.buckets):
+                series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def time(self, *labels):
+        return _Timer(self, labels) if METRICS_ENABLED else _NOOP_TIMER
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            series = {labels: (list(counts), total, count) for labels, (counts, total, count) in self._series.items()}
+        for labels, (counts, total, count) in sorted(series.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                bucket_labels = _format_labels(self.labelnames, labels, 'le="%s"' % bound)
+                lines.append(f"{self.name}_bucket{bucket_labels} {cumulative}")
+            bucket_labels = _format_labels(self.labelnames, labels, 'le="+Inf"')
+            lines.append(f"{self.name}_bucket{bucket_labels} {count}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, labels)} {total}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, labels)} {count}")
+        return lines
+
+class Counter:
+    def __init__(self, name: str, help: str, labelnames: tuple = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labels, amount: float = 1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            values = sorted(self._values.items())
+        lines.extend(f"{self.name}{_format_labels(self.labelnames, labels)} {value}" for labels, value in values)
+        return lines
+
+class _Timer:
+    __slots__ = ("histogram", "labels", "started")
+
+    def __init__(self, histogram: Histogram, labels: tuple):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.perf_counter() - self.started, *self.labels)
+
+_NOOP_TIMER = contextlib.nullcontext()
+
+class MetricsRegistry:
+    """Holds the metrics and renders them (plus component ``stats()`` gauges) as Prometheus text."""
+
+    def __init__(self, prefix: str):
+        self.prefix = prefix
+        self._metrics = []
+        self._collectors = {}
+
+    def histogram(self, name: str, help: str, labelnames: tuple = (), buckets: tuple = DEFAULT_BUCKETS) -> Histogram:
+        metric = Histogram(f"{self.prefix}_{name}", help, labelnames, buckets)
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name: str, help: str, labelnames: tuple = ()) -> Counter:
+        metric = Counter(f"{self.prefix}_{name}", help, labelnames)
+        self._metrics.append(metric)
+        return metric
+
+    def collect(self, component: str, stats_fn):
+        """Export the numeric fields of ``stats_fn()`` as gauges at scrape time."""
+        self._collectors[component] = stats_fn
+
+    def _gauges(self, name: str, value) -> list:
+        if isinstance(value, dict):
+            return [line for key, item in value.items() for line in self._gauges(f"{name}_{key}", item)]
+        if isinstance(value, bool):
+            value = int(value)
+        if not isinstance(value, (int, float)):
+            return []
+        name = re.sub(r"[^a-zA-Z0-9_]", "_", name)
+        return [f"# TYPE {name} gauge", f"{name} {value}"]
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        for component, stats_fn in self._collectors.items():
+            try:
+                lines.extend(self._gauges(f"{self.prefix}_{component}", stats_fn()))
+            except Exception as e:
+                logger.warning(f"Metrics collector {component} failed: {e}")
+        return "\n".join(lines) + "\n"
+
+metrics = MetricsRegistry("medivision")
+http_request_seconds = metrics.histogram(
+    "http_request_seconds", "HTTP request latency by route", ("method", "route", "status")
+)
+stage_seconds = metrics.histogram("stage_seconds", "Time spent in each scan pipeline stage", ("stage",))
+analysis_seconds = metrics.histogram("analysis_seconds", "End-to-end analysis latency by serving tier", ("tier",))
+inference_seconds = metrics.histogram("inference_seconds", "Local model inference time per call", ("model", "backend"))
+inference_batch_size = metrics.histogram(
+    "inference_batch_size", "Images per local inference call", ("model",), buckets=(1, 2, 4, 8, 16, 32, 64)
+)
+mongo_command_seconds = metrics.histogram(
+    "mongo_command_seconds", "MongoDB command latency", ("command", "outcome")
+)
+event_loop_lag_seconds = metrics.histogram(
+    "event_loop_lag_seconds", "Event loop scheduling delay", buckets=(0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5)
+)
+profiles_written = metrics.counter("profiles_written_total", "Sampled request profiles written to disk")
+
+class MongoCommandMetrics(monitoring.CommandListener):
+    """Feeds pymongo command events into ``mongo_command_seconds``."""
+
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        mongo_command_seconds.observe(event.duration_micros / 1e6, event.command_name, "ok")
+
+    def failed(self, event):
+        mongo_command_seconds.observe(event.duration_micros / 1e6, event.command_name, "error")
+
+async def monitor_event_loop_lag(interval: float = 0.5):
+    """Sleep ``interval`` in a loop; any overshoot is time the loop was blocked."""
+    loop = asyncio.get_running_loop()
+    while True:
+        started = loop.time()
+        await asyncio.sleep(interval)
+        event_loop_lag_seconds.observe(max(0.0, loop.time() - started - interval))
+
+# cProfile sampling: a fraction of requests is profiled and dumped as .prof
+# files (load with pstats or snakeviz). cProfile sees the whole loop thread,
+# so concurrent requests show up in a sample too.
+PROFILE_SAMPLE_RATE = float(os.environ.get("PROFILE_SAMPLE_RATE", "0"))
+PROFILE_DIR = Path(os.environ.get("PROFILE_DIR", str(ROOT_DIR / "profiles")))
+
+class MetricsMiddleware:
+    """Times every HTTP request and samples some of them with cProfile."""
+
+    def __init__(self, app, profile_rate: float = 0.0):
+        self.app = app
+        self.profile_rate = profile_rate
+        self._profiling = False
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not METRICS_ENABLED:
+            return await self.app(scope, receive, send)
+
+        status = 500
+
+        async def tracking_send(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        profiler = None
+        if self.profile_rate > 0 and not self._profiling and random.random() < self.profile_rate:
+            self._profiling = True
+            profiler = cProfile.Profile()
+            profiler.enable()
+
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, tracking_send)
+        finally:
+            route = scope.get("route")
+            http_request_seconds.observe(
+                time.perf_counter() - started, scope["method"], getattr(route, "path", "unmatched"), status
+            )
+            if profiler is not None:
+                profiler.disable()
+                self._profiling = False
+                await asyncio.to_thread(self._dump, profiler, scope)
+
+    def _dump(self, profiler, scope):
+        PROFILE_DIR.mkdir(parents=True, exist_ok=True)
+        slug = re.sub(r"[^a-zA-Z0-9]+", "_", scope["path"]).strip("_") or "root"
+        profiler.dump_stats(str(PROFILE_DIR / f"{int(time.time() * 1000)}-{scope['method']}-{slug}.prof"))
+        profiles_written.inc()
+
+# MongoDB connection
+mongo_url = os.environ['MONGO_URL']
+client = AsyncIOMotorClient(mongo_url, event_listeners=[MongoCommandMetrics()] if METRICS_ENABLED else [])
+db = client[os.environ['DB_NAME']]
+
 # ================== Models ==================
 
 class UserCreate(BaseModel):
@@ -81,6 +393,8 @@ class ScanResponse(BaseModel):
     status: str
     doctor_view: Optional[dict] = None
     patient_view: Optional[dict] = None
+    analysis_tier: Optional[str] = None
+    analysis_model: Optional[str] = None
     created_at: str
 
 class AnalysisRequest(BaseModel):
@@ -88,25 +402,184 @@ class AnalysisRequest(BaseModel):
 
 # ================== Auth Helpers ==================
 
-def hash_password(password: str) -> str:
-    return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
+BCRYPT_ROUNDS = int(os.environ.get("BCRYPT_ROUNDS", "12"))
+
+def hash_password(password: str, rounds: int = BCRYPT_ROUNDS) -> str:
+    return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt(rounds=rounds)).decode('utf-8')
 
 def verify_password(password: str, hashed: str) -> bool:
     return bcrypt.checkpw(password.encode('utf-8'), hashed.encode('utf-8'))
 
-def create_token(user_id: str, email: str) -> str:
+def password_hash_rounds(hashed: str) -> Optional[int]:
+    # bcrypt hashes look like $2b$12$<salt+digest>
+    try:
+        return int(hashed.split("$")[2])
+    except (IndexError, ValueError):
+        return None
+
+class PasswordHasher:
+    """Runs bcrypt on its own bounded pool so logins cannot starve other routes.
+
+    Up to ``max_pending`` calls may wait for a worker; beyond that callers get
+    a 429 instead of piling onto the queue.
+    """
+
+    def __init__(self, workers: int, max_pending: int, rounds: int):
+        self.workers = workers
+        self.max_pending = max_pending
+        self.rounds = rounds
+        self._executor = None
+        self.pending = 0
+        self.rejected = 0
+        self.rehashed = 0
+
+    def _get_executor(self):
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="bcrypt")
+        return self._executor
+
+    async def _run(self, fn, *args):
+        if self.pending >= self.workers + self.max_pending:
+            self.rejected += 1
+            raise HTTPException(
+                status_code=429,
+                detail="Too many authentication requests, please retry shortly",
+                headers={"Retry-After": "1"}
+            )
+        self.pending += 1
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self._get_executor(), functools.partial(fn, *args))
+        finally:
+            self.pending -= 1
+
+    async def hash(self, password: str) -> str:
+        return await self._run(hash_password, password, self.rounds)
+
+    async def verify(self, password: str, hashed: str) -> bool:
+        return await self._run(verify_password, password, hashed)
+
+    def needs_rehash(self, hashed: str) -> bool:
+        return password_hash_rounds(hashed) != self.rounds
+
+    def stats(self) -> dict:
+        return {
+            "workers": self.workers,
+            "max_pending": self.max_pending,
+            "rounds": self.rounds,
+            "pending": self.pending,
+            "rejected": self.rejected,
+            "rehashed": self.rehashed,
+        }
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+password_hasher = PasswordHasher(
+    workers=int(os.environ.get("AUTH_HASH_WORKERS", "2")),
+    max_pending=int(os.environ.get("AUTH_HASH_MAX_PENDING", "32")),
+    rounds=BCRYPT_ROUNDS,
+)
+
+# Claims that let AUTH_TRUST_TOKEN_CLAIMS mode build the principal without a lookup.
+TOKEN_PRINCIPAL_CLAIMS = ("user_id", "email", "name", "created_at")
+
+def create_token(user_id: str, email: str, name: Optional[str] = None, created_at: Optional[str] = None) -> str:
     payload = {
         "user_id": user_id,
         "email": email,
         "exp": datetime.now(timezone.utc).timestamp() + 86400 * 7  # 7 days
     }
+    if name is not None and created_at is not None:
+        payload["name"] = name
+        payload["created_at"] = created_at
     return jwt.encode(payload, JWT_SECRET, algorithm=JWT_ALGORITHM)
 
+class PrincipalCache:
+    """Memoizes decoded tokens (until ``exp``) and user records (for a short TTL).
+
+    Call ``invalidate_user`` whenever a user document changes or is deleted;
+    other processes see the change once their entry's TTL runs out. With
+    ``trust_token_claims`` the principal is built from the signed token
+    claims and the users collection is not consulted at all, so a token
+    cannot be revoked: it keeps working, with the claims it was issued with,
+    until it expires, even if the user is changed or deleted.
+    """
+
+    def __init__(self, max_entries: int, ttl_seconds: float, trust_token_claims: bool):
+        self.trust_token_claims = trust_token_claims
+        self.users = TTLCache(max_entries, ttl_seconds)
+        self.tokens = TTLCache(max_entries, ttl_seconds)
+        self.token_hits = 0
+        self.token_misses = 0
+        self.user_hits = 0
+        self.user_misses = 0
+        self.claim_hits = 0
+
+    def decode(self, token: str) -> dict:
+        payload = self.tokens.get(token)
+        if payload is not None:
+            self.token_hits += 1
+            return payload
+        self.token_misses += 1
+        payload = jwt.decode(token, JWT_SECRET, algorithms=[JWT_ALGORITHM])
+        remaining = payload.get("exp", 0) - datetime.now(timezone.utc).timestamp()
+        if remaining > 0:
+            self.tokens.set(token, payload, ttl=remaining)
+        return payload
+
+    async def resolve(self, payload: dict) -> Optional[dict]:
+        user_id = payload["user_id"]
+        if self.trust_token_claims and all(claim in payload for claim in TOKEN_PRINCIPAL_CLAIMS):
+            self.claim_hits += 1
+            return {
+                "id": user_id,
+                "email": payload["email"],
+                "name": payload["name"],
+                "created_at": payload["created_at"],
+            }
+
+        user = self.users.get(user_id)
+        if user is not None:
+            self.user_hits += 1
+            return user
+        self.user_misses += 1
+        user = await db.users.find_one({"id": user_id}, {"_id": 0, "password_hash": 0})
+        if user:
+            self.users.set(user_id, user)
+        return user
+
+    def invalidate_user(self, user_id: str):
+        self.users.pop(user_id)
+
+    def stats(self) -> dict:
+        user_lookups = self.user_hits + self.user_misses + self.claim_hits
+        token_lookups = self.token_hits + self.token_misses
+        return {
+            "trust_token_claims": self.trust_token_claims,
+            "cached_users": len(self.users),
+            "cached_tokens": len(self.tokens),
+            "token_hits": self.token_hits,
+            "token_misses": self.token_misses,
+            "user_hits": self.user_hits,
+            "user_misses": self.user_misses,
+            "claim_hits": self.claim_hits,
+            "token_hit_rate": round(self.token_hits / token_lookups, 4) if token_lookups else 0.0,
+            "user_hit_rate": round((self.user_hits + self.claim_hits) / user_lookups, 4) if user_lookups else 0.0,
+        }
+
+principal_cache = PrincipalCache(
+    max_entries=int(os.environ.get("AUTH_CACHE_MAX_ENTRIES", "10000")),
+    ttl_seconds=float(os.environ.get("AUTH_CACHE_TTL_SECONDS", "60")),
+    trust_token_claims=_env_flag("AUTH_TRUST_TOKEN_CLAIMS"),
+)
+
 async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)):
     try:
         token = credentials.credentials
-        payload = jwt.decode(token, JWT_SECRET, algorithms=[JWT_ALGORITHM])
-        user = await db.users.find_one({"id": payload["user_id"]}, {"_id": 0})
+        payload = principal_cache.decode(token)
+        user = await principal_cache.resolve(payload)
         if not user:
             raise HTTPException(status_code=401, detail="User not found")
         return user
@@ -115,191 +588,1176 @@ async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(s
     except jwt.InvalidTokenError:
         raise HTTPException(status_code=401, detail="Invalid token")
 
+# ================== Blob Storage ==================
+
+class BlobStore:
+    """Content-addressed storage for image bytes, keyed by their SHA-256."""
+
+    name = "base"
+
+    async def put(self, data: bytes, content_type: str = "image/jpeg") -> str:
+        raise NotImplementedError
+
+    async def size(self, key: str) -> Optional[int]:
+        raise NotImplementedError
+
+    async def read(self, key: str, start: int = 0, end: Optional[int] = None) -> bytes:
+        raise NotImplementedError
+
+    async def delete(self, key: str):
+        raise NotImplementedError
+
+    async def iter_range(self, key: str, start: int, end: int, chunk_size: int = 256 * 1024):
+        """Yield bytes ``start..end`` (inclusive) in chunks."""
+        position = start
+        while position <= end:
+            stop = min(end, position + chunk_size - 1)
+            yield await self.read(key, position, stop)
+            position = stop + 1
+
+class LocalBlobStore(BlobStore):
+    name = "local"
+
+    def __init__(self, root: Path):
+        self.root = Path(root)
+
+    def _path(self, key: str) -> Path:
+        return self.root / key[:2] / key
+
+    def _write(self, key: str, data: bytes):
+        path = self._path(key)
+        if path.exists():
+            return
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_suffix(f".{uuid.uuid4().hex}.tmp")
+        tmp_path.write_bytes(data)
+        os.replace(tmp_path, path)
+
+    def _read(self, key: str, start: int, end: Optional[int]) -> bytes:
+        with open(self._path(key), "rb") as f:
+            f.seek(start)
+            return f.read() if end is None else f.read(end - start + 1)
+
+    async def put(self, data: bytes, content_type: str = "image/jpeg") -> str:
+        key = hashlib.sha256(data).hexdigest()
+        await asyncio.to_thread(self._write, key, data)
+        return key
+
+    async def size(self, key: str) -> Optional[int]:
+        try:
+            return (await asyncio.to_thread(self._path(key).stat)).st_size
+        except FileNotFoundError:
+            return None
+
+    async def read(self, key: str, start: int = 0, end: Optional[int] = None) -> bytes:
+        return await asyncio.to_thread(self._read, key, start, end)
+
+    async def delete(self, key: str):
+        await asyncio.to_thread(self._path(key).unlink, True)
+
+class GridFSBlobStore(BlobStore):
+    name = "gridfs"
+
+    def __init__(self, database, bucket_name: str = "images"):
+        self.files = database[f"{bucket_name}.files"]
+        self.bucket = AsyncIOMotorGridFSBucket(database, bucket_name=bucket_name)
+
+    async def put(self, data: bytes, content_type: str = "image/jpeg") -> str:
+        key = hashlib.sha256(data).hexdigest()
+        if await self.files.find_one({"filename": key}, {"_id": 1}) is None:
+            await self.bucket.upload_from_stream(key, data, metadata={"content_type": content_type})
+            # Concurrent first writes of the same bytes each add a revision; keep
+            # the oldest (the one reads use) and drop the rest.
+            async for doc in self.files.find({"filename": key}, {"_id": 1}).sort("_id", ASCENDING).skip(1):
+                with contextlib.suppress(NoFile):
+                    await self.bucket.delete(doc["_id"])
+        return key
+
+    async def size(self, key: str) -> Optional[int]:
+        doc = await self.files.find_one({"filename": key}, {"length": 1}, sort=[("_id", ASCENDING)])
+        return doc["length"] if doc else None
+
+    async def read(self, key: str, start: int = 0, end: Optional[int] = None) -> bytes:
+        grid_out = await self.bucket.open_download_stream_by_name(key, revision=0)
+        grid_out.seek(start)
+        return await grid_out.read(-1 if end is None else end - start + 1)
+
+    async def delete(self, key: str):
+        async for doc in self.files.find({"filename": key}, {"_id": 1}):
+            await self.bucket.delete(doc["_id"])
+
+def create_blob_store() -> BlobStore:
+    backend = os.environ.get("BLOB_STORE", "gridfs").lower()
+    if backend == "local":
+        return LocalBlobStore(os.environ.get("BLOB_STORE_PATH", str(ROOT_DIR / "blobs")))
+    return GridFSBlobStore(db, os.environ.get("BLOB_STORE_BUCKET", "images"))
+
+blob_store = create_blob_store()
+
+async def load_scan_image(scan: dict) -> bytes:
+    """Image bytes for a scan, from the blob store or a legacy inline field."""
+    if scan.get("image_base64"):
+        return base64.b64decode(scan["image_base64"])
+    return await blob_store.read(scan["image_sha256"])
+
+# Scans with identical content share one blob, so db.blob_refs counts the
+# references to each key. Whoever drops the count to zero marks the count
+# document as deleting before removing the bytes; an upload of the same
+# content can't take a reference until that delete has finished, and then
+# stores the bytes again.
+BLOB_DELETE_LEASE_SECONDS = 60
+
+async def acquire_blob(key: str):
+    while True:
+        try:
+            await db.blob_refs.update_one(
+                {"_id": key, "$or": [{"deleting_until": None}, {"deleting_until": {"$lt": time.time()}}]},
+                {"$inc": {"refs": 1}, "$unset": {"deleting_until": ""}},
+                upsert=True
+            )
+            return
+        except DuplicateKeyError:
+            await asyncio.sleep(0.05)
+
+async def store_blob(data: bytes, content_type: str = "image/jpeg") -> str:
+    """Take a reference on ``data``'s blob, then make sure its bytes are stored."""
+    key = hashlib.sha256(data).hexdigest()
+    await acquire_blob(key)
+    try:
+        return await blob_store.put(data, content_type)
+    except Exception:
+        await release_blob(key)
+        raise
+
+async def release_blob(key: Optional[str], field: str = "image_sha256"):
+    """Drop one scan's reference to a blob; the last one out deletes it."""
+    if not key:
+        return
+    refs = await db.blob_refs.find_one_and_update(
+        {"_id": key}, {"$inc": {"refs": -1}}, return_document=ReturnDocument.AFTER
+    )
+    if refs is not None and refs["refs"] > 0:
+        return
+    if await db.scans.find_one({field: key}, {"_id": 1}):
+        # Still used by a scan stored before blobs were reference counted.
+        return
+    try:
+        await db.blob_refs.update_one(
+            {"_id": key, "refs": {"$lte": 0}, "deleting_until": None},
+            {"$set": {"deleting_until": time.time() + BLOB_DELETE_LEASE_SECONDS}, "$setOnInsert": {"refs": 0}},
+            upsert=True
+        )
+    except DuplicateKeyError:
+        # Referenced again in the meantime, or already being deleted.
+        return
+    await blob_store.delete(key)
+    await db.blob_refs.delete_one({"_id": key, "refs": {"$lte": 0}})
+
+async def release_scan_blobs(scan_doc: dict):
+    """Drop the references an upload took for a scan that never got stored."""
+    await release_blob(scan_doc.get("image_sha256"))
+    await release_blob(scan_doc.get("thumbnail_sha256"), field="thumbnail_sha256")
+
 # ================== Image Processing ==================
 
-def preprocess_image(image_bytes: bytes) -> bytes:
-    """Normalize image size using PIL"""
+MAX_UPLOAD_BYTES = int(os.environ.get("MAX_UPLOAD_BYTES", str(50 * 1024 * 1024)))
+MAX_REQUEST_BYTES = int(os.environ.get("MAX_REQUEST_BYTES", str(100 * 1024 * 1024)))
+MAX_IMAGE_PIXELS = int(os.environ.get("MAX_IMAGE_PIXELS", str(100_000_000)))
+THUMBNAIL_SIZE = int(os.environ.get("THUMBNAIL_SIZE", "160"))
+
+def sniff_image_type(header: bytes) -> Optional[str]:
+    """Identify JPEG/PNG/WEBP from magic bytes, ignoring the client's content type."""
+    if header.startswith(b"\xff\xd8\xff"):
+        return "image/jpeg"
+    if header.startswith(b"\x89PNG\r\n\x1a\n"):
+        return "image/png"
+    if header[:4] == b"RIFF" and header[8:12] == b"WEBP":
+        return "image/webp"
+    return None
+
+def make_thumbnail(image: Image.Image) -> bytes:
+    """Small JPEG preview used by scan listings."""
+    thumb = image.copy()
+    if thumb.mode not in ('RGB', 'L'):
+        thumb = thumb.convert('RGB')
+    thumb.thumbnail((THUMBNAIL_SIZE, THUMBNAIL_SIZE), Image.Resampling.LANCZOS)
+    buffer = io.BytesIO()
+    thumb.save(buffer, format='JPEG', quality=75)
+    return buffer.getvalue()
+
+def dhash(image: Image.Image) -> str:
+    """64-bit difference hash (16 hex chars); stable across re-encoding and rescaling."""
+    small = np.asarray(image.convert("L").resize((9, 8), Image.Resampling.BILINEAR), dtype=np.int16)
+    bits = (small[:, 1:] > small[:, :-1]).flatten()
+    return f"{int(np.packbits(bits).view('>u8')[0]):016x}"
+
+def preprocess_image(source) -> tuple:
+    """Normalize image size using PIL; returns ``(processed_bytes, thumbnail_bytes, dhash)``
+
+    ``source`` may be bytes or a binary file object, which PIL reads
+    incrementally. JPEGs are downscaled during decode via ``draft()`` so the
+    full-resolution bitmap is never materialized.
+    """
+    if isinstance(source, (bytes, bytearray)):
+        source = io.BytesIO(source)
+    image = Image.open(source)
+    if image.width * image.height > MAX_IMAGE_PIXELS:
+        raise ValueError(f"Image is too large ({image.width}x{image.height})")
+    # Resize to max 1024x1024 while maintaining aspect ratio
+    max_size = (1024, 1024)
+    image.draft(image.mode, max_size)
+    # Convert to RGB if necessary
+    if image.mode not in ('RGB', 'L'):
+        image = image.convert('RGB')
+    image.thumbnail(max_size, Image.Resampling.LANCZOS)
+    # Save to bytes
+    buffer = io.BytesIO()
+    image.save(buffer, format='JPEG', quality=85)
+    return buffer.getvalue(), make_thumbnail(image), dhash(image)
+
+async def read_upload_image(file: UploadFile) -> tuple:
+    """Validate an upload by size and magic bytes, then preprocess it off the loop.
+
+    The spooled upload file is handed to PIL directly, so no full in-memory
+    copy of the original is made.
+    """
+    size = file.size
+    if size is None:
+        file.file.seek(0, os.SEEK_END)
+        size = file.file.tell()
+    if size > MAX_UPLOAD_BYTES:
+        raise HTTPException(status_code=413, detail=f"Image exceeds the {MAX_UPLOAD_BYTES // (1024 * 1024)} MB upload limit")
+
+    await file.seek(0)
+    header = await file.read(16)
+    await file.seek(0)
+    if sniff_image_type(header) is None:
+        raise HTTPException(status_code=400, detail="Only JPEG, PNG, and WEBP images are allowed")
+
     try:
-        image = Image.open(io.BytesIO(image_bytes))
-        # Convert to RGB if necessary
-        if image.mode in ('RGBA', 'P'):
-            image = image.convert('RGB')
-        # Resize to max 1024x1024 while maintaining aspect ratio
-        max_size = (1024, 1024)
-        image.thumbnail(max_size, Image.Resampling.LANCZOS)
-        # Save to bytes
-        buffer = io.BytesIO()
-        image.save(buffer, format='JPEG', quality=85)
-        return buffer.getvalue()
+        with stage_seconds.time("preprocess"):
+            return await ingest_executor.run(preprocess_image, file.file)
     except Exception as e:
         logger.error(f"Image preprocessing error: {e}")
-        return image_bytes
-
-async def analyze_with_gemini(image_base64: str, scan_type: str) -> dict:
-    """Analyze medical image using OpenAI vision models with local fallback."""
-    _local_xray_model = getattr(analyze_with_gemini, "_local_xray_model", None)
+        raise HTTPException(status_code=400, detail="Could not decode image")
+
+class RequestTooLarge(HTTPException):
+    # An HTTPException so FastAPI's body parsing re-raises it instead of answering 400.
+    def __init__(self):
+        super().__init__(status_code=413, detail="Request body too large")
+
+class RequestSizeLimitMiddleware:
+    """Rejects request bodies over ``max_bytes`` while they are still streaming in.
+
+    ``path_limits`` maps exact request paths to their own (e.g. batch upload) limit.
+    """
+
+    def __init__(self, app, max_bytes: int, path_limits: Optional[dict] = None):
+        self.app = app
+        self.max_bytes = max_bytes
+        self.path_limits = path_limits or {}
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        max_bytes = self.path_limits.get(scope.get("path"), self.max_bytes)
+        content_length = dict(scope["headers"]).get(b"content-length")
+        if content_length and content_length.isdigit() and int(content_length) > max_bytes:
+            return await self._reject(send)
+
+        received = 0
+        response_started = False
+
+        async def limited_receive():
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > max_bytes:
+                    raise RequestTooLarge()
+            return message
+
+        async def tracking_send(message):
+            nonlocal response_started
+            if message["type"] == "http.response.start":
+                response_started = True
+            await send(message)
 
-    def analyze_locally_with_ml(image_b64: str, scan_kind: str) -> dict:
-        """
-        Local ML inference for chest X-ray using torchxrayvision DenseNet.
-        Requires: torch, numpy, scikit-image, torchxrayvision
-        """
-        if scan_kind.lower() != "xray":
-            raise RuntimeError("Local ML model currently supports xray only.")
-
-        import numpy as np
-        import torch
-        from skimage.transform import resize
-        import torchxrayvision as xrv
-
-        nonlocal _local_xray_model
-        if _local_xray_model is None:
-            _local_xray_model = xrv.models.DenseNet(weights="densenet121-res224-all")
-            _local_xray_model.eval()
-            setattr(analyze_with_gemini, "_local_xray_model", _local_xray_model)
-
-        image_bytes = base64.b64decode(image_b64)
-        image = Image.open(io.BytesIO(image_bytes)).convert("L")
-        img = np.array(image).astype(np.float32) / 255.0
-        img = resize(img, (224, 224), anti_aliasing=True, preserve_range=True).astype(np.float32)
-        img = img[None, None, :, :]  # [B,C,H,W]
-
-        with torch.no_grad():
-            preds = _local_xray_model(torch.from_numpy(img))
-            probs = torch.sigmoid(preds)[0].cpu().numpy()
+        try:
+            await self.app(scope, limited_receive, tracking_send)
+        except RequestTooLarge:
+            if not response_started:
+                await self._reject(send)
+
+    async def _reject(self, send):
+        response = JSONResponse(status_code=413, content={"detail": "Request body too large"})
+        await response({"type": "http"}, None, send)
+
+RESPONSE_COMPRESSION_MIN_BYTES = int(os.environ.get("RESPONSE_COMPRESSION_MIN_BYTES", "1024"))
+RESPONSE_COMPRESSION_LEVEL = int(os.environ.get("RESPONSE_COMPRESSION_LEVEL", "6"))
+
+class CompressionMiddleware:
+    """gzip (or br, when the ``brotli`` package is installed) for complete JSON/text responses.
+
+    Streamed bodies (NDJSON batches, image downloads) and already-encoded
+    responses pass through untouched, so streaming keeps its latency.
+    """
+
+    COMPRESSIBLE_TYPES = (b"application/json", b"text/")
+    SKIP_STATUSES = {204, 206, 304}
+
+    def __init__(self, app, minimum_size: int, level: int):
+        self.app = app
+        self.minimum_size = minimum_size
+        self.level = level
+
+    def _encoding(self, scope) -> Optional[str]:
+        accept = dict(scope["headers"]).get(b"accept-encoding", b"").decode("latin-1")
+        offered = set()
+        for part in accept.split(","):
+            name, *params = [token.strip().lower() for token in part.split(";")]
+            q = next((param[2:] for param in params if param.startswith("q=")), "1")
+            try:
+                if float(q) > 0:
+                    offered.add(name)
+            except ValueError:
+                continue  # malformed q: treat as not acceptable
+        if brotli is not None and "br" in offered:
+            return "br"
+        if "gzip" in offered:
+            return "gzip"
+        return None
+
+    def _compress(self, body: bytes, encoding: str) -> bytes:
+        if encoding == "br":
+            return brotli.compress(body, quality=min(self.level, 11))
+        return gzip.compress(body, compresslevel=self.level, mtime=0)
+
+    async def __call__(self, scope, receive, send):
+        encoding = self._encoding(scope) if scope["type"] == "http" else None
+        if encoding is None:
+            return await self.app(scope, receive, send)
+
+        start = None
+
+        async def compressing_send(message):
+            nonlocal start
+            if start is None and message["type"] == "http.response.start":
+                headers = dict(message.get("headers", []))
+                if (message["status"] in self.SKIP_STATUSES or b"content-encoding" in headers
+                        or not headers.get(b"content-type", b"").startswith(self.COMPRESSIBLE_TYPES)):
+                    start = False
+                    return await send(message)
+                start = message
+                return
+            if not start or message["type"] != "http.response.body":
+                return await send(message)
+
+            message_start, start = start, False
+            body = message.get("body", b"")
+            headers = [(k, v) for k, v in message_start.get("headers", []) if k != b"content-length"]
+            if message.get("more_body") or len(body) < self.minimum_size:
+                # Streaming or too small to be worth it: forward as-is.
+                await send(message_start)
+                return await send(message)
+
+            body = self._compress(body, encoding)
+            headers = [(k, b"W/" + v if k == b"etag" and not v.startswith(b"W/") else v) for k, v in headers]
+            vary = b", ".join([v for k, v in headers if k == b"vary"] + [b"Accept-Encoding"])
+            headers = [(k, v) for k, v in headers if k != b"vary"] + [
+                (b"content-encoding", encoding.encode()),
+                (b"content-length", str(len(body)).encode()),
+                (b"vary", vary),
+            ]
+            await send({**message_start, "headers": headers})
+            await send({"type": "http.response.body", "body": body})
+
+        await self.app(scope, receive, compressing_send)
+
+def json_response(request: Request, content, headers: Optional[dict] = None) -> Response:
+    """orjson-serialized response with a weak ETag; answers a matching If-None-Match with 304."""
+    body = orjson.dumps(content)
+    etag = 'W/"%s"' % hashlib.blake2b(body, digest_size=12).hexdigest()
+    headers = {**(headers or {}), "ETag": etag, "Cache-Control": "private, no-cache"}
+    if_none_match = request.headers.get("if-none-match", "")
+    if etag in (tag.strip() for tag in if_none_match.split(",")) or if_none_match.strip() == "*":
+        return Response(status_code=304, headers=headers)
+    return Response(content=body, media_type="application/json", headers=headers)
+
+# ================== Analysis Executor ==================
+
+class AnalysisExecutor:
+    """Bounded pool that keeps CPU-bound analysis off the event loop."""
+
+    def __init__(self, max_workers: int, max_concurrency: int, kind: str = "thread"):
+        self.max_workers = max_workers
+        self.max_concurrency = max_concurrency
+        self.kind = kind
+        self._executor = None
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self.queued = 0
+        self.running = 0
+        self.peak_queued = 0
+        self.completed = 0
+        self.failed = 0
+
+    def _get_executor(self):
+        if self._executor is None:
+            if self.kind == "process":
+                self._executor = ProcessPoolExecutor(max_workers=self.max_workers)
+            else:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=self.max_workers, thread_name_prefix="analysis"
+                )
+        return self._executor
+
+    async def run(self, fn, *args):
+        loop = asyncio.get_running_loop()
+        self.queued += 1
+        self.peak_queued = max(self.peak_queued, self.queued)
+        waiting = True
+        try:
+            async with self._semaphore:
+                self.queued -= 1
+                waiting = False
+                self.running += 1
+                try:
+                    result = await loop.run_in_executor(self._get_executor(), functools.partial(fn, *args))
+                except Exception:
+                    self.failed += 1
+                    raise
+                finally:
+                    self.running -= 1
+                self.completed += 1
+                return result
+        finally:
+            if waiting:
+                self.queued -= 1
+
+    def stats(self) -> dict:
+        return {
+            "kind": self.kind,
+            "max_workers": self.max_workers,
+            "max_concurrency": self.max_concurrency,
+            "queued": self.queued,
+            "running": self.running,
+            "peak_queued": self.peak_queued,
+            "completed": self.completed,
+            "failed": self.failed,
+        }
 
-        pathologies = _local_xray_model.pathologies
-        top_idx = np.argsort(probs)[::-1][:5]
-        top_items = [(pathologies[i], float(probs[i])) for i in top_idx if probs[i] >= 0.20]
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
 
-        if not top_items:
-            top_items = [("No high-probability abnormality detected by local model", 0.0)]
+analysis_executor = AnalysisExecutor(
+    max_workers=int(os.environ.get("ANALYSIS_LOCAL_WORKERS", str(min(4, os.cpu_count() or 1)))),
+    max_concurrency=int(os.environ.get("ANALYSIS_MAX_CONCURRENCY", "4")),
+    kind=os.environ.get("ANALYSIS_EXECUTOR", "thread"),
+)
 
-        findings = [f"{name}: probability {prob:.2f}" for name, prob in top_items]
-        likely = [name for name, prob in top_items if prob >= 0.35 and "No high-probability" not in name]
-        likely_text = ", ".join(likely) if likely else "No strong abnormality signal"
+# Upload decoding gets its own small pool; its concurrency caps how many
+# decoded images are in memory at once.
+ingest_executor = AnalysisExecutor(
+    max_workers=int(os.environ.get("INGEST_WORKERS", "2")),
+    max_concurrency=int(os.environ.get("INGEST_MAX_CONCURRENCY", "2")),
+)
 
+# Cloud calls are I/O bound, so they get their own (larger) limit instead of a pool slot.
+cloud_semaphore = asyncio.Semaphore(int(os.environ.get("ANALYSIS_CLOUD_CONCURRENCY", "16")))
+cloud_in_flight = 0
+
+_openai_client = None
+
+def get_openai_client():
+    """Shared AsyncOpenAI client so HTTP connections are reused across scans."""
+    global _openai_client
+    if _openai_client is None:
+        from openai import AsyncOpenAI
+        _openai_client = AsyncOpenAI(
+            api_key=os.environ.get('OPENAI_API_KEY'),
+            # The router enforces the overall deadline; keep SDK retries from stacking past it.
+            timeout=float(os.environ.get("ANALYSIS_CLOUD_TIMEOUT_SECONDS", "30")),
+            max_retries=int(os.environ.get("OPENAI_MAX_RETRIES", "1")),
+        )
+    return _openai_client
+
+# ================== Local Analyzers ==================
+
+XRAY_WEIGHTS = os.environ.get("XRAY_WEIGHTS", "densenet121-res224-all")
+
+class ModelRegistry:
+    """Loads each local model once per process and records how long it took.
+
+    Loaders return the model plus a dict of timings; an optional warmup
+    callable runs a dummy inference so the first real request doesn't pay for
+    lazy kernel initialisation.
+    """
+
+    def __init__(self):
+        self._loaders = {}
+        self._models = {}
+        self._locks = {}
+        self.timings = {}
+        self.errors = {}
+        self._loaded_elsewhere = set()
+
+    def register(self, name: str, loader, warmup=None):
+        self._loaders[name] = (loader, warmup)
+        self._locks[name] = threading.Lock()
+
+    def is_loaded(self, name: str) -> bool:
+        return name in self._models or name in self._loaded_elsewhere
+
+    def record(self, name: str, timings: Optional[dict] = None, error: Optional[str] = None):
+        """Record a load that ran in another process, e.g. an analysis pool worker."""
+        if error is not None:
+            self.errors[name] = error
+            return
+        self.timings[name] = timings or {}
+        self.errors.pop(name, None)
+        self._loaded_elsewhere.add(name)
+
+    def get(self, name: str):
+        model = self._models.get(name)
+        if model is not None:
+            return model
+        with self._locks[name]:
+            if name not in self._models:
+                loader, _ = self._loaders[name]
+                started = time.perf_counter()
+                try:
+                    model, timings = loader()
+                except Exception as e:
+                    self.errors[name] = str(e)
+                    raise
+                timings["total_load_seconds"] = time.perf_counter() - started
+                self.timings[name] = timings
+                self.errors.pop(name, None)
+                self._models[name] = model
+        return self._models[name]
+
+    def warm(self, name: str) -> dict:
+        """Load (if needed) and run the warmup inference; returns the timings."""
+        model = self.get(name)
+        _, warmup = self._loaders[name]
+        if warmup is not None and "warmup_seconds" not in self.timings[name]:
+            started = time.perf_counter()
+            warmup(model)
+            self.timings[name]["warmup_seconds"] = time.perf_counter() - started
+        return dict(self.timings[name])
+
+    def status(self) -> dict:
         return {
-            "doctor_view": {
-                "summary": "Local DenseNet chest X-ray model inference completed.",
-                "findings": findings,
-                "observations": [
-                    "Model: torchxrayvision DenseNet121 (res224, all pathologies)",
-                    f"Top likely patterns: {likely_text}",
-                ],
-                "recommendations": [
-                    "Validate with clinical context and radiologist review.",
-                    "Use confirmatory imaging/labs if clinically indicated."
-                ],
-                "confidence_level": "Medium",
-                "areas_of_concern": likely
-            },
-            "patient_view": {
-                "summary": "Your X-ray was analyzed by a local machine-learning model.",
-                "findings": [f"Most likely patterns found: {likely_text}."],
-                "what_it_means": "This is an AI screening result and not a final diagnosis.",
-                "next_steps": [
-                    "Share this report with your doctor/radiologist.",
-                    "Follow medical advice for confirmation tests."
-                ],
-                "reassurance": "Only your doctor can confirm diagnosis."
+            name: {
+                "loaded": self.is_loaded(name),
+                "timings": self.timings.get(name, {}),
+                "error": self.errors.get(name),
             }
+            for name in self._loaders
         }
 
-    def analyze_locally_with_pil(image_b64: str, scan_kind: str) -> dict:
-        """Lightweight local vision analysis that does not require external APIs."""
-        image_bytes = base64.b64decode(image_b64)
-        image = Image.open(io.BytesIO(image_bytes)).convert("L")
-        width, height = image.size
-        pixel_count = max(1, width * height)
-
-        stats = ImageStat.Stat(image)
-        mean_brightness = float(stats.mean[0])
-        std_dev = float(stats.stddev[0])
-
-        # Edge-density proxy for structural complexity.
-        edges = image.filter(ImageFilter.FIND_EDGES)
-        edge_pixels = sum(1 for px in edges.getdata() if px > 30)
-        edge_density = edge_pixels / pixel_count
-
-        findings = [
-            f"Analyzed locally using image-statistics pipeline ({scan_kind.replace('_', ' ').upper()}).",
-            f"Mean grayscale brightness: {mean_brightness:.1f}/255.",
-            f"Contrast estimate (std dev): {std_dev:.1f}.",
-            f"Edge-density estimate: {edge_density:.3f}.",
-        ]
+XRAY_INFERENCE_BACKEND = os.environ.get("XRAY_INFERENCE_BACKEND", "eager").lower()
+XRAY_INFERENCE_BACKENDS = ("eager", "torchscript", "compile", "int8", "onnx")
+XRAY_INTRA_OP_THREADS = int(os.environ.get("XRAY_INTRA_OP_THREADS", "0"))
 
-        quality_notes = []
-        if mean_brightness < 45:
-            quality_notes.append("Image appears underexposed (dark).")
-        elif mean_brightness > 210:
-            quality_notes.append("Image appears overexposed (bright).")
-        else:
-            quality_notes.append("Exposure appears within a usable range.")
+class XrayRunner:
+    """Backend-agnostic callable mapping a ``[B,224,224]`` batch to ``[B,P]`` probabilities."""
 
-        if std_dev < 25:
-            quality_notes.append("Low contrast may hide subtle findings.")
-        else:
-            quality_notes.append("Contrast appears moderate-to-good.")
+    def __init__(self, backend: str, forward, pathologies: list):
+        self.backend = backend
+        self.pathologies = pathologies
+        self._forward = forward
 
-        if edge_density < 0.05:
-            quality_notes.append("Low structural edge content; verify image sharpness.")
-        elif edge_density > 0.20:
-            quality_notes.append("High structural detail is present.")
+    def __call__(self, batch: np.ndarray) -> np.ndarray:
+        return self._forward(np.ascontiguousarray(batch[:, None, :, :], dtype=np.float32))  # [B,C,H,W]
 
-        confidence = "Low" if std_dev < 20 else ("Medium" if std_dev < 40 else "Medium")
+def _onnx_xray_forward(model):
+    import torch
+    import onnxruntime as ort
 
+    path = Path(os.environ.get("XRAY_ONNX_PATH", str(ROOT_DIR / "models" / f"{XRAY_WEIGHTS}.onnx")))
+    if not path.exists():
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with torch.no_grad():
+            torch.onnx.export(
+                model, torch.zeros((1, 1, 224, 224)), str(path),
+                input_names=["image"], output_names=["logits"],
+                dynamic_axes={"image": {0: "batch"}, "logits": {0: "batch"}},
+                opset_version=17,
+            )
+    options = ort.SessionOptions()
+    if XRAY_INTRA_OP_THREADS > 0:
+        options.intra_op_num_threads = XRAY_INTRA_OP_THREADS
+    session = ort.InferenceSession(str(path), options, providers=["CPUExecutionProvider"])
+
+    def forward(batch: np.ndarray) -> np.ndarray:
+        logits = session.run(None, {"image": batch})[0]
+        return 1.0 / (1.0 + np.exp(-logits))
+
+    return forward
+
+def build_xray_runner(model, backend: str) -> XrayRunner:
+    """Wrap an eager DenseNet in the requested CPU inference backend.
+
+    ``int8`` applies dynamic quantization, which in PyTorch only covers
+    ``nn.Linear`` layers (the DenseNet classifier head); convolutions stay float32.
+    """
+    import torch
+
+    if backend == "onnx":
+        return XrayRunner(backend, _onnx_xray_forward(model), list(model.pathologies))
+
+    if backend == "eager":
+        module = model
+    elif backend == "torchscript":
+        with torch.no_grad():
+            traced = torch.jit.trace(model, torch.zeros((1, 1, 224, 224)))
+        module = torch.jit.optimize_for_inference(torch.jit.freeze(traced.eval()))
+    elif backend == "compile":
+        module = torch.compile(model)
+    elif backend == "int8":
+        module = torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+    else:
+        raise ValueError(f"Unknown X-ray inference backend {backend!r}; choose from {', '.join(XRAY_INFERENCE_BACKENDS)}")
+
+    def forward(batch: np.ndarray) -> np.ndarray:
+        with torch.inference_mode():
+            return torch.sigmoid(module(torch.from_numpy(batch))).cpu().numpy()
+
+    return XrayRunner(backend, forward, list(model.pathologies))
+
+def load_xray_base_model(timings: dict):
+    started = time.perf_counter()
+    import torch
+    timings["import_torch_seconds"] = time.perf_counter() - started
+
+    started = time.perf_counter()
+    import torchxrayvision as xrv
+    import skimage.transform  # noqa: F401 - used by prepare_xray_input
+    timings["import_xrv_seconds"] = time.perf_counter() - started
+
+    if XRAY_INTRA_OP_THREADS > 0:
+        torch.set_num_threads(XRAY_INTRA_OP_THREADS)
+
+    started = time.perf_counter()
+    model = xrv.models.DenseNet(weights=XRAY_WEIGHTS)
+    model.eval()
+    timings["weights_seconds"] = time.perf_counter() - started
+    timings["weights_fingerprint"] = weights_fingerprint(model)
+    return model
+
+def weights_fingerprint(model) -> str:
+    """Short hash of a model's parameters, so a replaced weights file gets new cache keys."""
+    digest = hashlib.blake2b(digest_size=8)
+    for name, tensor in model.state_dict().items():
+        digest.update(name.encode())
+        digest.update(tensor.detach().cpu().numpy().tobytes())
+    return digest.hexdigest()
+
+def load_xray_model():
+    timings = {}
+    model = load_xray_base_model(timings)
+    started = time.perf_counter()
+    runner = build_xray_runner(model, XRAY_INFERENCE_BACKEND)
+    timings["backend"] = XRAY_INFERENCE_BACKEND
+    timings["backend_build_seconds"] = time.perf_counter() - started
+    return runner, timings
+
+def warm_xray_model(runner):
+    runner(np.zeros((1, 224, 224), dtype=np.float32))
+
+model_registry = ModelRegistry()
+model_registry.register("xray", load_xray_model, warmup=warm_xray_model)
+
+# eager: load and warm during startup; background: same, without delaying
+# startup (readiness reports false until done); lazy: load on first use.
+MODEL_LOAD_MODE = os.environ.get("MODEL_LOAD_MODE", "eager").lower()
+
+def get_local_xray_model():
+    return model_registry.get("xray")
+
+def preload_models_for_fork():
+    """Load local models in a pre-fork master (see gunicorn.conf.py).
+
+    Forked workers inherit the loaded runner and share its weights
+    copy-on-write instead of each loading a DenseNet. The master stays
+    single-threaded while loading so no OpenMP pool exists at fork time, and
+    the heap is frozen so the garbage collector doesn't dirty shared pages.
+    Warmup runs per worker. ONNX sessions own thread pools that don't survive
+    a fork, so that backend still loads in each worker.
+    """
+    global XRAY_INTRA_OP_THREADS
+    if _env_flag("USE_LOCAL_ML", "true") and XRAY_INFERENCE_BACKEND != "onnx":
+        worker_threads = XRAY_INTRA_OP_THREADS
+        XRAY_INTRA_OP_THREADS = 1
+        try:
+            model_registry.get("xray")
+            model_registry.timings["xray"]["loaded_before_fork"] = True
+            logger.info("Local X-ray model loaded in the master; workers will share it")
+        except Exception as e:
+            logger.warning(f"Pre-fork X-ray model load failed, workers will load their own: {e}")
+        finally:
+            XRAY_INTRA_OP_THREADS = worker_threads
+    gc.freeze()
+
+def configure_worker_process():
+    """Post-fork setup: give this worker its share of CPU threads."""
+    torch = sys.modules.get("torch")
+    if torch is not None and XRAY_INTRA_OP_THREADS > 0:
+        torch.set_num_threads(XRAY_INTRA_OP_THREADS)
+
+def warm_model(name: str) -> dict:
+    """Module-level so a process pool can pickle it; warms that process's registry."""
+    return model_registry.warm(name)
+
+async def warm_local_models():
+    if not _env_flag("USE_LOCAL_ML", "true"):
+        return
+    try:
+        timings = await analysis_executor.run(warm_model, "xray")
+        if analysis_executor.kind == "process":
+            # Inference runs in the pool's workers; other workers load on first use.
+            timings["process"] = "analysis_pool"
+            model_registry.record("xray", timings)
+        logger.info(f"Local X-ray model ready: {timings}")
+    except Exception as e:
+        model_registry.record("xray", error=str(e) or type(e).__name__)
+        logger.warning(f"Local X-ray model warmup failed, ML path will fall back: {e}")
+
+def prepare_xray_input(image_bytes: bytes):
+    """Decode and resize an X-ray to the model's 224x224 grayscale input."""
+    return resize_xray_input(decode_grayscale(image_bytes))
+
+def resize_xray_input(gray: np.ndarray) -> np.ndarray:
+    from skimage.transform import resize
+
+    img = gray.astype(np.float32) / 255.0
+    return resize(img, (224, 224), anti_aliasing=True, preserve_range=True).astype(np.float32)
+
+def run_xray_batch(images: list):
+    """One DenseNet forward pass over a batch of prepared inputs."""
+    runner = get_local_xray_model()
+    inference_batch_size.observe(len(images), "xray")
+    with inference_seconds.time("xray", runner.backend):
+        return runner(np.stack(images)), runner.pathologies
+
+class XrayBatcher:
+    """Coalesces concurrent X-ray inferences into batched forward passes.
+
+    Requests wait at most ``max_wait_ms`` for company; a batch is flushed as
+    soon as ``max_batch`` inputs are queued. Batches run concurrently, up to
+    the analysis executor's capacity; while every lane is busy, new requests
+    keep queueing and go out together in the next batch.
+    """
+
+    def __init__(self, max_batch: int, max_wait_ms: float):
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000.0
+        self._queue = None
+        self._task = None
+        self._running = set()
+        self.batches = 0
+        self.items = 0
+
+    async def infer(self, image):
+        loop = asyncio.get_running_loop()
+        if self._task is None or self._task.done():
+            self._queue = asyncio.Queue()
+            self._task = asyncio.create_task(self._run())
+        future = loop.create_future()
+        self._queue.put_nowait((image, future))
+        return await future
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        try:
+            while True:
+                capacity = max(1, min(analysis_executor.max_workers, analysis_executor.max_concurrency))
+                while len(self._running) >= capacity:
+                    await asyncio.wait(self._running, return_when=asyncio.FIRST_COMPLETED)
+
+                batch = [await self._queue.get()]
+                deadline = loop.time() + self.max_wait
+                while len(batch) < self.max_batch:
+                    if not self._queue.empty():
+                        batch.append(self._queue.get_nowait())
+                        continue
+                    remaining = deadline - loop.time()
+                    if remaining <= 0:
+                        break
+                    try:
+                        batch.append(await asyncio.wait_for(self._queue.get(), remaining))
+                    except asyncio.TimeoutError:
+                        break
+
+                batch = [(image, future) for image, future in batch if not future.cancelled()]
+                if batch:
+                    task = asyncio.create_task(self._infer_batch(batch))
+                    self._running.add(task)
+                    task.add_done_callback(self._running.discard)
+        finally:
+            for task in self._running:
+                task.cancel()
+
+    async def _infer_batch(self, batch: list):
+        try:
+            probs, pathologies = await analysis_executor.run(run_xray_batch, [image for image, _ in batch])
+        except asyncio.CancelledError:
+            for _, future in batch:
+                future.cancel()
+            raise
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        self.batches += 1
+        self.items += len(batch)
+        for i, (_, future) in enumerate(batch):
+            if not future.done():
+                future.set_result((probs[i], pathologies))
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, *self._running, return_exceptions=True)
+            self._task = None
+
+    def stats(self) -> dict:
         return {
-            "doctor_view": {
-                "summary": "Local on-device image quality and structure analysis completed.",
-                "findings": findings,
-                "observations": quality_notes,
-                "recommendations": [
-                    "Treat this as preliminary technical screening, not diagnosis.",
-                    "Correlate with clinical history and radiologist interpretation.",
-                    "If quality is poor, reacquire scan at higher clarity."
-                ],
-                "confidence_level": confidence,
-                "areas_of_concern": []
-            },
-            "patient_view": {
-                "summary": "Your image was analyzed locally on this system.",
-                "findings": [
-                    "The system checked image clarity, brightness, and structure.",
-                    "This helps detect whether the scan quality is suitable for review."
-                ],
-                "what_it_means": "This result is a technical pre-screen and does not replace a doctor’s diagnosis.",
-                "next_steps": [
-                    "Share the report with a doctor/radiologist.",
-                    "If advised, upload a clearer image for better review."
-                ],
-                "reassurance": "You now have a real local analysis result instead of a placeholder response."
-            }
+            "max_batch": self.max_batch,
+            "max_wait_ms": self.max_wait * 1000.0,
+            "pending": self._queue.qsize() if self._queue else 0,
+            "running_batches": len(self._running),
+            "batches": self.batches,
+            "items": self.items,
+            "avg_batch_size": round(self.items / self.batches, 2) if self.batches else 0.0,
         }
 
-    try:
-        if os.environ.get("MOCK_AI", "").lower() in ("1", "true", "yes"):
-            try:
-                if os.environ.get("USE_LOCAL_ML", "true").lower() in ("1", "true", "yes"):
-                    return analyze_locally_with_ml(image_base64, scan_type)
-            except Exception as ml_err:
-                logger.warning(f"Local ML unavailable, falling back to basic analysis: {ml_err}")
-            return analyze_locally_with_pil(image_base64, scan_type)
+xray_batcher = XrayBatcher(
+    max_batch=int(os.environ.get("XRAY_BATCH_SIZE", "8")),
+    max_wait_ms=float(os.environ.get("XRAY_BATCH_WAIT_MS", "10")),
+)
+
+def build_xray_report(probs, pathologies: list, backend: str = XRAY_INFERENCE_BACKEND) -> dict:
+    top_idx = np.argsort(probs)[::-1][:5]
+    top_items = [(pathologies[i], float(probs[i])) for i in top_idx if probs[i] >= 0.20]
 
-        from openai import OpenAI
-        import json
-        import re
+    if not top_items:
+        top_items = [("No high-probability abnormality detected by local model", 0.0)]
 
-        api_key = os.environ.get('OPENAI_API_KEY')
-        if not api_key:
+    findings = [f"{name}: probability {prob:.2f}" for name, prob in top_items]
+    likely = [name for name, prob in top_items if prob >= 0.35 and "No high-probability" not in name]
+    likely_text = ", ".join(likely) if likely else "No strong abnormality signal"
+
+    return {
+        "doctor_view": {
+            "summary": "Local DenseNet chest X-ray model inference completed.",
+            "findings": findings,
+            "observations": [
+                f"Model: torchxrayvision DenseNet121 (res224, all pathologies, {backend} backend)",
+                f"Top likely patterns: {likely_text}",
+            ],
+            "recommendations": [
+                "Validate with clinical context and radiologist review.",
+                "Use confirmatory imaging/labs if clinically indicated."
+            ],
+            "confidence_level": "Medium",
+            "areas_of_concern": likely
+        },
+        "patient_view": {
+            "summary": "Your X-ray was analyzed by a local machine-learning model.",
+            "findings": [f"Most likely patterns found: {likely_text}."],
+            "what_it_means": "This is an AI screening result and not a final diagnosis.",
+            "next_steps": [
+                "Share this report with your doctor/radiologist.",
+                "Follow medical advice for confirmation tests."
+            ],
+            "reassurance": "Only your doctor can confirm diagnosis."
+        }
+    }
+
+def xray_analysis(probs, pathologies: list) -> dict:
+    analysis = build_xray_report(probs, pathologies)
+    analysis["report"] = {
+        "template": "xray:v1",
+        "params": {"probs": [float(p) for p in probs], "pathologies": list(pathologies), "backend": XRAY_INFERENCE_BACKEND},
+    }
+    return analysis
+
+async def analyze_locally_with_ml(pipeline: "AnalysisPipeline", scan_kind: str) -> dict:
+    """
+    Local ML inference for chest X-ray using torchxrayvision DenseNet.
+    Requires: torch, numpy, scikit-image, torchxrayvision (plus onnxruntime for the onnx backend)
+    """
+    if scan_kind.lower() != "xray":
+        raise RuntimeError("Local ML model currently supports xray only.")
+
+    return xray_analysis(*await pipeline.get("xray_inference"))
+
+def decode_image(image_bytes: bytes) -> Image.Image:
+    image = Image.open(io.BytesIO(image_bytes))
+    image.load()
+    return image
+
+def to_grayscale(image: Image.Image) -> np.ndarray:
+    return np.asarray(image.convert("L"))
+
+def decode_grayscale(image_bytes: bytes) -> np.ndarray:
+    """Decode image bytes once into a 2-D uint8 grayscale array."""
+    return to_grayscale(decode_image(image_bytes))
+
+def compute_quality_metrics(gray: np.ndarray) -> dict:
+    """Brightness, contrast, edge density, histogram and sharpness in a few vectorized passes.
+
+    Edge density reproduces PIL's ``FIND_EDGES`` + ``> 30`` count exactly: the
+    3x3 kernel on interior pixels, border pixels copied from the source.
+    """
+    height, width = gray.shape
+    pixel_count = max(1, width * height)
+
+    histogram = np.bincount(gray.ravel(), minlength=256)
+    levels = np.arange(256, dtype=np.float64)
+    mean_brightness = float(histogram @ levels) / pixel_count
+    variance = float(histogram @ (levels * levels)) / pixel_count - mean_brightness ** 2
+    std_dev = float(np.sqrt(max(variance, 0.0)))
+
+    if height < 3 or width < 3:
+        edge_pixels = int(np.count_nonzero(gray > 30))
+        sharpness = 0.0
+    else:
+        g = gray.astype(np.int16)
+        center = g[1:-1, 1:-1]
+        up, down, left, right = g[:-2, 1:-1], g[2:, 1:-1], g[1:-1, :-2], g[1:-1, 2:]
+        cross = up + down + left + right
+        diagonals = g[:-2, :-2] + g[:-2, 2:] + g[2:, :-2] + g[2:, 2:]
+        edges = 8 * center - cross - diagonals
+        border = np.concatenate((gray[0], gray[-1], gray[1:-1, 0], gray[1:-1, -1]))
+        edge_pixels = int(np.count_nonzero(edges > 30)) + int(np.count_nonzero(border > 30))
+        # Variance of the 4-neighbour Laplacian.
+        sharpness = float((cross - 4 * center).var(dtype=np.float64))
+
+    return {
+        "width": width,
+        "height": height,
+        "mean_brightness": mean_brightness,
+        "std_dev": std_dev,
+        "edge_density": edge_pixels / pixel_count,
+        "sharpness": sharpness,
+        "histogram": histogram.tolist(),
+    }
+
+def timed_quality_metrics(gray: np.ndarray) -> dict:
+    with inference_seconds.time("quality", "numpy"):
+        return compute_quality_metrics(gray)
+
+def analyze_locally_with_pil(image_bytes: bytes, scan_kind: str) -> dict:
+    """Lightweight local vision analysis that does not require external APIs."""
+    return quality_analysis(timed_quality_metrics(decode_grayscale(image_bytes)), scan_kind)
+
+def quality_analysis(metrics: dict, scan_kind: str) -> dict:
+    analysis = build_quality_report(metrics, scan_kind)
+    params = {key: float(metrics[key]) for key in ("mean_brightness", "std_dev", "edge_density", "sharpness")}
+    analysis["report"] = {"template": "quality:v1", "params": {"metrics": params, "scan_kind": scan_kind}}
+    return analysis
+
+def build_quality_report(metrics: dict, scan_kind: str) -> dict:
+    mean_brightness = metrics["mean_brightness"]
+    std_dev = metrics["std_dev"]
+    edge_density = metrics["edge_density"]
+
+    findings = [
+        f"Analyzed locally using image-statistics pipeline ({scan_kind.replace('_', ' ').upper()}).",
+        f"Mean grayscale brightness: {mean_brightness:.1f}/255.",
+        f"Contrast estimate (std dev): {std_dev:.1f}.",
+        f"Edge-density estimate: {edge_density:.3f}.",
+        f"Sharpness estimate (Laplacian variance): {metrics['sharpness']:.1f}.",
+    ]
+
+    quality_notes = []
+    if mean_brightness < 45:
+        quality_notes.append("Image appears underexposed (dark).")
+    elif mean_brightness > 210:
+        quality_notes.append("Image appears overexposed (bright).")
+    else:
+        quality_notes.append("Exposure appears within a usable range.")
+
+    if std_dev < 25:
+        quality_notes.append("Low contrast may hide subtle findings.")
+    else:
+        quality_notes.append("Contrast appears moderate-to-good.")
+
+    if edge_density < 0.05:
+        quality_notes.append("Low structural edge content; verify image sharpness.")
+    elif edge_density > 0.20:
+        quality_notes.append("High structural detail is present.")
+
+    confidence = "Low" if std_dev < 20 else ("Medium" if std_dev < 40 else "Medium")
+
+    return {
+        "doctor_view": {
+            "summary": "Local on-device image quality and structure analysis completed.",
+            "findings": findings,
+            "observations": quality_notes,
+            "recommendations": [
+                "Treat this as preliminary technical screening, not diagnosis.",
+                "Correlate with clinical history and radiologist interpretation.",
+                "If quality is poor, reacquire scan at higher clarity."
+            ],
+            "confidence_level": confidence,
+            "areas_of_concern": []
+        },
+        "patient_view": {
+            "summary": "Your image was analyzed locally on this system.",
+            "findings": [
+                "The system checked image clarity, brightness, and structure.",
+                "This helps detect whether the scan quality is suitable for review."
+            ],
+            "what_it_means": "This result is a technical pre-screen and does not replace a doctor’s diagnosis.",
+            "next_steps": [
+                "Share the report with a doctor/radiologist.",
+                "If advised, upload a clearer image for better review."
+            ],
+            "reassurance": "You now have a real local analysis result instead of a placeholder response."
+        }
+    }
+
+# ================== Analysis Pipeline ==================
+
+# Starts the quality metrics alongside X-ray inference so a failed model
+# falls back without waiting for them; costs the metrics on every X-ray.
+LOCAL_PREFETCH_QUALITY = _env_flag("LOCAL_PREFETCH_QUALITY")
+
+async def _xray_inference(xray_input: np.ndarray) -> tuple:
+    return await xray_batcher.infer(xray_input)
+
+class AnalysisPipeline:
+    """Lazily computed, shared intermediates of one local analysis.
+
+    ``await pipeline.get(stage)`` runs the stage and the stages it depends on,
+    each at most once per image, so the X-ray model and the quality fallback
+    decode and convert the image once between them. CPU stages run in
+    ``analysis_executor``; stages requested together run concurrently.
+    ``timings`` holds each finished stage's own seconds (dependencies
+    excluded, executor queueing included).
+    """
+
+    # stage -> (dependencies, function, runs on the event loop)
+    STAGES = {
+        "decode": (("image_bytes",), decode_image, False),
+        "grayscale": (("decode",), to_grayscale, False),
+        "xray_input": (("grayscale",), resize_xray_input, False),
+        "quality_metrics": (("grayscale",), timed_quality_metrics, False),
+        "xray_inference": (("xray_input",), _xray_inference, True),
+    }
+
+    def __init__(self, image_bytes: bytes):
+        self.image_bytes = image_bytes
+        self.timings = {}
+        self._tasks = {}
+
+    def get(self, stage: str) -> asyncio.Future:
+        if stage == "image_bytes":
+            future = asyncio.get_running_loop().create_future()
+            future.set_result(self.image_bytes)
+            return future
+        task = self._tasks.get(stage)
+        if task is None:
+            task = self._tasks[stage] = asyncio.ensure_future(self._run(stage))
+        return task
+
+    def prefetch(self, *stages: str):
+        for stage in stages:
+            self.get(stage)
+
+    async def _run(self, stage: str):
+        dependencies, fn, on_loop = self.STAGES[stage]
+        inputs = await asyncio.gather(*(self.get(dependency) for dependency in dependencies))
+        started = time.perf_counter()
+        result = await fn(*inputs) if on_loop else await analysis_executor.run(fn, *inputs)
+        elapsed = time.perf_counter() - started
+        self.timings[stage] = elapsed
+        if METRICS_ENABLED:
+            stage_seconds.observe(elapsed, f"analysis_{stage}")
+        return result
+
+    def close(self):
+        """Cancel stages nobody waited for (e.g. a prefetch the model made unnecessary)."""
+        for task in self._tasks.values():
+            if not task.done():
+                task.cancel()
+            elif not task.cancelled():
+                task.exception()  # retrieved, so an unused failure isn't logged as unhandled
+
+LOCAL_PIL_MODEL_ID = "local-pil:v2"
+
+# Model id of the local X-ray model before its weights have been loaded
+# (and fingerprinted) in this process; results under it are never cached.
+UNVERIFIED_WEIGHTS = "unverified"
+
+def xray_weights_fingerprint() -> str:
+    return model_registry.timings.get("xray", {}).get("weights_fingerprint", UNVERIFIED_WEIGHTS)
+
+def local_ml_model_id() -> str:
+    return f"local-ml:{XRAY_WEIGHTS}@{xray_weights_fingerprint()}:{XRAY_INFERENCE_BACKEND}"
+
+def cloud_model_id() -> str:
+    return f"openai:{os.environ.get('OPENAI_VISION_MODEL', 'gpt-4.1-mini')}"
+
+def analysis_model_id(scan_type: str) -> str:
+    """Identity of the analyzer expected to serve a scan (part of the cache key)."""
+    if cloud_enabled():
+        return cloud_model_id()
+    if _env_flag("USE_LOCAL_ML", "true") and scan_type.lower() == "xray":
+        return local_ml_model_id()
+    return LOCAL_PIL_MODEL_ID
+
+async def analyze_locally(image_bytes: bytes, scan_kind: str, pipeline: Optional["AnalysisPipeline"] = None) -> tuple:
+    """Local ML with quality-report fallback, both reading one ``AnalysisPipeline``."""
+    pipeline = pipeline or AnalysisPipeline(image_bytes)
+    try:
+        if _env_flag("USE_LOCAL_ML", "true") and scan_kind.lower() == "xray":
+            if LOCAL_PREFETCH_QUALITY:
+                pipeline.prefetch("quality_metrics")
             try:
-                if os.environ.get("USE_LOCAL_ML", "true").lower() in ("1", "true", "yes"):
-                    return analyze_locally_with_ml(image_base64, scan_type)
+                return await analyze_locally_with_ml(pipeline, scan_kind), local_ml_model_id()
             except Exception as ml_err:
                 logger.warning(f"Local ML unavailable, falling back to basic analysis: {ml_err}")
-            return analyze_locally_with_pil(image_base64, scan_type)
+        return quality_analysis(await pipeline.get("quality_metrics"), scan_kind), LOCAL_PIL_MODEL_ID
+    finally:
+        pipeline.close()
 
-        system_message = """You are an advanced medical imaging AI assistant. Analyze the provided medical image and provide a comprehensive diagnostic report.
+async def analyze_with_gemini(image_bytes: bytes, scan_type: str, image_sha256: Optional[str] = None) -> dict:
+    """Analyze medical image using OpenAI vision models with local fallback."""
+    analysis, _ = await analyze_scan(image_bytes, scan_type, image_sha256)
+    return analysis
+
+async def analyze_scan(image_bytes: bytes, scan_type: str, image_sha256: Optional[str] = None) -> tuple:
+    """Return ``(analysis, served_by)``; ``served_by`` names the tier and model.
+
+    When ``image_sha256`` is given the result is served from / stored in the
+    analysis cache.
+    """
+    started = time.perf_counter()
+    if image_sha256 and analysis_cache.enabled:
+        analysis, served_by = await analysis_cache.get_or_compute(image_sha256, scan_type, image_bytes)
+    else:
+        analysis, model_id, tier = await provider_router.route(image_bytes, scan_type)
+        served_by = {"tier": tier, "model_id": model_id}
+    if METRICS_ENABLED:
+        analysis_seconds.observe(time.perf_counter() - started, served_by["tier"])
+    return analysis, served_by
+
+def cloud_enabled() -> bool:
+    return not _env_flag("MOCK_AI") and bool(os.environ.get('OPENAI_API_KEY'))
+
+async def analyze_with_cloud(image_bytes: bytes, scan_type: str) -> dict:
+    """One OpenAI vision call; raises on any provider error."""
+    global cloud_in_flight
+    system_message = """You are an advanced medical imaging AI assistant. Analyze the provided medical image and provide a comprehensive diagnostic report.
 
 IMPORTANT: You are providing educational analysis only. This is NOT a medical diagnosis and should not replace professional medical advice.
 
@@ -322,61 +1780,1313 @@ Provide your analysis in the following JSON format:
     }
 }"""
 
-        prompt = (
-            f"{system_message}\n\n"
-            f"Please analyze this {scan_type.replace('_', ' ').upper()} medical image "
-            "and provide the report strictly in the JSON format above."
+    prompt = (
+        f"{system_message}\n\n"
+        f"Please analyze this {scan_type.replace('_', ' ').upper()} medical image "
+        "and provide the report strictly in the JSON format above."
+    )
+
+    model_name = os.environ.get("OPENAI_VISION_MODEL", "gpt-4.1-mini")
+    image_base64 = base64.b64encode(image_bytes).decode('utf-8')
+    async with cloud_semaphore:
+        cloud_in_flight += 1
+        try:
+            response = await get_openai_client().responses.create(
+                model=model_name,
+                input=[
+                    {
+                        "role": "user",
+                        "content": [
+                            {"type": "input_text", "text": prompt},
+                            {
+                                "type": "input_image",
+                                "image_url": f"data:image/jpeg;base64,{image_base64}",
+                            },
+                        ],
+                    }
+                ],
+            )
+        finally:
+            cloud_in_flight -= 1
+    response_text = response.output_text or ""
+
+    json_match = re.search(r'\{[\s\S]*\}', response_text)
+    if json_match:
+        return json.loads(json_match.group())
+
+    return {
+        "doctor_view": {
+            "summary": response_text[:500] if len(response_text) > 500 else response_text,
+            "findings": ["Analysis completed"],
+            "observations": ["Image processed successfully"],
+            "recommendations": ["Consult with a medical professional for detailed interpretation"],
+            "confidence_level": "Medium",
+            "areas_of_concern": []
+        },
+        "patient_view": {
+            "summary": "Your scan has been analyzed.",
+            "findings": ["The AI has reviewed your image"],
+            "what_it_means": "Please consult with your doctor for a detailed explanation.",
+            "next_steps": ["Schedule a follow-up with your healthcare provider"],
+            "reassurance": "Remember, this is an AI-assisted analysis. Your doctor will provide the final interpretation."
+        }
+    }
+
+# ================== Provider Routing ==================
+
+class CircuitBreaker:
+    """Consecutive-failure circuit breaker for the cloud provider.
+
+    After ``failure_threshold`` failures in a row the circuit opens and scans
+    go straight to the local analyzers for ``reset_seconds``. Then a single
+    trial call is let through (half-open); its outcome closes or re-opens
+    the circuit.
+    """
+
+    def __init__(self, failure_threshold: int, reset_seconds: float, clock=time.monotonic):
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.clock = clock
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self.opens = 0
+        self._trial_in_flight = False
+
+    def allow(self) -> bool:
+        if self.state == "closed":
+            return True
+        if self.state == "open":
+            if self.clock() - self.opened_at < self.reset_seconds:
+                return False
+            self.state = "half_open"
+            self._trial_in_flight = False
+        if self._trial_in_flight:
+            return False
+        self._trial_in_flight = True
+        return True
+
+    def record_success(self):
+        self.state = "closed"
+        self.failures = 0
+        self._trial_in_flight = False
+
+    def record_failure(self):
+        self.failures += 1
+        self._trial_in_flight = False
+        if self.state == "half_open" or self.failures >= self.failure_threshold:
+            if self.state != "open":
+                self.opens += 1
+                logger.warning(f"Cloud circuit opened after {self.failures} consecutive failures")
+            self.state = "open"
+            self.opened_at = self.clock()
+
+    def release(self):
+        """A call ended without an outcome (cancelled); let another trial through."""
+        self._trial_in_flight = False
+
+    def stats(self) -> dict:
+        return {
+            "state": self.state,
+            "consecutive_failures": self.failures,
+            "opens": self.opens,
+        }
+
+class ProviderRouter:
+    """Routes each analysis to the cloud model or the local tiers.
+
+    Cloud calls get a hard ``timeout``. While the circuit breaker is open,
+    scans skip the cloud entirely. With ``hedge_after`` > 0, a local analysis
+    starts when the cloud call is slower than that budget and whichever
+    finishes first (cloud preferred on a tie) serves the scan. The losing
+    cloud call keeps running to its deadline so the breaker still learns
+    whether the provider is healthy.
+    """
+
+    TIERS = ("cloud", "local", "local_hedge", "local_fallback", "local_circuit_open")
+
+    def __init__(self, timeout: float, hedge_after: float, breaker: CircuitBreaker):
+        self.timeout = timeout
+        self.hedge_after = hedge_after
+        self.breaker = breaker
+        self.served = {tier: 0 for tier in self.TIERS}
+        self.hedged = 0
+        self.timeouts = 0
+        self.errors = 0
+
+    async def route(self, image_bytes: bytes, scan_type: str) -> tuple:
+        """Return ``(analysis, model_id, tier)``."""
+        if not cloud_enabled():
+            return self._served(*await analyze_locally(image_bytes, scan_type), "local")
+        if not self.breaker.allow():
+            return self._served(*await analyze_locally(image_bytes, scan_type), "local_circuit_open")
+
+        cloud = asyncio.ensure_future(self._call_cloud(image_bytes, scan_type))
+        # The cloud task may outlive this call (lost hedge); don't warn about its exception.
+        cloud.add_done_callback(lambda task: task.cancelled() or task.exception())
+        hedge = None
+        try:
+            if self.hedge_after > 0:
+                done, _ = await asyncio.wait({cloud}, timeout=self.hedge_after)
+                if not done:
+                    self.hedged += 1
+                    hedge = asyncio.ensure_future(analyze_locally(image_bytes, scan_type))
+                    await asyncio.wait({cloud, hedge}, return_when=asyncio.FIRST_COMPLETED)
+                    if not cloud.done() and hedge.exception() is None:
+                        return self._served(*hedge.result(), "local_hedge")
+            analysis = await cloud
+            if hedge is not None:
+                hedge.cancel()
+            return self._served(analysis, cloud_model_id(), "cloud")
+        except asyncio.CancelledError:
+            cloud.cancel()
+            if hedge is not None:
+                hedge.cancel()
+            raise
+        except Exception as e:
+            logger.error(f"Cloud AI analysis error, switching to local fallback: {e!r}")
+            if hedge is not None and (not hedge.done() or (not hedge.cancelled() and hedge.exception() is None)):
+                fallback = hedge
+            else:
+                # No hedge, or it already failed: its exception must not become the scan's.
+                fallback = analyze_locally(image_bytes, scan_type)
+            return self._served(*await fallback, "local_fallback")
+
+    async def _call_cloud(self, image_bytes: bytes, scan_type: str) -> dict:
+        try:
+            analysis = await asyncio.wait_for(analyze_with_cloud(image_bytes, scan_type), self.timeout)
+        except asyncio.CancelledError:
+            self.breaker.release()
+            raise
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            self.breaker.record_failure()
+            raise TimeoutError(f"cloud analysis exceeded {self.timeout}s deadline")
+        except Exception:
+            self.errors += 1
+            self.breaker.record_failure()
+            raise
+        self.breaker.record_success()
+        return analysis
+
+    def _served(self, analysis: dict, model_id: str, tier: str) -> tuple:
+        self.served[tier] += 1
+        return analysis, model_id, tier
+
+    def stats(self) -> dict:
+        return {
+            "timeout_seconds": self.timeout,
+            "hedge_after_seconds": self.hedge_after,
+            "served": dict(self.served),
+            "hedged": self.hedged,
+            "timeouts": self.timeouts,
+            "errors": self.errors,
+            "circuit": self.breaker.stats(),
+        }
+
+provider_router = ProviderRouter(
+    timeout=float(os.environ.get("ANALYSIS_CLOUD_TIMEOUT_SECONDS", "30")),
+    hedge_after=float(os.environ.get("ANALYSIS_HEDGE_AFTER_SECONDS", "0")),
+    breaker=CircuitBreaker(
+        failure_threshold=int(os.environ.get("ANALYSIS_CIRCUIT_FAILURES", "5")),
+        reset_seconds=float(os.environ.get("ANALYSIS_CIRCUIT_RESET_SECONDS", "30")),
+    ),
+)
+
+# ================== Report Storage ==================
+
+# Local reports are stored as a template id plus the numbers they were
+# rendered from; the boilerplate text is re-rendered on read. Changing a
+# template's wording changes every stored report that uses it, so bump the
+# id (and keep the old renderer) when old reports must keep their text.
+REPORT_TEMPLATES = {
+    "quality:v1": lambda params: build_quality_report(params["metrics"], params["scan_kind"]),
+    "xray:v1": lambda params: build_xray_report(np.asarray(params["probs"]), params["pathologies"], params["backend"]),
+}
+# Free-text reports are deflated with the standard-library zlib. gzip would be
+# the same deflate stream behind a larger header, and zstd's better ratio is
+# small on payloads of a few KB while adding a dependency. Stored reports
+# record their ``encoding``, so another codec can be added without rewriting
+# old scans.
+REPORT_COMPRESSION_LEVEL = int(os.environ.get("REPORT_COMPRESSION_LEVEL", "6"))
+
+def compact_report(analysis: dict) -> dict:
+    """Storage form of an analysis: template reference, or a zlib-compressed JSON blob."""
+    template = analysis.get("report")
+    if template and template.get("template") in REPORT_TEMPLATES:
+        return {"template": template["template"], "params": template["params"]}
+    views = {"doctor_view": analysis.get("doctor_view"), "patient_view": analysis.get("patient_view")}
+    return {"encoding": "zlib", "data": zlib.compress(orjson.dumps(views), REPORT_COMPRESSION_LEVEL)}
+
+def expand_report(report: dict) -> dict:
+    """``{"doctor_view", "patient_view"}`` from a stored compact report."""
+    if "template" in report:
+        rendered = REPORT_TEMPLATES[report["template"]](report["params"])
+    else:
+        rendered = orjson.loads(zlib.decompress(report["data"]))
+    return {"doctor_view": rendered.get("doctor_view"), "patient_view": rendered.get("patient_view")}
+
+def expand_scan(scan: dict) -> dict:
+    """Replace a scan's stored ``report`` with the views the API returns (legacy scans pass through)."""
+    report = scan.pop("report", None)
+    if report:
+        try:
+            scan.update(expand_report(report))
+        except Exception as e:
+            logger.error(f"Could not expand report for scan {scan.get('id')}: {e}")
+    return scan
+
+# ================== Analysis Cache ==================
+
+# Bump when analyzer output changes in a way that should invalidate stored results.
+ANALYSIS_CACHE_VERSION = "1"
+
+class AnalysisResultCache:
+    """Content-addressed cache of analysis results.
+
+    Keys combine the processed image hash, scan type and the identity of the
+    analyzer (cloud model name, or local weights name and fingerprint), so
+    changing ``OPENAI_VISION_MODEL`` or the local weights naturally misses old
+    entries.
+    An in-memory LRU sits in front of the ``analysis_cache`` collection, and
+    concurrent identical requests share one in-flight analysis.
+    """
+
+    def __init__(self, enabled: bool, ttl_seconds: float, max_entries: int, max_bytes: int):
+        self.enabled = enabled
+        self.ttl_seconds = ttl_seconds
+        self.memory = TTLCache(max_entries, ttl_seconds, max_bytes)
+        self._inflight = {}
+        self.memory_hits = 0
+        self.mongo_hits = 0
+        self.misses = 0
+        self.shared = 0
+
+    @staticmethod
+    def key(image_sha256: str, scan_type: str, model_id: str) -> str:
+        return f"v{ANALYSIS_CACHE_VERSION}:{model_id}:{scan_type.lower()}:{image_sha256}"
+
+    async def prepare(self):
+        """Drop entries written by analyzers we no longer run."""
+        current = [cloud_model_id(), local_ml_model_id(), LOCAL_PIL_MODEL_ID]
+        stale_model = {"$nin": current}
+        if xray_weights_fingerprint() == UNVERIFIED_WEIGHTS:
+            # Weights not loaded yet, so we can't tell which local entries are current.
+            stale_model["$not"] = re.compile("^local-ml:")
+        result = await db.analysis_cache.delete_many({"$or": [
+            {"version": {"$ne": ANALYSIS_CACHE_VERSION}},
+            {"model_id": stale_model},
+        ]})
+        if result.deleted_count:
+            logger.info(f"Invalidated {result.deleted_count} stale analysis cache entries")
+
+    async def get_or_compute(self, image_sha256: str, scan_type: str, image_bytes: bytes) -> tuple:
+        """Return ``(analysis, served_by)`` like ``analyze_scan``."""
+        model_id = analysis_model_id(scan_type)
+        key = self.key(image_sha256, scan_type, model_id)
+
+        cached = self.memory.get(key)
+        if cached is not None:
+            self.memory_hits += 1
+            return cached, {"tier": "cache", "model_id": model_id}
+
+        task = self._inflight.get(key)
+        if task is not None:
+            self.shared += 1
+        else:
+            task = asyncio.ensure_future(self._load(key, model_id, image_sha256, scan_type, image_bytes))
+            self._inflight[key] = task
+            task.add_done_callback(lambda _: self._inflight.pop(key, None))
+        # Shield so one cancelled waiter doesn't cancel the analysis for the others.
+        return await asyncio.shield(task)
+
+    async def _load(self, key: str, model_id: str, image_sha256: str, scan_type: str, image_bytes: bytes) -> tuple:
+        now = datetime.now(timezone.utc)
+        try:
+            doc = await db.analysis_cache.find_one({"key": key, "expires_at": {"$gt": now}}, {"_id": 0, "analysis": 1})
+        except Exception as e:
+            logger.warning(f"Analysis cache lookup failed: {e}")
+            doc = None
+        if doc:
+            self.mongo_hits += 1
+            self._remember(key, doc["analysis"])
+            return doc["analysis"], {"tier": "cache", "model_id": model_id}
+
+        self.misses += 1
+        analysis, served_model_id, tier = await provider_router.route(image_bytes, scan_type)
+        served_by = {"tier": tier, "model_id": served_model_id}
+        # A fallback result must not be stored under the key of the analyzer that failed,
+        # nor a local result from weights this process hasn't fingerprinted.
+        if served_model_id != model_id or f"@{UNVERIFIED_WEIGHTS}:" in model_id:
+            return analysis, served_by
+
+        self._remember(key, analysis)
+        try:
+            await db.analysis_cache.update_one(
+                {"key": key},
+                {"$set": {
+                    "key": key,
+                    "version": ANALYSIS_CACHE_VERSION,
+                    "model_id": model_id,
+                    "scan_type": scan_type.lower(),
+                    "image_sha256": image_sha256,
+                    "analysis": analysis,
+                    "created_at": now,
+                    "expires_at": now + timedelta(seconds=self.ttl_seconds),
+                }},
+                upsert=True
+            )
+        except Exception as e:
+            logger.warning(f"Analysis cache store failed: {e}")
+        return analysis, served_by
+
+    def _remember(self, key: str, analysis: dict):
+        self.memory.set(key, analysis, size=len(json.dumps(analysis, default=str)))
+
+    def stats(self) -> dict:
+        hits = self.memory_hits + self.mongo_hits
+        lookups = hits + self.misses
+        return {
+            "enabled": self.enabled,
+            "entries": len(self.memory),
+            "bytes": self.memory.bytes,
+            "memory_hits": self.memory_hits,
+            "mongo_hits": self.mongo_hits,
+            "misses": self.misses,
+            "shared_in_flight": self.shared,
+            "evictions": self.memory.evictions,
+            "hit_rate": round(hits / lookups, 4) if lookups else 0.0,
+        }
+
+analysis_cache = AnalysisResultCache(
+    enabled=_env_flag("ANALYSIS_CACHE_ENABLED", "true"),
+    ttl_seconds=float(os.environ.get("ANALYSIS_CACHE_TTL_SECONDS", str(7 * 86400))),
+    max_entries=int(os.environ.get("ANALYSIS_CACHE_MAX_ENTRIES", "1024")),
+    max_bytes=int(os.environ.get("ANALYSIS_CACHE_MAX_BYTES", str(64 * 1024 * 1024))),
+)
+
+# ================== Activity Log ==================
+
+DEVELOPER_LOG_TTL_DAYS = int(os.environ.get("DEVELOPER_LOG_TTL_DAYS", "90"))
+
+class ActivityLogSink:
+    """Buffers developer_logs events and writes them with ``insert_many``.
+
+    A batch is flushed when it reaches ``max_batch`` events or
+    ``flush_interval`` seconds after its first event. The buffer holds at most
+    ``max_pending`` events; when it is full, ``log`` waits up to
+    ``block_timeout`` seconds for room and then drops the event.
+    """
+
+    def __init__(self, max_batch: int, flush_interval: float, max_pending: int, block_timeout: float):
+        self.max_batch = max_batch
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.block_timeout = block_timeout
+        self._queue = None
+        self._task = None
+        self._closing = False
+        self.flushed = 0
+        self.batches = 0
+        self.dropped = 0
+        self.write_errors = 0
+
+    def start(self):
+        if self._task is not None:
+            return
+        self._queue = asyncio.Queue(maxsize=self.max_pending)
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self, timeout: float = 10):
+        """Flush everything still buffered, then stop the writer."""
+        if self._task is None:
+            return
+        # Events logged from here on are written directly instead of queueing behind the sentinel.
+        self._closing = True
+        try:
+            # The sentinel queues behind every event logged so far.
+            await asyncio.wait_for(self._queue.put(None), timeout)
+            await asyncio.wait_for(asyncio.shield(self._task), timeout)
+        except asyncio.TimeoutError:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self.dropped += self._queue.qsize()
+            logger.error(f"Activity log did not flush within {timeout}s; dropped {self._queue.qsize()} events")
+        self._task = None
+        self._closing = False
+
+    async def log(self, action: str, **fields):
+        now = datetime.now(timezone.utc)
+        event = {
+            "id": str(uuid.uuid4()),
+            "action": action,
+            **fields,
+            "timestamp": now.isoformat(),
+            # BSON date for the TTL index; "timestamp" stays a string for existing readers.
+            "logged_at": now,
+        }
+        if self._task is None or self._closing:
+            # Not running inside the app (e.g. maintenance commands), or shutting down.
+            await db.developer_logs.insert_one(event)
+            self.flushed += 1
+            return
+        try:
+            self._queue.put_nowait(event)
+        except asyncio.QueueFull:
+            try:
+                await asyncio.wait_for(self._queue.put(event), self.block_timeout)
+            except asyncio.TimeoutError:
+                self.dropped += 1
+                logger.warning(f"Activity log buffer full, dropped {action} event")
+
+    async def _run(self):
+        pending = []
+        closing = False
+        while not closing:
+            deadline = time.monotonic() + self.flush_interval
+            while len(pending) < self.max_batch:
+                timeout = deadline - time.monotonic() if pending else None
+                if timeout is not None and timeout <= 0:
+                    break
+                try:
+                    event = await asyncio.wait_for(self._queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                if event is None:
+                    closing = True
+                    break
+                if not pending:
+                    deadline = time.monotonic() + self.flush_interval
+                pending.append(event)
+            if not pending:
+                continue
+            if await self._write(pending, retry=not closing) or closing:
+                pending = []
+            else:
+                # Keep the batch and try again; producers feel the backpressure meanwhile.
+                await asyncio.sleep(self.flush_interval)
+
+    async def _write(self, batch: list, retry: bool) -> bool:
+        try:
+            with stage_seconds.time("activity_log_flush"):
+                await db.developer_logs.insert_many(batch, ordered=False)
+        except Exception as e:
+            self.write_errors += 1
+            if retry:
+                logger.error(f"Activity log flush of {len(batch)} events failed, will retry: {e}")
+                return False
+            self.dropped += len(batch)
+            logger.error(f"Activity log flush of {len(batch)} events failed, dropping them: {e}")
+            return False
+        self.flushed += len(batch)
+        self.batches += 1
+        return True
+
+    def stats(self) -> dict:
+        return {
+            "running": self._task is not None,
+            "buffered": self._queue.qsize() if self._queue else 0,
+            "max_pending": self.max_pending,
+            "flushed": self.flushed,
+            "batches": self.batches,
+            "dropped": self.dropped,
+            "write_errors": self.write_errors,
+        }
+
+activity_log = ActivityLogSink(
+    max_batch=int(os.environ.get("ACTIVITY_LOG_BATCH_SIZE", "200")),
+    flush_interval=float(os.environ.get("ACTIVITY_LOG_FLUSH_SECONDS", "1")),
+    max_pending=int(os.environ.get("ACTIVITY_LOG_MAX_PENDING", "10000")),
+    block_timeout=float(os.environ.get("ACTIVITY_LOG_BLOCK_SECONDS", "0.05")),
+)
+
+# ================== User Stats ==================
+
+# One pre-aggregated document per user in db.user_stats, kept current with
+# $inc on every scan state change so /stats is a single point read. A scan
+# counts towards exactly one status bucket at a time. Every $inc also bumps
+# ``version`` so a rebuild can tell whether it raced with one.
+SCAN_STATUSES = ("processing", "completed", "failed")
+
+def _stats_type_key(scan_type: str) -> str:
+    # scan_type comes from the client; keep it usable as a Mongo field name.
+    return scan_type.replace("%", "%25").replace(".", "%2E").replace("$", "%24")
+
+def _stats_type_name(key: str) -> str:
+    return key.replace("%24", "$").replace("%2E", ".").replace("%25", "%")
+
+def empty_user_stats(user_id: str) -> dict:
+    return {
+        "user_id": user_id,
+        "total_scans": 0,
+        "by_status": {status: 0 for status in SCAN_STATUSES},
+        "scan_types": {},
+    }
+
+async def record_scan_stats(user_id: str, scan_type: str, count: int = 1, status: str = "processing"):
+    """Add (or with a negative ``count``, remove) scans from a user's stats."""
+    await db.user_stats.update_one(
+        {"user_id": user_id},
+        {
+            "$inc": {
+                "total_scans": count,
+                f"by_status.{status}": count,
+                f"scan_types.{_stats_type_key(scan_type)}": count,
+                "version": 1,
+            },
+            "$set": {"updated_at": datetime.now(timezone.utc).isoformat()},
+        },
+        upsert=True
+    )
+
+async def record_scan_transition(user_id: str, old_status: str, new_status: str):
+    """Move one scan between status buckets."""
+    await db.user_stats.update_one(
+        {"user_id": user_id},
+        {
+            "$inc": {f"by_status.{old_status}": -1, f"by_status.{new_status}": 1, "version": 1},
+            "$set": {"updated_at": datetime.now(timezone.utc).isoformat()},
+        },
+        upsert=True
+    )
+
+async def transition_scan(scan_id: str, user_id: str, new_status: str, fields: Optional[dict] = None) -> bool:
+    """Move a scan out of ``processing`` and count it exactly once.
+
+    Returns False when the scan already left ``processing`` (or was deleted),
+    in which case the stats are left alone.
+    """
+    with stage_seconds.time("scan_update"):
+        result = await db.scans.update_one(
+            {"id": scan_id, "status": "processing"},
+            {"$set": {"status": new_status, "lease_until": None, **(fields or {})}}
         )
+    if result.modified_count != 1:
+        return False
+    await record_scan_transition(user_id, "processing", new_status)
+    return True
 
-        client = OpenAI(api_key=api_key)
-        model_name = os.environ.get("OPENAI_VISION_MODEL", "gpt-4.1-mini")
-        response = client.responses.create(
-            model=model_name,
-            input=[
-                {
-                    "role": "user",
-                    "content": [
-                        {"type": "input_text", "text": prompt},
-                        {
-                            "type": "input_image",
-                            "image_url": f"data:image/jpeg;base64,{image_base64}",
-                        },
-                    ],
-                }
-            ],
+async def compute_user_stats(user_id: Optional[str] = None) -> dict:
+    """Recompute stats documents from db.scans (all users, or just ``user_id``)."""
+    pipeline = [
+        {"$group": {
+            "_id": {"user_id": "$user_id", "scan_type": "$scan_type", "status": "$status"},
+            "count": {"$sum": 1},
+        }},
+    ]
+    if user_id is not None:
+        pipeline.insert(0, {"$match": {"user_id": user_id}})
+
+    stats = {}
+    async for row in db.scans.aggregate(pipeline, allowDiskUse=True):
+        key = row["_id"]
+        doc = stats.setdefault(key["user_id"], empty_user_stats(key["user_id"]))
+        doc["total_scans"] += row["count"]
+        status = key.get("status") or "processing"
+        doc["by_status"][status] = doc["by_status"].get(status, 0) + row["count"]
+        type_key = _stats_type_key(key.get("scan_type") or "")
+        doc["scan_types"][type_key] = doc["scan_types"].get(type_key, 0) + row["count"]
+    if user_id is not None:
+        stats.setdefault(user_id, empty_user_stats(user_id))
+    return stats
+
+async def _replace_user_stats(user_id: str, doc: dict, version: Optional[int]) -> bool:
+    """Store a recomputed document only if no ``$inc`` landed since ``version`` was read."""
+    now = datetime.now(timezone.utc).isoformat()
+    try:
+        result = await db.user_stats.replace_one(
+            {"user_id": user_id, "version": version if version is not None else {"$exists": False}},
+            {**doc, "version": (version or 0) + 1, "rebuilt_at": now, "updated_at": now},
+            upsert=True
         )
-        response_text = response.output_text or ""
+    except DuplicateKeyError:
+        # The document exists at another version (user_id is unique).
+        return False
+    return bool(result.matched_count or result.upserted_id)
 
-        json_match = re.search(r'\{[\s\S]*\}', response_text)
-        if json_match:
-            return json.loads(json_match.group())
+async def _user_stats_versions(user_id: Optional[str] = None) -> dict:
+    query = {"user_id": user_id} if user_id is not None else {}
+    return {
+        doc["user_id"]: doc.get("version")
+        async for doc in db.user_stats.find(query, {"_id": 0, "user_id": 1, "version": 1})
+    }
 
+async def rebuild_user_stats(user_id: Optional[str] = None, max_attempts: int = 5) -> int:
+    """Overwrite stored stats with values recomputed from db.scans.
+
+    Versions are read before aggregating; a user whose document was
+    incremented in the meantime is recomputed on its own, so the rebuild
+    never overwrites a concurrent ``$inc``.
+    """
+    versions = await _user_stats_versions(user_id)
+    computed = await compute_user_stats(user_id)
+    for uid, doc in computed.items():
+        version = versions.get(uid)
+        for _ in range(max_attempts):
+            if await _replace_user_stats(uid, doc, version):
+                break
+            version = (await _user_stats_versions(uid)).get(uid)
+            doc = (await compute_user_stats(uid))[uid]
+        else:
+            logger.warning(f"Gave up rebuilding stats for {uid}: concurrent updates kept changing it")
+    return len(computed)
+
+def _comparable_stats(doc: Optional[dict]) -> tuple:
+    doc = doc or {}
+    return (
+        doc.get("total_scans", 0),
+        {k: v for k, v in (doc.get("by_status") or {}).items() if v},
+        {k: v for k, v in (doc.get("scan_types") or {}).items() if v},
+    )
+
+async def check_user_stats(repair: bool = False) -> list:
+    """Compare stored stats with db.scans; returns the user ids that disagree."""
+    computed = await compute_user_stats()
+    stored = {
+        doc["user_id"]: doc
+        async for doc in db.user_stats.find({}, {"_id": 0})
+    }
+    mismatched = []
+    for uid in sorted(set(computed) | set(stored)):
+        expected = computed.get(uid, empty_user_stats(uid))
+        if _comparable_stats(expected) != _comparable_stats(stored.get(uid)):
+            mismatched.append(uid)
+            logger.warning(
+                f"User stats mismatch for {uid}: stored {_comparable_stats(stored.get(uid))}, "
+                f"actual {_comparable_stats(expected)}"
+            )
+            if repair:
+                await rebuild_user_stats(uid)
+    return mismatched
+
+# ================== Similarity Index ==================
+
+# Near-duplicate reuse is opt-in: a re-upload within this many dHash bits of a
+# completed scan of the same type gets that scan's analysis.
+NEAR_DUPLICATE_REUSE = _env_flag("NEAR_DUPLICATE_REUSE")
+NEAR_DUPLICATE_MAX_DISTANCE = int(os.environ.get("NEAR_DUPLICATE_MAX_DISTANCE", "4"))
+
+def _chunk_flips(max_bits: int) -> list:
+    """16-bit masks grouped by how many bits they flip (0..max_bits)."""
+    return [
+        [sum(1 << bit for bit in bits) for bits in itertools.combinations(range(16), count)]
+        for count in range(max_bits + 1)
+    ]
+
+class HammingIndex:
+    """Multi-index hashing over 64-bit perceptual hashes.
+
+    Hashes are split into four 16-bit chunks with one table per chunk. Two
+    hashes within distance ``r`` must agree on some chunk to within
+    ``r // 4`` bits, so a query probes only those chunk values and checks
+    the candidates with a popcount; it never walks the whole index.
+    """
+
+    CHUNKS = 4
+    MAX_DISTANCE = 15
+    _FLIPS = _chunk_flips(MAX_DISTANCE // CHUNKS)
+
+    def __init__(self):
+        self._tables = [{} for _ in range(self.CHUNKS)]  # chunk value -> set of hashes
+        self._ids = {}  # hash -> set of scan ids
+
+    def __len__(self) -> int:
+        return sum(len(ids) for ids in self._ids.values())
+
+    @staticmethod
+    def _chunks(value: int) -> list:
+        return [(value >> (16 * i)) & 0xFFFF for i in range(HammingIndex.CHUNKS)]
+
+    def add(self, scan_id: str, value: int):
+        ids = self._ids.get(value)
+        if ids is None:
+            ids = self._ids[value] = set()
+            for table, chunk in zip(self._tables, self._chunks(value)):
+                table.setdefault(chunk, set()).add(value)
+        ids.add(scan_id)
+
+    def remove(self, scan_id: str, value: int):
+        ids = self._ids.get(value)
+        if ids is None:
+            return
+        ids.discard(scan_id)
+        if ids:
+            return
+        del self._ids[value]
+        for table, chunk in zip(self._tables, self._chunks(value)):
+            bucket = table.get(chunk)
+            if bucket is not None:
+                bucket.discard(value)
+                if not bucket:
+                    del table[chunk]
+
+    def search(self, value: int, max_distance: int) -> list:
+        """``(distance, scan_id)`` pairs within ``max_distance``, nearest first."""
+        max_distance = min(max_distance, self.MAX_DISTANCE)
+        flips = [mask for group in self._FLIPS[:max_distance // self.CHUNKS + 1] for mask in group]
+        candidates = set()
+        for table, chunk in zip(self._tables, self._chunks(value)):
+            for mask in flips:
+                bucket = table.get(chunk ^ mask)
+                if bucket:
+                    candidates.update(bucket)
+        matches = []
+        for candidate in candidates:
+            distance = (candidate ^ value).bit_count()
+            if distance <= max_distance:
+                matches.extend((distance, scan_id) for scan_id in self._ids[candidate])
+        matches.sort()
+        return matches
+
+class SimilarityIndex:
+    """Per-user ``HammingIndex`` kept in a TTL'd LRU and loaded from db.scans on demand.
+
+    Scans added or deleted through this process update a loaded index
+    directly; the TTL bounds how stale an index can be for changes made by
+    other processes.
+    """
+
+    def __init__(self, max_users: int, ttl_seconds: float):
+        self.indexes = TTLCache(max_users, ttl_seconds)
+        self._loading = {}
+        self.loads = 0
+        self.queries = 0
+
+    async def get(self, user_id: str) -> HammingIndex:
+        index = self.indexes.get(user_id)
+        if index is not None:
+            return index
+        task = self._loading.get(user_id)
+        if task is None:
+            task = asyncio.ensure_future(self._load(user_id))
+            self._loading[user_id] = task
+            task.add_done_callback(lambda _: self._loading.pop(user_id, None))
+        return await asyncio.shield(task)
+
+    async def _load(self, user_id: str) -> HammingIndex:
+        index = HammingIndex()
+        async for scan in db.scans.find(
+            {"user_id": user_id, "dhash": {"$ne": None}}, {"_id": 0, "id": 1, "dhash": 1}
+        ):
+            if scan.get("dhash"):
+                index.add(scan["id"], int(scan["dhash"], 16))
+        self.indexes.set(user_id, index)
+        self.loads += 1
+        return index
+
+    def add(self, user_id: str, scan_id: str, dhash: Optional[str]):
+        index = self.indexes.get(user_id)
+        if index is not None and dhash:
+            index.add(scan_id, int(dhash, 16))
+
+    def remove(self, user_id: str, scan_id: str, dhash: Optional[str]):
+        index = self.indexes.get(user_id)
+        if index is not None and dhash:
+            index.remove(scan_id, int(dhash, 16))
+
+    async def similar(self, user_id: str, dhash: str, max_distance: int, exclude: Optional[str] = None) -> list:
+        self.queries += 1
+        index = await self.get(user_id)
+        return [(d, scan_id) for d, scan_id in index.search(int(dhash, 16), max_distance) if scan_id != exclude]
+
+    def stats(self) -> dict:
         return {
-            "doctor_view": {
-                "summary": response_text[:500] if len(response_text) > 500 else response_text,
-                "findings": ["Analysis completed"],
-                "observations": ["Image processed successfully"],
-                "recommendations": ["Consult with a medical professional for detailed interpretation"],
-                "confidence_level": "Medium",
-                "areas_of_concern": []
-            },
-            "patient_view": {
-                "summary": "Your scan has been analyzed.",
-                "findings": ["The AI has reviewed your image"],
-                "what_it_means": "Please consult with your doctor for a detailed explanation.",
-                "next_steps": ["Schedule a follow-up with your healthcare provider"],
-                "reassurance": "Remember, this is an AI-assisted analysis. Your doctor will provide the final interpretation."
-            }
+            "users_loaded": len(self.indexes),
+            "loads": self.loads,
+            "queries": self.queries,
+            "evictions": self.indexes.evictions,
         }
 
+similarity_index = SimilarityIndex(
+    max_users=int(os.environ.get("SIMILARITY_INDEX_USERS", "1000")),
+    ttl_seconds=float(os.environ.get("SIMILARITY_INDEX_TTL_SECONDS", "300")),
+)
+
+async def find_reusable_analysis(scan_doc: dict) -> Optional[tuple]:
+    """Analysis of the nearest completed same-type scan within NEAR_DUPLICATE_MAX_DISTANCE."""
+    if not scan_doc.get("dhash"):
+        return None
+    matches = await similarity_index.similar(
+        scan_doc["user_id"], scan_doc["dhash"], NEAR_DUPLICATE_MAX_DISTANCE, exclude=scan_doc["id"]
+    )
+    for distance, scan_id in matches[:10]:
+        source = await db.scans.find_one(
+            {"id": scan_id, "user_id": scan_doc["user_id"], "scan_type": scan_doc["scan_type"], "status": "completed"},
+            {"_id": 0, "id": 1, "report": 1, "doctor_view": 1, "patient_view": 1, "analysis_model": 1, "archive": 1}
+        )
+        if not source:
+            continue
+        await rehydrate_scans([source], {"report", "doctor_view", "patient_view"})
+        report = source.get("report")
+        expand_scan(source)
+        if source.get("doctor_view"):
+            analysis = {"doctor_view": source["doctor_view"], "patient_view": source.get("patient_view")}
+            if report and "template" in report:
+                # Keep referencing the source's template instead of inlining its rendered text.
+                analysis["report"] = report
+            return analysis, {
+                "tier": "near_duplicate",
+                "model_id": source.get("analysis_model"),
+                "source_scan_id": scan_id,
+                "distance": distance,
+            }
+    return None
+
+async def analyze_scan_doc(scan_doc: dict, image_bytes: bytes) -> tuple:
+    """``analyze_scan`` for a stored scan, reusing a near-duplicate's analysis when enabled."""
+    if NEAR_DUPLICATE_REUSE:
+        started = time.perf_counter()
+        try:
+            reused = await find_reusable_analysis(scan_doc)
+        except Exception as e:
+            logger.warning(f"Near-duplicate lookup failed for {scan_doc['id']}: {e}")
+            reused = None
+        if reused is not None:
+            if METRICS_ENABLED:
+                analysis_seconds.observe(time.perf_counter() - started, "near_duplicate")
+            return reused
+    return await analyze_scan(image_bytes, scan_doc["scan_type"], scan_doc.get("image_sha256"))
+
+# ================== Data Lifecycle ==================
+
+SCAN_ARCHIVE_AFTER_DAYS = int(os.environ.get("SCAN_ARCHIVE_AFTER_DAYS", "180"))  # 0 disables archival
+SCAN_ARCHIVE_STORE = os.environ.get("SCAN_ARCHIVE_STORE", "collection").lower()  # collection | blob
+DEAD_LETTER_TTL_DAYS = int(os.environ.get("DEAD_LETTER_TTL_DAYS", "30"))
+
+# collection -> policy. "archive_after_days" moves old scan payloads into the
+# scan archive. "expire_after_days" is enforced by the TTL index on
+# ``ttl_field`` (see MONGO_INDEXES); rows written before that field existed
+# are swept by ``legacy_field``, an ISO timestamp string.
+RETENTION_POLICIES = {
+    "scans": {"archive_after_days": SCAN_ARCHIVE_AFTER_DAYS},
+    "developer_logs": {"expire_after_days": DEVELOPER_LOG_TTL_DAYS, "ttl_field": "logged_at", "legacy_field": "timestamp"},
+    "scan_dead_letters": {"expire_after_days": DEAD_LETTER_TTL_DAYS, "ttl_field": "failed_at", "legacy_field": "timestamp"},
+}
+
+# What an archived scan keeps in db.scans: enough for listings, stats, the
+# similarity index and blob reference counting.
+SCAN_STUB_FIELDS = frozenset({
+    "_id", "id", "user_id", "scan_type", "file_name", "status", "created_at", "image_sha256", "image_ref",
+    "thumbnail_sha256", "dhash", "analysis_tier", "analysis_model", "archived_at", "archive",
+})
+ARCHIVABLE_STATUSES = ("completed", "failed")
+
+scans_archived = metrics.counter("lifecycle_scans_archived_total", "Scans whose payload moved to the archive")
+bytes_reclaimed = metrics.counter("lifecycle_bytes_reclaimed_total", "BSON bytes removed from db.scans by archival")
+archive_bytes_written = metrics.counter("lifecycle_archive_bytes_total", "Compressed bytes written to the scan archive")
+scans_rehydrated = metrics.counter("lifecycle_scans_rehydrated_total", "Archived scan payloads read back")
+rows_expired = metrics.counter("lifecycle_rows_expired_total", "Legacy rows deleted by retention sweeps", ("collection",))
+
+class ScanArchive:
+    """Compressed (zlib'd BSON) scan payloads in ``scans_archive`` or, with ``store="blob"``, the blob store."""
+
+    def __init__(self, store: str):
+        self.store = store
+
+    @staticmethod
+    def encode(scan_id: str, payload: dict) -> bytes:
+        # The id makes every payload distinct, so content-addressed blobs are never shared.
+        return zlib.compress(bson.encode({"id": scan_id, **payload}), REPORT_COMPRESSION_LEVEL)
+
+    @staticmethod
+    def decode(data: bytes) -> dict:
+        payload = bson.decode(zlib.decompress(data))
+        payload.pop("id", None)
+        return payload
+
+    async def put(self, scan: dict, data: bytes) -> dict:
+        if self.store == "blob":
+            key = await blob_store.put(data, content_type="application/octet-stream")
+            return {"store": "blob", "key": key, "size": len(data)}
+        await db.scans_archive.replace_one(
+            {"id": scan["id"]}, {"id": scan["id"], "user_id": scan["user_id"], "data": data}, upsert=True
+        )
+        return {"store": "collection", "size": len(data)}
+
+    async def read_many(self, scans: list) -> dict:
+        """``{scan_id: compressed payload}`` for archived stubs."""
+        found = {}
+        in_collection = [scan["id"] for scan in scans if scan["archive"].get("store") == "collection"]
+        if in_collection:
+            async for doc in db.scans_archive.find({"id": {"$in": in_collection}}, {"_id": 0, "id": 1, "data": 1}):
+                found[doc["id"]] = doc["data"]
+        for scan in scans:
+            if scan["archive"].get("store") == "blob":
+                found[scan["id"]] = await blob_store.read(scan["archive"]["key"])
+        return found
+
+    async def delete(self, scan_id: str, ref: dict):
+        if ref.get("store") == "blob":
+            await blob_store.delete(ref["key"])
+        else:
+            await db.scans_archive.delete_one({"id": scan_id})
+
+scan_archive = ScanArchive(SCAN_ARCHIVE_STORE)
+
+async def rehydrate_scans(scans: list, fields: Optional[set] = None) -> list:
+    """Merge archived payloads back into stub documents, in place (only ``fields``, when given)."""
+    archived = [scan for scan in scans if scan.get("archive")]
+    if not archived:
+        return scans
+    try:
+        payloads = await scan_archive.read_many(archived)
     except Exception as e:
-        logger.error(f"Cloud AI analysis error, switching to local fallback: {e}")
+        logger.error(f"Reading archived scans failed: {e}")
+        payloads = {}
+    for scan in archived:
+        data = payloads.get(scan["id"])
+        scan.pop("archive")
+        if data is None:
+            logger.error(f"Archived payload missing for scan {scan['id']}")
+            continue
+        payload = ScanArchive.decode(data)
+        scan.update(payload if fields is None else {k: v for k, v in payload.items() if k in fields})
+        scans_rehydrated.inc()
+    return scans
+
+class LifecycleManager:
+    """Applies ``RETENTION_POLICIES`` in the background.
+
+    Every ``interval`` seconds one process (holding the lease in
+    ``lifecycle_state``) archives completed/failed scans older than the scan
+    policy: everything outside SCAN_STUB_FIELDS is compressed into the scan
+    archive and removed from the hot document, which keeps serving listings
+    and is rehydrated on read. ``clock`` returns epoch seconds; it is
+    injectable so retention can be replayed on a simulated timeline.
+    """
+
+    def __init__(self, policies: dict, archive: ScanArchive, interval: float, batch_size: int, clock=time.time):
+        self.policies = policies
+        self.archive = archive
+        self.interval = interval
+        self.batch_size = batch_size
+        self.clock = clock
+        self.owner = f"{os.uname().nodename}:{os.getpid()}"
+        self._task = None
+        self._leased = False
+        self._legacy_swept = set()
+        self.runs = 0
+        self.last_run = None
+        self.totals = {"archived": 0, "bytes_reclaimed": 0, "archive_bytes": 0, "expired": 0}
+
+    def start(self):
+        if self._task is None and self.interval > 0:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _run(self):
+        while True:
+            try:
+                if await self._acquire_lease():
+                    await self.run_once()
+            except Exception as e:
+                logger.error(f"Lifecycle run failed: {e}")
+            finally:
+                self._leased = False
+            await asyncio.sleep(self.interval)
+
+    async def _acquire_lease(self) -> bool:
+        now = self.clock()
+        try:
+            await db.lifecycle_state.update_one(
+                {"_id": "lifecycle", "lease_until": {"$lt": now}},
+                {"$set": {"lease_until": now + self.interval * 0.9, "owner": self.owner}},
+                upsert=True
+            )
+            self._leased = True
+            return True
+        except DuplicateKeyError:
+            # Another process holds an unexpired lease.
+            return False
+
+    async def _renew_lease(self) -> bool:
+        """Extend a held lease before each batch; False once another process has taken it over."""
+        if not self._leased:
+            return True
+        renewed = await db.lifecycle_state.update_one(
+            {"_id": "lifecycle", "owner": self.owner},
+            {"$set": {"lease_until": self.clock() + self.interval * 0.9}}
+        )
+        self._leased = bool(renewed.matched_count)
+        return self._leased
+
+    async def run_once(self, user_id: Optional[str] = None) -> dict:
+        """One pass over every policy; ``user_id`` confines it to one user's documents."""
+        now = self.clock()
+        report = {"at": datetime.fromtimestamp(now, timezone.utc).isoformat(), "archived": 0,
+                  "bytes_reclaimed": 0, "archive_bytes": 0, "expired": {}}
+        for collection, policy in self.policies.items():
+            if policy.get("archive_after_days"):
+                report.update(await self.archive_scans(now - policy["archive_after_days"] * 86400, now, user_id))
+            if policy.get("expire_after_days") and policy.get("legacy_field") and collection not in self._legacy_swept:
+                cutoff = datetime.fromtimestamp(now - policy["expire_after_days"] * 86400, timezone.utc).isoformat()
+                query = {policy["ttl_field"]: {"$exists": False}, policy["legacy_field"]: {"$lt": cutoff}}
+                if user_id:
+                    query["user_id"] = user_id
+                deleted = (await db[collection].delete_many(query)).deleted_count
+                report["expired"][collection] = deleted
+                rows_expired.inc(collection, amount=deleted)
+                if not user_id and not await db[collection].find_one({policy["ttl_field"]: {"$exists": False}}, {"_id": 1}):
+                    # New rows always carry ttl_field; once the legacy rows are gone, stop scanning for them.
+                    self._legacy_swept.add(collection)
+
+        self.runs += 1
+        self.last_run = report
+        for key in ("archived", "bytes_reclaimed", "archive_bytes"):
+            self.totals[key] += report[key]
+        self.totals["expired"] += sum(report["expired"].values())
+        return report
+
+    async def archive_scans(self, cutoff: float, now: float, user_id: Optional[str] = None) -> dict:
+        cutoff_iso = datetime.fromtimestamp(cutoff, timezone.utc).isoformat()
+        archived_at = datetime.fromtimestamp(now, timezone.utc)
+        result = {"archived": 0, "bytes_reclaimed": 0, "archive_bytes": 0}
+        skipped = []
+        while True:
+            if not await self._renew_lease():
+                logger.warning("Lifecycle lease lost to another process; ending this pass")
+                return result
+            query = {
+                "archived_at": None,
+                "created_at": {"$lt": cutoff_iso},
+                "status": {"$in": list(ARCHIVABLE_STATUSES)},
+                "id": {"$nin": skipped},
+            }
+            if user_id:
+                query["user_id"] = user_id
+            scans = await db.scans.find(query, {"_id": 0}).sort("created_at", ASCENDING).limit(self.batch_size).to_list(self.batch_size)
+            if not scans:
+                return result
+
+            for scan in scans:
+                payload = {k: v for k, v in scan.items() if k not in SCAN_STUB_FIELDS}
+                update = {"$set": {"archived_at": archived_at}}
+                ref = None
+                if payload:
+                    data = ScanArchive.encode(scan["id"], payload)
+                    ref = await self.archive.put(scan, data)
+                    update["$set"]["archive"] = ref
+                    update["$unset"] = {k: "" for k in payload}
+                # Only if nothing changed since it was read (e.g. deleted or re-analyzed).
+                updated = await db.scans.update_one(
+                    {"id": scan["id"], "archived_at": None, "status": scan["status"]}, update
+                )
+                if not updated.modified_count:
+                    skipped.append(scan["id"])
+                    current = (await db.scans.find_one({"id": scan["id"]}, {"_id": 0, "archive": 1}) or {}).get("archive")
+                    # A concurrent pass may have archived it to the same place; keep that copy.
+                    if ref is not None and not (current and current.get("key") == ref.get("key")):
+                        await self.archive.delete(scan["id"], ref)
+                    continue
+                reclaimed = len(bson.encode(payload)) if payload else 0
+                result["archived"] += 1
+                result["bytes_reclaimed"] += reclaimed
+                result["archive_bytes"] += ref["size"] if ref else 0
+                scans_archived.inc()
+                bytes_reclaimed.inc(amount=reclaimed)
+                archive_bytes_written.inc(amount=ref["size"] if ref else 0)
+            logger.info(f"Archived {result['archived']} scans ({result['bytes_reclaimed']} bytes reclaimed)")
+
+    def stats(self) -> dict:
+        return {
+            "runs": self.runs,
+            "interval_seconds": self.interval,
+            "archive_store": self.archive.store,
+            **{f"total_{key}": value for key, value in self.totals.items()},
+        }
+
+lifecycle = LifecycleManager(
+    RETENTION_POLICIES,
+    scan_archive,
+    interval=float(os.environ.get("LIFECYCLE_INTERVAL_SECONDS", "3600")),
+    batch_size=int(os.environ.get("LIFECYCLE_BATCH_SIZE", "200")),
+)
+
+# ================== Scan Jobs ==================
+
+SCAN_JOB_LEASE_SECONDS = float(os.environ.get("SCAN_JOB_LEASE_SECONDS", "300"))
+
+async def complete_scan_analysis(scan_id: str, user_id: str, scan_type: str, analysis: dict, served_by: Optional[dict] = None):
+    """Persist a finished analysis and record it in the developer log."""
+    served_by = served_by or {}
+    await transition_scan(scan_id, user_id, "completed", {
+        "report": compact_report(analysis),
+        "analysis_tier": served_by.get("tier"),
+        "analysis_model": served_by.get("model_id"),
+        **({"analysis_source": served_by["source_scan_id"]} if served_by.get("source_scan_id") else {}),
+    })
+
+    await activity_log.log(
+        "scan_analyzed", scan_id=scan_id, user_id=user_id, scan_type=scan_type,
+        tier=served_by.get("tier"), model_id=served_by.get("model_id")
+    )
+
+class ScanJobQueue:
+    """In-process work queue for background scan analysis.
+
+    Scan documents in Mongo are the source of truth: a worker claims a scan by
+    taking its lease, so scans left in ``processing`` by a crashed process are
+    picked up again once the lease expires.
+    """
+
+    def __init__(self, workers: int, max_attempts: int, backoff_seconds: float):
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.backoff_seconds = backoff_seconds
+        self._queue = None
+        self._tasks = []
+        self._retry_tasks = set()
+        self._waiters = {}
+        self._waiter_counts = {}
+        self.completed = 0
+        self.retried = 0
+        self.dead_lettered = 0
+
+    def start(self):
+        if self._tasks:
+            return
+        self._queue = asyncio.Queue()
+        self._tasks = [asyncio.create_task(self._worker(i)) for i in range(self.workers)]
+
+    async def stop(self):
+        for task in [*self._tasks, *self._retry_tasks]:
+            task.cancel()
+        await asyncio.gather(*self._tasks, *self._retry_tasks, return_exceptions=True)
+        self._tasks = []
+        self._retry_tasks = set()
+
+    def enqueue(self, scan_id: str, delay: float = 0):
+        if delay <= 0:
+            self._queue.put_nowait(scan_id)
+            return
+
+        async def _delayed():
+            await asyncio.sleep(delay)
+            self._queue.put_nowait(scan_id)
+
+        task = asyncio.create_task(_delayed())
+        self._retry_tasks.add(task)
+        task.add_done_callback(self._retry_tasks.discard)
+
+    async def recover(self) -> int:
+        """Re-queue scans that were left in ``processing`` (e.g. after a crash).
+
+        A scan whose lease has not expired yet is queued for when it does.
+        """
+        count = 0
+        now = time.time()
+        async for scan in db.scans.find({"status": "processing"}, {"_id": 0, "id": 1, "lease_until": 1}):
+            self.enqueue(scan["id"], delay=(scan.get("lease_until") or now) - now)
+            count += 1
+        if count:
+            logger.info(f"Re-queued {count} scans stuck in processing")
+        return count
+
+    def waiter(self, scan_id: str) -> asyncio.Event:
+        """Event set when a local worker finishes ``scan_id``; pair with ``release_waiter``."""
+        self._waiter_counts[scan_id] = self._waiter_counts.get(scan_id, 0) + 1
+        return self._waiters.setdefault(scan_id, asyncio.Event())
+
+    def release_waiter(self, scan_id: str):
+        remaining = self._waiter_counts.get(scan_id, 0) - 1
+        if remaining > 0:
+            self._waiter_counts[scan_id] = remaining
+        else:
+            self._waiter_counts.pop(scan_id, None)
+            self._waiters.pop(scan_id, None)
+
+    def _notify(self, scan_id: str):
+        event = self._waiters.pop(scan_id, None)
+        if event is not None:
+            event.set()
+
+    async def _claim(self, scan_id: str) -> Optional[dict]:
+        now = time.time()
+        scan = await db.scans.find_one_and_update(
+            {
+                "id": scan_id,
+                "status": "processing",
+                "$or": [{"lease_until": None}, {"lease_until": {"$lt": now}}],
+            },
+            {"$set": {"lease_until": now + SCAN_JOB_LEASE_SECONDS}, "$inc": {"attempts": 1}},
+            projection={"_id": 0},
+        )
+        if scan:
+            scan["attempts"] = scan.get("attempts", 0) + 1
+        return scan
+
+    async def _worker(self, index: int):
+        while True:
+            scan_id = await self._queue.get()
+            try:
+                await self._process(scan_id)
+            except Exception as e:
+                logger.error(f"Scan job worker {index} error for {scan_id}: {e}")
+            finally:
+                self._queue.task_done()
+
+    async def _process(self, scan_id: str):
+        scan = await self._claim(scan_id)
+        if not scan:
+            # Already finished or deleted; if another worker holds the lease,
+            # look again when it expires in case that worker died.
+            leased = await db.scans.find_one({"id": scan_id, "status": "processing"}, {"_id": 0, "lease_until": 1})
+            if leased and leased.get("lease_until"):
+                self.enqueue(scan_id, delay=leased["lease_until"] - time.time())
+            return
+
         try:
-            if os.environ.get("USE_LOCAL_ML", "true").lower() in ("1", "true", "yes"):
-                return analyze_locally_with_ml(image_base64, scan_type)
-        except Exception as ml_err:
-            logger.warning(f"Local ML unavailable, falling back to basic analysis: {ml_err}")
-        return analyze_locally_with_pil(image_base64, scan_type)
+            image_bytes = await load_scan_image(scan)
+            analysis, served_by = await analyze_scan_doc(scan, image_bytes)
+            await complete_scan_analysis(scan_id, scan["user_id"], scan["scan_type"], analysis, served_by)
+            self.completed += 1
+            self._notify(scan_id)
+        except Exception as e:
+            attempts = scan["attempts"]
+            logger.warning(f"Scan job {scan_id} attempt {attempts} failed: {e}")
+            if attempts < self.max_attempts:
+                await db.scans.update_one(
+                    {"id": scan_id},
+                    {"$set": {"lease_until": None, "last_error": str(e)}}
+                )
+                self.retried += 1
+                self.enqueue(scan_id, delay=self.backoff_seconds * (2 ** (attempts - 1)))
+                return
+
+            await db.scan_dead_letters.insert_one({
+                "id": str(uuid.uuid4()),
+                "scan_id": scan_id,
+                "user_id": scan["user_id"],
+                "scan_type": scan["scan_type"],
+                "attempts": attempts,
+                "error": str(e),
+                "timestamp": datetime.now(timezone.utc).isoformat(),
+                "failed_at": datetime.now(timezone.utc),
+            })
+            await transition_scan(scan_id, scan["user_id"], "failed", {"last_error": str(e)})
+            self.dead_lettered += 1
+            self._notify(scan_id)
+
+    def stats(self) -> dict:
+        return {
+            "workers": self.workers,
+            "queued": self._queue.qsize() if self._queue else 0,
+            "scheduled_retries": len(self._retry_tasks),
+            "completed": self.completed,
+            "retried": self.retried,
+            "dead_lettered": self.dead_lettered,
+        }
+
+scan_jobs = ScanJobQueue(
+    workers=int(os.environ.get("SCAN_JOB_WORKERS", "4")),
+    max_attempts=int(os.environ.get("SCAN_JOB_MAX_ATTEMPTS", "3")),
+    backoff_seconds=float(os.environ.get("SCAN_JOB_BACKOFF_SECONDS", "2")),
+)
 
 # ================== Auth Routes ==================
 
@@ -393,21 +3103,21 @@ async def register(user_data: UserCreate):
         "id": user_id,
         "email": user_data.email,
         "name": user_data.name,
-        "password_hash": hash_password(user_data.password),
+        "password_hash": await password_hasher.hash(user_data.password),
         "created_at": datetime.now(timezone.utc).isoformat()
     }
     
     await db.users.insert_one(user_doc)
+    await db.user_stats.update_one(
+        {"user_id": user_id},
+        {"$setOnInsert": {**empty_user_stats(user_id), "rebuilt_at": user_doc["created_at"]}},
+        upsert=True
+    )
     
     # Log developer activity
-    await db.developer_logs.insert_one({
-        "id": str(uuid.uuid4()),
-        "action": "user_registered",
-        "user_id": user_id,
-        "timestamp": datetime.now(timezone.utc).isoformat()
-    })
+    await activity_log.log("user_registered", user_id=user_id)
     
-    token = create_token(user_id, user_data.email)
+    token = create_token(user_id, user_data.email, user_data.name, user_doc["created_at"])
     
     return TokenResponse(
         access_token=token,
@@ -425,10 +3135,20 @@ async def login(credentials: UserLogin):
     if not user:
         raise HTTPException(status_code=401, detail="Invalid credentials")
     
-    if not verify_password(credentials.password, user["password_hash"]):
+    if not await password_hasher.verify(credentials.password, user["password_hash"]):
         raise HTTPException(status_code=401, detail="Invalid credentials")
     
-    token = create_token(user["id"], user["email"])
+    # Upgrade hashes transparently when BCRYPT_ROUNDS changes.
+    if password_hasher.needs_rehash(user["password_hash"]):
+        try:
+            new_hash = await password_hasher.hash(credentials.password)
+            await db.users.update_one({"id": user["id"]}, {"$set": {"password_hash": new_hash}})
+            principal_cache.invalidate_user(user["id"])
+            password_hasher.rehashed += 1
+        except Exception as e:
+            logger.warning(f"Password rehash skipped for user {user['id']}: {e}")
+    
+    token = create_token(user["id"], user["email"], user["name"], user["created_at"])
     
     return TokenResponse(
         access_token=token,
@@ -451,154 +3171,917 @@ async def get_me(current_user: dict = Depends(get_current_user)):
 
 # ================== Scan Routes ==================
 
+ALLOWED_UPLOAD_TYPES = ("image/jpeg", "image/png", "image/webp")
+
+def new_scan_doc(user_id: str, scan_type: str, file_name: str, image_size: int, image_sha256: str,
+                 thumbnail_sha256: Optional[str], image_dhash: Optional[str], background: bool) -> dict:
+    return {
+        "id": str(uuid.uuid4()),
+        "user_id": user_id,
+        "scan_type": scan_type,
+        "file_name": file_name,
+        "image_sha256": image_sha256,
+        "image_ref": {"store": blob_store.name, "size": image_size, "content_type": "image/jpeg"},
+        "thumbnail_sha256": thumbnail_sha256,
+        "dhash": image_dhash,
+        "status": "processing",
+        "attempts": 0 if background else 1,
+        # Inline analysis holds the lease so crash recovery doesn't pick the scan up twice.
+        "lease_until": None if background else time.time() + SCAN_JOB_LEASE_SECONDS,
+        "created_at": datetime.now(timezone.utc).isoformat()
+    }
+
+async def ingest_upload(file: UploadFile, user_id: str, scan_type: str, background: bool) -> tuple:
+    """Validate, preprocess and store one upload; returns ``(processed_bytes, scan_doc)``."""
+    if file.content_type not in ALLOWED_UPLOAD_TYPES:
+        raise HTTPException(status_code=400, detail="Only JPEG, PNG, and WEBP images are allowed")
+    processed_bytes, thumbnail_bytes, image_dhash = await read_upload_image(file)
+    with stage_seconds.time("blob_put"):
+        image_sha256 = await store_blob(processed_bytes)
+        try:
+            thumbnail_sha256 = await store_blob(thumbnail_bytes) if thumbnail_bytes else None
+        except Exception:
+            await release_blob(image_sha256)
+            raise
+    scan_doc = new_scan_doc(
+        user_id, scan_type, file.filename, len(processed_bytes), image_sha256, thumbnail_sha256, image_dhash, background
+    )
+    return processed_bytes, scan_doc
+
+async def analyze_new_scan(scan_doc: dict, image_bytes: bytes) -> dict:
+    """Analyze a just-inserted scan inline; on error marks it failed and re-raises."""
+    try:
+        analysis, served_by = await analyze_scan_doc(scan_doc, image_bytes)
+        await complete_scan_analysis(scan_doc["id"], scan_doc["user_id"], scan_doc["scan_type"], analysis, served_by)
+    except Exception as e:
+        logger.error(f"Analysis failed: {e}")
+        await transition_scan(scan_doc["id"], scan_doc["user_id"], "failed", {"last_error": str(e)})
+        scan_doc["status"] = "failed"
+        raise
+
+    scan_doc["status"] = "completed"
+    scan_doc["doctor_view"] = analysis.get("doctor_view")
+    scan_doc["patient_view"] = analysis.get("patient_view")
+    scan_doc["analysis_tier"] = served_by.get("tier")
+    scan_doc["analysis_model"] = served_by.get("model_id")
+    return scan_doc
+
+def scan_response(scan_doc: dict) -> dict:
+    return ScanResponse(**{k: v for k, v in scan_doc.items() if k != "_id"}).model_dump()
+
 @api_router.post("/process-medical-image", response_model=ScanResponse)
 async def process_medical_image(
     file: UploadFile = File(...),
     scan_type: str = Form(...),
+    background: Optional[bool] = Form(None),
     current_user: dict = Depends(get_current_user)
 ):
-    # Validate file type
-    allowed_types = ["image/jpeg", "image/png", "image/webp"]
-    if file.content_type not in allowed_types:
-        raise HTTPException(status_code=400, detail="Only JPEG, PNG, and WEBP images are allowed")
+    if background is None:
+        background = _env_flag("SCAN_JOB_MODE")
     
-    # Read and preprocess image
-    image_bytes = await file.read()
-    processed_bytes = preprocess_image(image_bytes)
-    image_base64 = base64.b64encode(processed_bytes).decode('utf-8')
+    # Validate, preprocess and store the image
+    processed_bytes, scan_doc = await ingest_upload(file, current_user["id"], scan_type, background)
     
-    # Create scan record
-    scan_id = str(uuid.uuid4())
-    scan_doc = {
-        "id": scan_id,
-        "user_id": current_user["id"],
-        "scan_type": scan_type,
-        "file_name": file.filename,
-        "image_base64": image_base64,
-        "status": "processing",
-        "doctor_view": None,
-        "patient_view": None,
-        "created_at": datetime.now(timezone.utc).isoformat()
-    }
+    try:
+        with stage_seconds.time("scan_insert"):
+            await db.scans.insert_one(scan_doc)
+    except Exception:
+        await release_scan_blobs(scan_doc)
+        raise
+    await record_scan_stats(current_user["id"], scan_type)
+    similarity_index.add(current_user["id"], scan_doc["id"], scan_doc["dhash"])
     
-    await db.scans.insert_one(scan_doc)
+    if background:
+        scan_jobs.enqueue(scan_doc["id"])
+        return JSONResponse(status_code=202, content=scan_response(scan_doc))
     
-    # Analyze with Gemini
     try:
-        analysis = await analyze_with_gemini(image_base64, scan_type)
-        
-        # Update scan with results
-        await db.scans.update_one(
-            {"id": scan_id},
-            {"$set": {
-                "status": "completed",
-                "doctor_view": analysis.get("doctor_view"),
-                "patient_view": analysis.get("patient_view")
-            }}
-        )
-        
-        # Log analysis
-        await db.developer_logs.insert_one({
-            "id": str(uuid.uuid4()),
-            "action": "scan_analyzed",
-            "scan_id": scan_id,
-            "user_id": current_user["id"],
-            "scan_type": scan_type,
-            "timestamp": datetime.now(timezone.utc).isoformat()
-        })
-        
-        scan_doc["status"] = "completed"
-        scan_doc["doctor_view"] = analysis.get("doctor_view")
-        scan_doc["patient_view"] = analysis.get("patient_view")
-        
+        await analyze_new_scan(scan_doc, processed_bytes)
     except Exception as e:
-        logger.error(f"Analysis failed: {e}")
-        await db.scans.update_one(
-            {"id": scan_id},
-            {"$set": {"status": "failed"}}
-        )
-        scan_doc["status"] = "failed"
         raise HTTPException(status_code=500, detail=f"AI analysis failed: {str(e)}")
     
     return ScanResponse(**{k: v for k, v in scan_doc.items() if k != "_id"})
 
-@api_router.get("/scans", response_model=List[ScanResponse])
-async def get_scans(current_user: dict = Depends(get_current_user)):
+MAX_BATCH_FILES = int(os.environ.get("MAX_BATCH_FILES", "50"))
+MAX_BATCH_REQUEST_BYTES = int(os.environ.get("MAX_BATCH_REQUEST_BYTES", str(500 * 1024 * 1024)))
+
+def batch_item(index: int, file_name: Optional[str], scan_doc: Optional[dict] = None,
+               status: Optional[str] = None, error: Optional[str] = None) -> dict:
+    return {
+        "index": index,
+        "file_name": file_name,
+        "status": status or scan_doc["status"],
+        "scan": scan_response(scan_doc) if scan_doc else None,
+        "error": error,
+    }
+
+@api_router.post("/process-medical-images")
+async def process_medical_images(
+    files: List[UploadFile] = File(...),
+    scan_type: str = Form(...),
+    background: Optional[bool] = Form(None),
+    stream: bool = Form(False),
+    current_user: dict = Depends(get_current_user)
+):
+    """Upload a whole study in one request.
+
+    Images are preprocessed in parallel and inserted with one ``insert_many``.
+    Every file gets an item with its own status, so one bad image doesn't
+    fail the batch. With ``stream`` the items are sent as NDJSON lines as
+    each analysis finishes.
+    """
+    if len(files) > MAX_BATCH_FILES:
+        raise HTTPException(status_code=400, detail=f"At most {MAX_BATCH_FILES} images per batch")
+    if background is None:
+        background = _env_flag("SCAN_JOB_MODE")
+    
+    user_id = current_user["id"]
+    ingested = await asyncio.gather(
+        *(ingest_upload(file, user_id, scan_type, background) for file in files), return_exceptions=True
+    )
+    
+    rejected, accepted = [], []
+    for index, (file, result) in enumerate(zip(files, ingested)):
+        if isinstance(result, Exception):
+            error = result.detail if isinstance(result, HTTPException) else "Could not process image"
+            rejected.append(batch_item(index, file.filename, status="rejected", error=error))
+        else:
+            accepted.append((index, *result))
+    
+    if accepted:
+        try:
+            with stage_seconds.time("scan_insert_many"):
+                await db.scans.insert_many([scan_doc for _, _, scan_doc in accepted], ordered=False)
+        except BulkWriteError as e:
+            # Unordered: everything except the reported documents was inserted.
+            failed = {error["index"] for error in e.details.get("writeErrors", [])}
+            if not failed:
+                raise
+            logger.error(f"Batch insert failed for {len(failed)} of {len(accepted)} scans: {e}")
+            for position in sorted(failed):
+                index, _, scan_doc = accepted[position]
+                await release_scan_blobs(scan_doc)
+                rejected.append(batch_item(index, scan_doc["file_name"], status="rejected", error="Could not store scan"))
+            accepted = [item for position, item in enumerate(accepted) if position not in failed]
+        except Exception:
+            for _, _, scan_doc in accepted:
+                await release_scan_blobs(scan_doc)
+            raise
+    
+    if accepted:
+        await record_scan_stats(user_id, scan_type, count=len(accepted))
+        for _, _, scan_doc in accepted:
+            similarity_index.add(user_id, scan_doc["id"], scan_doc["dhash"])
+    
+    if background:
+        for _, _, scan_doc in accepted:
+            scan_jobs.enqueue(scan_doc["id"])
+        items = rejected + [batch_item(index, scan_doc["file_name"], scan_doc) for index, _, scan_doc in accepted]
+        return JSONResponse(status_code=202, content={"items": sorted(items, key=lambda item: item["index"])})
+    
+    async def analyze_item(index: int, image_bytes: bytes, scan_doc: dict) -> dict:
+        try:
+            await analyze_new_scan(scan_doc, image_bytes)
+        except Exception as e:
+            return batch_item(index, scan_doc["file_name"], scan_doc, error=f"AI analysis failed: {str(e)}")
+        return batch_item(index, scan_doc["file_name"], scan_doc)
+    
+    # Concurrent analyses let the X-ray batcher and the cloud limiter group the work.
+    tasks = [asyncio.ensure_future(analyze_item(*item)) for item in accepted]
+    
+    if stream:
+        async def lines():
+            for item in rejected:
+                yield json.dumps(item) + "\n"
+            for next_done in asyncio.as_completed(tasks):
+                yield json.dumps(await next_done) + "\n"
+        return StreamingResponse(lines(), media_type="application/x-ndjson")
+    
+    items = rejected + list(await asyncio.gather(*tasks))
+    return {"items": sorted(items, key=lambda item: item["index"])}
+
+SCAN_SUMMARY_FIELDS = ("id", "user_id", "scan_type", "file_name", "status", "created_at")
+
+def encode_scan_cursor(scan: dict) -> str:
+    raw = json.dumps([scan["created_at"], scan["id"]]).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip("=")
+
+def decode_scan_cursor(cursor: str) -> tuple:
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        created_at, scan_id = json.loads(raw)
+        return str(created_at), str(scan_id)
+    except Exception:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+def scan_projection(fields: Optional[str], view: str) -> dict:
+    if fields:
+        requested = {f.strip() for f in fields.split(",") if f.strip()}
+        unknown = requested - set(ScanResponse.model_fields)
+        if unknown:
+            raise HTTPException(status_code=400, detail=f"Unknown fields: {', '.join(sorted(unknown))}")
+    elif view == "full":
+        requested = set(ScanResponse.model_fields)
+    else:
+        requested = set(SCAN_SUMMARY_FIELDS)
+    # Keyset pagination needs the sort keys on every item.
+    requested |= {"id", "created_at"}
+    if requested & {"doctor_view", "patient_view"}:
+        # Completed scans store their views as a compact report; see expand_scan.
+        requested.add("report")
+    if requested - SCAN_STUB_FIELDS:
+        # Archived scans keep only stub fields; the rest is rehydrated.
+        requested.add("archive")
+    return {"_id": 0, **{field: 1 for field in sorted(requested)}}
+
+@api_router.get("/scans")
+async def get_scans(
+    request: Request,
+    limit: int = Query(100, ge=1, le=100),
+    cursor: Optional[str] = None,
+    fields: Optional[str] = None,
+    view: str = Query("summary", pattern="^(summary|full)$"),
+    current_user: dict = Depends(get_current_user)
+):
+    """Newest-first scan listing with keyset pagination.
+
+    Returns a summary representation by default; ``fields`` selects specific
+    ``ScanResponse`` fields. The cursor for the next page is returned in the
+    ``X-Next-Cursor`` header.
+    """
+    query = {"user_id": current_user["id"]}
+    if cursor:
+        created_at, scan_id = decode_scan_cursor(cursor)
+        query["$or"] = [
+            {"created_at": {"$lt": created_at}},
+            {"created_at": created_at, "id": {"$lt": scan_id}},
+        ]
+    
+    projection = scan_projection(fields, view)
     scans = await db.scans.find(
-        {"user_id": current_user["id"]},
-        {"_id": 0}
-    ).sort("created_at", -1).to_list(100)
+        query,
+        projection
+    ).sort([("created_at", -1), ("id", -1)]).limit(limit + 1).to_list(limit + 1)
+    
+    headers = {}
+    if len(scans) > limit:
+        scans = scans[:limit]
+        headers["X-Next-Cursor"] = encode_scan_cursor(scans[-1])
     
-    return [ScanResponse(**scan) for scan in scans]
+    await rehydrate_scans(scans, set(projection))
+    return json_response(request, [expand_scan(scan) for scan in scans], headers)
+
+SCAN_RESPONSE_FIELDS = {"report", *ScanResponse.model_fields}
+SCAN_RESPONSE_PROJECTION = {"_id": 0, "archive": 1, **{field: 1 for field in SCAN_RESPONSE_FIELDS}}
 
 @api_router.get("/scans/{scan_id}", response_model=ScanResponse)
-async def get_scan(scan_id: str, current_user: dict = Depends(get_current_user)):
+async def get_scan(scan_id: str, request: Request, current_user: dict = Depends(get_current_user)):
+    # Stored documents are written through ScanResponse-shaped code paths, so the
+    # projection is serialized directly instead of being re-validated per request.
+    scan = await db.scans.find_one(
+        {"id": scan_id, "user_id": current_user["id"]},
+        SCAN_RESPONSE_PROJECTION
+    )
+    
+    if not scan:
+        raise HTTPException(status_code=404, detail="Scan not found")
+    
+    await rehydrate_scans([scan], SCAN_RESPONSE_FIELDS)
+    return json_response(request, {field: None for field in ScanResponse.model_fields} | expand_scan(scan))
+
+@api_router.get("/scans/{scan_id}/status")
+async def get_scan_status(
+    scan_id: str,
+    wait: float = Query(0, ge=0, le=60),
+    current_user: dict = Depends(get_current_user)
+):
+    """Scan job status; with ``wait`` it long-polls until the scan leaves ``processing``."""
+    projection = {"_id": 0, "id": 1, "status": 1, "attempts": 1, "last_error": 1}
+    query = {"id": scan_id, "user_id": current_user["id"]}
+    deadline = time.monotonic() + wait
+    while True:
+        scan = await db.scans.find_one(query, projection)
+        if not scan:
+            raise HTTPException(status_code=404, detail="Scan not found")
+        remaining = deadline - time.monotonic()
+        if scan["status"] != "processing" or remaining <= 0:
+            return scan
+        # Woken early by a local worker; the periodic re-read covers other processes.
+        event = scan_jobs.waiter(scan_id)
+        try:
+            await asyncio.wait_for(event.wait(), timeout=min(remaining, 1.0))
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            scan_jobs.release_waiter(scan_id)
+
+@api_router.get("/scans/{scan_id}/similar")
+async def get_similar_scans(
+    scan_id: str,
+    max_distance: int = Query(8, ge=0, le=HammingIndex.MAX_DISTANCE),
+    limit: int = Query(20, ge=1, le=100),
+    current_user: dict = Depends(get_current_user)
+):
+    """The user's scans whose dHash is within ``max_distance`` bits of this one, nearest first."""
+    scan = await db.scans.find_one({"id": scan_id, "user_id": current_user["id"]}, {"_id": 0, "dhash": 1})
+    if not scan:
+        raise HTTPException(status_code=404, detail="Scan not found")
+    if not scan.get("dhash"):
+        return {"items": [], "indexed": False}
+    
+    matches = (await similarity_index.similar(current_user["id"], scan["dhash"], max_distance, exclude=scan_id))[:limit]
+    projection = {"_id": 0, **{field: 1 for field in SCAN_SUMMARY_FIELDS}}
+    docs = {
+        doc["id"]: doc
+        async for doc in db.scans.find({"id": {"$in": [match_id for _, match_id in matches]}, "user_id": current_user["id"]}, projection)
+    }
+    items = [
+        {"distance": distance, "similarity": round(1 - distance / 64, 4), "scan": docs[match_id]}
+        for distance, match_id in matches if match_id in docs
+    ]
+    return {"items": items, "indexed": True}
+
+def parse_byte_range(range_header: str, size: int) -> Optional[tuple]:
+    """Parse a single ``bytes=`` range; anything else is served in full."""
+    match = re.fullmatch(r"bytes=(\d*)-(\d*)", range_header.strip())
+    if not match or not any(match.groups()):
+        return None
+    start_text, end_text = match.groups()
+    if start_text:
+        start = int(start_text)
+        end = min(int(end_text), size - 1) if end_text else size - 1
+    else:
+        start = max(0, size - int(end_text))
+        end = size - 1
+    if start > end or start >= size:
+        raise HTTPException(status_code=416, detail="Range not satisfiable", headers={"Content-Range": f"bytes */{size}"})
+    return start, end
+
+async def blob_response(request: Request, key: str, size: int, content_type: str, data: Optional[bytes] = None):
+    """Stream a content-addressed blob with ETag and single-range support."""
+    etag = f'"{key}"'
+    headers = {
+        "ETag": etag,
+        "Accept-Ranges": "bytes",
+        "Cache-Control": "private, max-age=31536000, immutable",
+    }
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match and (if_none_match.strip() == "*" or etag in [t.strip().removeprefix("W/") for t in if_none_match.split(",")]):
+        return Response(status_code=304, headers=headers)
+
+    start, end = 0, size - 1
+    status_code = 200
+    range_header = request.headers.get("range")
+    if range_header and size:
+        byte_range = parse_byte_range(range_header, size)
+        if byte_range:
+            start, end = byte_range
+            status_code = 206
+            headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+    headers["Content-Length"] = str(end - start + 1 if size else 0)
+
+    if data is not None:
+        return Response(content=data[start:end + 1], status_code=status_code, headers=headers, media_type=content_type)
+    return StreamingResponse(blob_store.iter_range(key, start, end), status_code=status_code, headers=headers, media_type=content_type)
+
+@api_router.get("/scans/{scan_id}/image")
+async def get_scan_image(scan_id: str, request: Request, current_user: dict = Depends(get_current_user)):
+    scan = await db.scans.find_one(
+        {"id": scan_id, "user_id": current_user["id"]},
+        {"_id": 0, "id": 1, "image_sha256": 1, "image_ref": 1, "image_base64": 1, "archive": 1}
+    )
+    
+    if not scan:
+        raise HTTPException(status_code=404, detail="Scan not found")
+    await rehydrate_scans([scan], {"image_base64"})
+    
+    if scan.get("image_base64"):
+        # Not migrated to the blob store yet.
+        data = base64.b64decode(scan["image_base64"])
+        key = scan.get("image_sha256") or hashlib.sha256(data).hexdigest()
+        return await blob_response(request, key, len(data), "image/jpeg", data=data)
+    
+    key = scan.get("image_sha256")
+    size = await blob_store.size(key) if key else None
+    if size is None:
+        raise HTTPException(status_code=404, detail="Image not found")
+    content_type = (scan.get("image_ref") or {}).get("content_type", "image/jpeg")
+    return await blob_response(request, key, size, content_type)
+
+@api_router.get("/scans/{scan_id}/thumbnail")
+async def get_scan_thumbnail(scan_id: str, request: Request, current_user: dict = Depends(get_current_user)):
     scan = await db.scans.find_one(
         {"id": scan_id, "user_id": current_user["id"]},
-        {"_id": 0}
+        {"_id": 0, "id": 1, "image_sha256": 1, "image_base64": 1, "thumbnail_sha256": 1, "archive": 1}
     )
     
     if not scan:
         raise HTTPException(status_code=404, detail="Scan not found")
+    await rehydrate_scans([scan], {"image_base64"})
     
-    return ScanResponse(**scan)
+    key = scan.get("thumbnail_sha256")
+    size = await blob_store.size(key) if key else None
+    if size is None:
+        # Scans from before thumbnails existed: build one now and keep it.
+        try:
+            image_bytes = await load_scan_image(scan)
+            thumbnail_bytes = await asyncio.to_thread(lambda: make_thumbnail(Image.open(io.BytesIO(image_bytes))))
+        except Exception as e:
+            logger.warning(f"Thumbnail generation failed for scan {scan_id}: {e}")
+            raise HTTPException(status_code=404, detail="Thumbnail not available")
+        key = await store_blob(thumbnail_bytes)
+        size = len(thumbnail_bytes)
+        stored = await db.scans.update_one(
+            {"id": scan_id, "thumbnail_sha256": scan.get("thumbnail_sha256")}, {"$set": {"thumbnail_sha256": key}}
+        )
+        if not stored.modified_count:
+            # A concurrent request stored it first (or the scan is gone).
+            await release_blob(key, field="thumbnail_sha256")
+    
+    return await blob_response(request, key, size, "image/jpeg")
 
 @api_router.delete("/scans/{scan_id}")
 async def delete_scan(scan_id: str, current_user: dict = Depends(get_current_user)):
-    result = await db.scans.delete_one({
-        "id": scan_id,
-        "user_id": current_user["id"]
-    })
+    scan = await db.scans.find_one_and_delete(
+        {"id": scan_id, "user_id": current_user["id"]},
+        projection={"_id": 0, "image_sha256": 1, "thumbnail_sha256": 1, "scan_type": 1, "status": 1, "dhash": 1, "archive": 1}
+    )
     
-    if result.deleted_count == 0:
+    if not scan:
         raise HTTPException(status_code=404, detail="Scan not found")
     
+    await record_scan_stats(
+        current_user["id"], scan.get("scan_type") or "", count=-1, status=scan.get("status") or "processing"
+    )
+    similarity_index.remove(current_user["id"], scan_id, scan.get("dhash"))
+    if scan.get("archive"):
+        await scan_archive.delete(scan_id, scan["archive"])
+    
+    await release_blob(scan.get("image_sha256"))
+    await release_blob(scan.get("thumbnail_sha256"), field="thumbnail_sha256")
+    
     return {"message": "Scan deleted successfully"}
 
 # ================== Stats Route ==================
 
 @api_router.get("/stats")
 async def get_stats(current_user: dict = Depends(get_current_user)):
-    total_scans = await db.scans.count_documents({"user_id": current_user["id"]})
-    completed_scans = await db.scans.count_documents({
-        "user_id": current_user["id"],
-        "status": "completed"
-    })
-    
-    # Get scan type distribution
-    pipeline = [
-        {"$match": {"user_id": current_user["id"]}},
-        {"$group": {"_id": "$scan_type", "count": {"$sum": 1}}}
-    ]
-    type_dist = await db.scans.aggregate(pipeline).to_list(10)
+    stats = await db.user_stats.find_one({"user_id": current_user["id"]}, {"_id": 0})
+    if not stats or "rebuilt_at" not in stats:
+        # Users from before pre-aggregated stats: seed their document once.
+        await rebuild_user_stats(current_user["id"])
+        stats = await db.user_stats.find_one({"user_id": current_user["id"]}, {"_id": 0})
     
     return {
-        "total_scans": total_scans,
-        "completed_scans": completed_scans,
-        "scan_types": {item["_id"]: item["count"] for item in type_dist}
+        "total_scans": stats.get("total_scans", 0),
+        "completed_scans": stats.get("by_status", {}).get("completed", 0),
+        "scan_types": {
+            _stats_type_name(key): count for key, count in stats.get("scan_types", {}).items() if count > 0
+        }
     }
 
 # ================== Health Check ==================
 
+def require_metrics_token(request: Request):
+    """Operational detail (``/metrics``, component health) needs ``METRICS_TOKEN`` when one is set.
+
+    Only liveness and readiness stay public, for load balancers and probes.
+    """
+    if METRICS_TOKEN and request.headers.get("authorization") != f"Bearer {METRICS_TOKEN}":
+        raise HTTPException(status_code=401, detail="Invalid metrics token")
+
 @api_router.get("/")
 async def root():
     return {"message": "MediVision AI API", "status": "healthy"}
 
 @api_router.get("/health")
 async def health_check():
+    """Liveness: the process is up and serving requests."""
     return {"status": "healthy", "timestamp": datetime.now(timezone.utc).isoformat()}
 
+@api_router.get("/health/ready")
+async def readiness_check():
+    """Readiness: MongoDB answers and required local models are loaded."""
+    checks = {}
+    try:
+        await asyncio.wait_for(db.command("ping"), timeout=2)
+        checks["database"] = "ok"
+    except Exception as e:
+        checks["database"] = f"unavailable: {e}"
+
+    models = model_registry.status()
+    if _env_flag("USE_LOCAL_ML", "true") and MODEL_LOAD_MODE != "lazy":
+        xray = models["xray"]
+        checks["xray_model"] = "ok" if xray["loaded"] else (f"failed: {xray['error']}" if xray["error"] else "loading")
+
+    # A model that failed to load is not a readiness failure: analysis falls back to PIL.
+    ready = checks["database"] == "ok" and checks.get("xray_model") != "loading"
+    return JSONResponse(
+        status_code=200 if ready else 503,
+        content={"status": "ready" if ready else "not_ready", "checks": checks, "models": models},
+    )
+
+@api_router.get("/health/analysis", dependencies=[Depends(require_metrics_token)])
+async def analysis_health():
+    return {
+        "local": analysis_executor.stats(),
+        "ingest": ingest_executor.stats(),
+        "xray_batching": xray_batcher.stats(),
+        "cloud": {"in_flight": cloud_in_flight, **provider_router.stats()},
+        "cache": analysis_cache.stats(),
+        "jobs": scan_jobs.stats(),
+        "similarity": similarity_index.stats(),
+    }
+
+@api_router.get("/health/auth", dependencies=[Depends(require_metrics_token)])
+async def auth_health():
+    return {"principals": principal_cache.stats(), "password_hashing": password_hasher.stats()}
+
+@api_router.get("/health/activity-log", dependencies=[Depends(require_metrics_token)])
+async def activity_log_health():
+    return activity_log.stats()
+
+@api_router.get("/health/lifecycle", dependencies=[Depends(require_metrics_token)])
+async def lifecycle_health():
+    return {"policies": RETENTION_POLICIES, "last_run": lifecycle.last_run, **lifecycle.stats()}
+
+# ================== Metrics Route ==================
+
+metrics.collect("analysis_executor", lambda: analysis_executor.stats())
+metrics.collect("ingest_executor", lambda: ingest_executor.stats())
+metrics.collect("password_hasher", lambda: password_hasher.stats())
+metrics.collect("xray_batching", lambda: xray_batcher.stats())
+metrics.collect("scan_jobs", lambda: scan_jobs.stats())
+metrics.collect("activity_log", lambda: activity_log.stats())
+metrics.collect("analysis_cache", lambda: analysis_cache.stats())
+metrics.collect("provider_router", lambda: {"cloud_in_flight": cloud_in_flight, **provider_router.stats()})
+metrics.collect("principal_cache", lambda: principal_cache.stats())
+metrics.collect("similarity_index", lambda: similarity_index.stats())
+metrics.collect("lifecycle", lambda: lifecycle.stats())
+
+@app.get("/metrics", include_in_schema=False)
+async def prometheus_metrics(request: Request):
+    if not METRICS_ENABLED:
+        raise HTTPException(status_code=404, detail="Metrics are disabled")
+    require_metrics_token(request)
+    return Response(metrics.render(), media_type="text/plain; version=0.0.4")
+
 # Include the router in the main app
 app.include_router(api_router)
 
+app.add_middleware(MetricsMiddleware, profile_rate=PROFILE_SAMPLE_RATE)
+
+app.add_middleware(
+    RequestSizeLimitMiddleware,
+    max_bytes=MAX_REQUEST_BYTES,
+    path_limits={"/api/process-medical-images": MAX_BATCH_REQUEST_BYTES},
+)
+
+app.add_middleware(
+    CompressionMiddleware,
+    minimum_size=RESPONSE_COMPRESSION_MIN_BYTES,
+    level=RESPONSE_COMPRESSION_LEVEL,
+)
+
 app.add_middleware(
     CORSMiddleware,
     allow_credentials=True,
     allow_origins=os.environ.get('CORS_ORIGINS', '*').split(','),
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor", "ETag"],
 )
 
-@app.on_event("shutdown")
-async def shutdown_db_client():
-    client.close()
+# ================== Database Indexes ==================
+
+MONGO_INDEXES = {
+    "users": [
+        IndexModel([("email", ASCENDING)], unique=True, name="email_unique"),
+        IndexModel([("id", ASCENDING)], unique=True, name="id_unique"),
+    ],
+    "scans": [
+        IndexModel([("id", ASCENDING)], unique=True, name="id_unique"),
+        IndexModel([("user_id", ASCENDING), ("created_at", DESCENDING), ("id", DESCENDING)], name="user_created"),
+        IndexModel([("user_id", ASCENDING), ("status", ASCENDING)], name="user_status"),
+        IndexModel([("status", ASCENDING)], name="processing", partialFilterExpression={"status": "processing"}),
+        IndexModel([("image_sha256", ASCENDING)], name="image_sha256", sparse=True),
+        IndexModel([("thumbnail_sha256", ASCENDING)], name="thumbnail_sha256", sparse=True),
+        IndexModel([("archived_at", ASCENDING), ("created_at", ASCENDING)], name="archive_candidates"),
+    ],
+    "scans_archive": [
+        IndexModel([("id", ASCENDING)], unique=True, name="id_unique"),
+        IndexModel([("user_id", ASCENDING)], name="user_id"),
+    ],
+    "analysis_cache": [
+        IndexModel([("key", ASCENDING)], unique=True, name="key_unique"),
+        IndexModel([("expires_at", ASCENDING)], expireAfterSeconds=0, name="expires_at_ttl"),
+    ],
+    "user_stats": [
+        IndexModel([("user_id", ASCENDING)], unique=True, name="user_id_unique"),
+    ],
+    "developer_logs": [
+        IndexModel(
+            [("logged_at", ASCENDING)],
+            expireAfterSeconds=DEVELOPER_LOG_TTL_DAYS * 86400,
+            name="logged_at_ttl"
+        ),
+    ],
+    "scan_dead_letters": [
+        IndexModel([("scan_id", ASCENDING)], name="scan_id"),
+        IndexModel([("failed_at", ASCENDING)], expireAfterSeconds=DEAD_LETTER_TTL_DAYS * 86400, name="failed_at_ttl"),
+    ],
+}
+
+async def sync_ttl_indexes(collection: str, indexes: list):
+    """Apply changed retention days to existing TTL indexes (create_indexes would reject the new options)."""
+    existing = await db[collection].index_information()
+    for index in indexes:
+        spec = index.document
+        current = existing.get(spec["name"])
+        if "expireAfterSeconds" in spec and current and current.get("expireAfterSeconds") != spec["expireAfterSeconds"]:
+            await db.command({"collMod": collection, "index": {
+                "keyPattern": dict(spec["key"]), "expireAfterSeconds": spec["expireAfterSeconds"],
+            }})
+            logger.info(f"TTL of {collection}.{spec['name']} set to {spec['expireAfterSeconds']}s")
+
+async def ensure_indexes():
+    """Create the indexes every hot query relies on (no-op when they exist)."""
+    for collection, indexes in MONGO_INDEXES.items():
+        try:
+            await sync_ttl_indexes(collection, indexes)
+            await db[collection].create_indexes(indexes)
+        except Exception as e:
+            logger.error(f"Index creation failed for {collection}: {e}")
+
+def _query_shapes() -> list:
+    """``(name, explain command)`` for the query shape behind each route."""
+    user_id, scan_id, created_at = "diagnostics", "diagnostics", "1970-01-01T00:00:00+00:00"
+    return [
+        ("login: users by email", {"find": "users", "filter": {"email": "diagnostics@example.com"}, "limit": 1}),
+        ("get_current_user: users by id", {"find": "users", "filter": {"id": user_id}, "limit": 1}),
+        ("get_scans: first page", {
+            "find": "scans", "filter": {"user_id": user_id},
+            "sort": {"created_at": -1, "id": -1}, "limit": 101,
+        }),
+        ("get_scans: keyset page", {
+            "find": "scans",
+            "filter": {"user_id": user_id, "$or": [
+                {"created_at": {"$lt": created_at}},
+                {"created_at": created_at, "id": {"$lt": scan_id}},
+            ]},
+            "sort": {"created_at": -1, "id": -1}, "limit": 101,
+        }),
+        ("get_scan: scan by id and user", {"find": "scans", "filter": {"id": scan_id, "user_id": user_id}, "limit": 1}),
+        ("scan jobs: claim", {"find": "scans", "filter": {"id": scan_id, "status": "processing"}, "limit": 1}),
+        ("lifecycle: archive candidates", {
+            "find": "scans",
+            "filter": {"archived_at": None, "created_at": {"$lt": created_at}, "status": {"$in": list(ARCHIVABLE_STATUSES)}},
+            "sort": {"created_at": 1}, "limit": 200,
+        }),
+        ("scan jobs: recovery", {"find": "scans", "filter": {"status": "processing"}}),
+        ("release_blob: scans by image", {"find": "scans", "filter": {"image_sha256": "diagnostics"}, "limit": 1}),
+        ("get_stats: user stats", {"find": "user_stats", "filter": {"user_id": user_id}, "limit": 1}),
+        ("analysis cache: lookup", {"find": "analysis_cache", "filter": {"key": "diagnostics"}, "limit": 1}),
+    ]
+
+def _winning_plan_stages(explain) -> list:
+    """All stage names inside every ``winningPlan`` of an explain document."""
+    stages = []
+
+    def collect(node, in_plan: bool):
+        if isinstance(node, dict):
+            if in_plan and "stage" in node:
+                stages.append(node["stage"])
+            for key, value in node.items():
+                if key != "rejectedPlans":
+                    collect(value, in_plan or key in ("winningPlan", "queryPlan"))
+        elif isinstance(node, list):
+            for item in node:
+                collect(item, in_plan)
+
+    collect(explain, False)
+    return stages
+
+async def check_query_plans() -> list:
+    """Explain every route's query shape; returns the names that fall back to COLLSCAN."""
+    offenders = []
+    for name, command in _query_shapes():
+        explain = await db.command({"explain": command, "verbosity": "queryPlanner"})
+        stages = _winning_plan_stages(explain)
+        if "COLLSCAN" in stages:
+            offenders.append(name)
+            logger.error(f"Query plan check failed: {name} uses COLLSCAN ({' -> '.join(stages)})")
+        else:
+            logger.info(f"Query plan check ok: {name} ({' -> '.join(stages) or 'no stages'})")
+    return offenders
+
+# ================== Lifespan ==================
+
+async def bootstrap_database():
+    await ensure_indexes()
+    if _env_flag("MONGO_QUERY_PLAN_CHECK"):
+        offenders = await check_query_plans()
+        if offenders:
+            raise RuntimeError(f"Queries without index support: {', '.join(offenders)}")
+
+@contextlib.asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Bring up indexes, models and background workers; stop them again on shutdown."""
+    await bootstrap_database()
+    if cloud_enabled():
+        # Import the SDK and build the client now rather than inside the first scan's deadline.
+        get_openai_client()
+    if MODEL_LOAD_MODE == "eager":
+        await warm_local_models()
+    elif MODEL_LOAD_MODE == "background":
+        app.state.model_warmup = asyncio.create_task(warm_local_models())
+
+    loop_lag_monitor = asyncio.create_task(monitor_event_loop_lag()) if METRICS_ENABLED else None
+    activity_log.start()
+    if analysis_cache.enabled:
+        await analysis_cache.prepare()
+    scan_jobs.start()
+    await scan_jobs.recover()
+    lifecycle.start()
+    try:
+        yield
+    finally:
+        if loop_lag_monitor is not None:
+            loop_lag_monitor.cancel()
+        await lifecycle.stop()
+        await scan_jobs.stop()
+        await xray_batcher.stop()
+        await activity_log.stop()
+        analysis_executor.shutdown()
+        ingest_executor.shutdown()
+        password_hasher.shutdown()
+        if _openai_client is not None:
+            await _openai_client.close()
+        client.close()
+
+app.router.lifespan_context = lifespan
+
+
+# ================== Maintenance Commands ==================
+
+async def migrate_inline_images(batch_size: int = 100) -> int:
+    """Move legacy inline ``image_base64`` payloads into the blob store in batches."""
+    migrated = 0
+    failed_ids = []
+    while True:
+        scans = await db.scans.find(
+            {"image_base64": {"$type": "string"}, "_id": {"$nin": failed_ids}},
+            {"_id": 1, "image_base64": 1}
+        ).limit(batch_size).to_list(batch_size)
+        if not scans:
+            break
+
+        payloads = []
+        for scan in scans:
+            try:
+                payloads.append((scan["_id"], base64.b64decode(scan["image_base64"])))
+            except Exception as e:
+                logger.error(f"Skipping scan {scan['_id']} with undecodable image: {e}")
+                failed_ids.append(scan["_id"])
+
+        keys = await asyncio.gather(*(store_blob(data) for _, data in payloads))
+        operations = [
+            UpdateOne(
+                {"_id": doc_id},
+                {
+                    "$set": {
+                        "image_sha256": key,
+                        "image_ref": {"store": blob_store.name, "size": len(data), "content_type": "image/jpeg"},
+                    },
+                    "$unset": {"image_base64": ""},
+                }
+            )
+            for (doc_id, data), key in zip(payloads, keys)
+        ]
+        if operations:
+            await db.scans.bulk_write(operations, ordered=False)
+        migrated += len(operations)
+        logger.info(f"Migrated {migrated} scan images to {blob_store.name} blob store")
+    return migrated
+
+async def backfill_dhashes(batch_size: int = 100) -> int:
+    """Compute ``dhash`` for scans stored before perceptual hashing existed."""
+    updated = 0
+    failed_ids = []
+    while True:
+        scans = await db.scans.find(
+            {"dhash": {"$exists": False}, "id": {"$nin": failed_ids}},
+            {"_id": 0, "id": 1, "image_sha256": 1, "image_base64": 1, "archive": 1}
+        ).limit(batch_size).to_list(batch_size)
+        if not scans:
+            break
+        await rehydrate_scans(scans, {"image_base64"})
+
+        operations = []
+        for scan in scans:
+            try:
+                image_bytes = await load_scan_image(scan)
+                value = await ingest_executor.run(lambda data: dhash(Image.open(io.BytesIO(data))), image_bytes)
+            except Exception as e:
+                logger.error(f"Skipping dhash for scan {scan['id']}: {e}")
+                failed_ids.append(scan["id"])
+                continue
+            operations.append(UpdateOne({"id": scan["id"]}, {"$set": {"dhash": value}}))
+        if operations:
+            await db.scans.bulk_write(operations, ordered=False)
+        updated += len(operations)
+        logger.info(f"Backfilled dhash for {updated} scans")
+    return updated
+
+async def compact_stored_reports(batch_size: int = 100) -> int:
+    """Replace inline ``doctor_view``/``patient_view`` on older scans with a compressed report."""
+    updated = 0
+    while True:
+        scans = await db.scans.find(
+            {"doctor_view": {"$type": "object"}, "report": {"$exists": False}},
+            {"_id": 0, "id": 1, "doctor_view": 1, "patient_view": 1}
+        ).limit(batch_size).to_list(batch_size)
+        if not scans:
+            break
+        await db.scans.bulk_write([
+            UpdateOne(
+                {"id": scan["id"]},
+                {"$set": {"report": compact_report(scan)}, "$unset": {"doctor_view": "", "patient_view": ""}}
+            )
+            for scan in scans
+        ], ordered=False)
+        updated += len(scans)
+        logger.info(f"Compacted reports for {updated} scans")
+    # Scans that never finished still carry the old null placeholders.
+    await db.scans.update_many({"doctor_view": None}, {"$unset": {"doctor_view": "", "patient_view": ""}})
+    return updated
+
+def main(argv=None):
+    import argparse
+
+    parser = argparse.ArgumentParser(description="MediVision AI maintenance commands")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    migrate = commands.add_parser("migrate-images", help="move inline scan images into the blob store")
+    migrate.add_argument("--batch-size", type=int, default=100)
+
+    rebuild = commands.add_parser("rebuild-stats", help="recompute user_stats documents from db.scans")
+    rebuild.add_argument("--user", help="only rebuild this user id")
+
+    check_stats = commands.add_parser("check-stats", help="fail if any user_stats document disagrees with db.scans")
+    check_stats.add_argument("--repair", action="store_true", help="rebuild the users that disagree")
+
+    backfill = commands.add_parser("backfill-dhash", help="compute perceptual hashes for older scans")
+    backfill.add_argument("--batch-size", type=int, default=100)
+
+    compact = commands.add_parser("compact-reports", help="store older inline scan reports in compact form")
+    compact.add_argument("--batch-size", type=int, default=100)
+
+    commands.add_parser("run-lifecycle", help="apply the retention policies once, now")
+
+    commands.add_parser("ensure-indexes", help="create the indexes declared in MONGO_INDEXES")
+    commands.add_parser("check-indexes", help="create indexes, then fail if any route query plan uses COLLSCAN")
+
+    args = parser.parse_args(argv)
+
+    async def run():
+        try:
+            if args.command == "migrate-images":
+                count = await migrate_inline_images(args.batch_size)
+                print(f"Migrated {count} scan images")
+            elif args.command == "rebuild-stats":
+                count = await rebuild_user_stats(args.user)
+                print(f"Rebuilt stats for {count} users")
+            elif args.command == "check-stats":
+                mismatched = await check_user_stats(repair=args.repair)
+                if mismatched:
+                    action = "Repaired" if args.repair else "Inconsistent"
+                    print(f"{action} stats for {len(mismatched)} users: " + ", ".join(mismatched))
+                    return 0 if args.repair else 1
+                print("User stats match db.scans")
+            elif args.command == "backfill-dhash":
+                count = await backfill_dhashes(args.batch_size)
+                print(f"Backfilled dhash for {count} scans")
+            elif args.command == "compact-reports":
+                count = await compact_stored_reports(args.batch_size)
+                print(f"Compacted reports for {count} scans")
+            elif args.command == "run-lifecycle":
+                print(json.dumps(await lifecycle.run_once(), indent=2))
+            elif args.command == "ensure-indexes":
+                await ensure_indexes()
+                print("Indexes are up to date")
+            elif args.command == "check-indexes":
+                await ensure_indexes()
+                offenders = await check_query_plans()
+                if offenders:
+                    print("COLLSCAN detected for: " + ", ".join(offenders))
+                    return 1
+                print("All route queries are index-backed")
+            return 0
+        finally:
+            client.close()
+
+    return asyncio.run(run())
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,49 @@
+import { useState, useEffect } from 'react';
+import axios from 'axios';
+
+const API_URL = `${process.env.REACT_APP_BACKEND_URL}/api`;
+
+// Scan images are served from an authenticated endpoint, so they are fetched
+// as blobs and exposed as object URLs. `variant` is 'image' or 'thumbnail'.
+// Older scans may still carry inline base64.
+export const useScanImage = (scan, token, variant = 'image') => {
+  const [src, setSrc] = useState(null);
+  const scanId = scan?.id;
+  const inlineImage = scan?.image_base64;
+
+  useEffect(() => {
+    if (!scanId) return undefined;
+    if (inlineImage) {
+      setSrc(`data:image/jpeg;base64,${inlineImage}`);
+      return undefined;
+    }
+
+    let objectUrl = null;
+    let cancelled = false;
+    axios.get(`${API_URL}/scans/${scanId}/${variant}`, {
+      headers: { Authorization: `Bearer ${token}` },
+      responseType: 'blob'
+    }).then((response) => {
+      if (cancelled) return;
+      objectUrl = URL.createObjectURL(response.data);
+      setSrc(objectUrl);
+    }).catch(() => {
+      if (!cancelled) setSrc(null);
+    });
+
+    return () => {
+      cancelled = true;
+      if (objectUrl) URL.revokeObjectURL(objectUrl);
+    };
+  }, [scanId, inlineImage, token, variant]);
+
+  return src;
+};
+
+const ScanImage = ({ scan, token, variant = 'image', alt, className, fallback = null }) => {
+  const src = useScanImage(scan, token, variant);
+  if (!src) return fallback;
+  return <img src={src} alt={alt} className={className} />;
+};
+
+export default ScanImage;
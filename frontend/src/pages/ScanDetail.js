@@ -9,6 +9,7 @@ import axios from 'axios';
 import Navbar from '@/components/Navbar';
 import Sidebar from '@/components/Sidebar';
 import Footer from '@/components/Footer';
+import { useScanImage } from '@/components/ScanImage';
 
 const API_URL = `${process.env.REACT_APP_BACKEND_URL}/api`;
 
@@ -19,6 +20,7 @@ const ScanDetail = () => {
   const [scan, setScan] = useState(null);
   const [loading, setLoading] = useState(true);
   const [activeView, setActiveView] = useState('patient');
+  const imageSrc = useScanImage(scan, token);
 
   const fetchScan = useCallback(async () => {
     try {
@@ -48,9 +50,9 @@ const ScanDetail = () => {
   };
 
   const handleDownload = () => {
-    if (!scan?.image_base64) return;
+    if (!imageSrc) return;
     const link = document.createElement('a');
-    link.href = `data:image/jpeg;base64,${scan.image_base64}`;
+    link.href = imageSrc;
     link.download = scan.file_name || 'scan.jpg';
     document.body.appendChild(link);
     link.click();
@@ -107,9 +109,9 @@ const ScanDetail = () => {
             <div>
               <div className="p-4 bg-white/5 border border-white/10">
                 <div className="aspect-square bg-white/10 relative overflow-hidden">
-                  {scan.image_base64 ? (
+                  {imageSrc ? (
                     <>
-                      <img src={`data:image/jpeg;base64,${scan.image_base64}`} alt={scan.file_name} className="w-full h-full object-contain" />
+                      <img src={imageSrc} alt={scan.file_name} className="w-full h-full object-contain" />
                       <div className="absolute top-4 left-4 w-8 h-8 border-l-2 border-t-2 border-black/40" />
                       <div className="absolute top-4 right-4 w-8 h-8 border-r-2 border-t-2 border-black/40" />
                       <div className="absolute bottom-4 left-4 w-8 h-8 border-l-2 border-b-2 border-black/40" />
@@ -11,6 +11,7 @@ import axios from 'axios';
 import Navbar from '@/components/Navbar';
 import Sidebar from '@/components/Sidebar';
 import Footer from '@/components/Footer';
+import ScanImage from '@/components/ScanImage';
 
 const API_URL = `${process.env.REACT_APP_BACKEND_URL}/api`;
 
@@ -149,13 +150,18 @@ const ScanHistory = () => {
               {filteredScans.map((scan, index) => (
                 <div key={scan.id} className="p-4 bg-white/5 border border-white/10 flex items-center gap-4 hover:border-white/40 cursor-pointer group" onClick={() => navigate(`/scan/${scan.id}`)} data-testid={`scan-item-${index}`}>
                   <div className="w-16 h-16 bg-white/10 flex-shrink-0 overflow-hidden">
-                    {scan.image_base64 ? (
-                      <img src={`data:image/jpeg;base64,${scan.image_base64}`} alt={scan.file_name} className="w-full h-full object-cover" />
-                    ) : (
-                      <div className="w-full h-full flex items-center justify-center">
-                        <Scan className="w-6 h-6 text-white/50" />
-                      </div>
-                    )}
+                    <ScanImage
+                      scan={scan}
+                      token={token}
+                      variant="thumbnail"
+                      alt={scan.file_name}
+                      className="w-full h-full object-cover"
+                      fallback={
+                        <div className="w-full h-full flex items-center justify-center">
+                          <Scan className="w-6 h-6 text-white/50" />
+                        </div>
+                      }
+                    />
                   </div>
                   <div className="flex-1 min-w-0">
                     <div className="flex items-center gap-3 mb-1">
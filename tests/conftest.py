@@ -0,0 +1,95 @@
+import os
+import sys
+import tempfile
+from pathlib import Path
+from typing import Optional
+
+import pytest
+
+BACKEND_DIR = Path(__file__).resolve().parent.parent / "backend"
+sys.path.insert(0, str(BACKEND_DIR))
+
+# The app reads its configuration at import time; point it at an in-memory
+# Mongo stand-in and keep every background loop and external call off.
+os.environ["MONGO_URL"] = "mongodb://localhost:27017"
+os.environ["DB_NAME"] = "medivision_test"
+os.environ["MOCK_AI"] = "1"
+os.environ["USE_LOCAL_ML"] = "false"
+os.environ["BLOB_STORE"] = "local"
+os.environ["BLOB_STORE_PATH"] = tempfile.mkdtemp(prefix="medivision-blobs-")
+os.environ["LIFECYCLE_INTERVAL_SECONDS"] = "0"
+os.environ["METRICS_ENABLED"] = "false"
+os.environ.pop("OPENAI_API_KEY", None)
+
+import motor.motor_asyncio  # noqa: E402
+import mongomock_motor  # noqa: E402
+
+# Kept for the tests that can also run against a real mongod (MONGO_TEST_URL).
+RealMotorClient = motor.motor_asyncio.AsyncIOMotorClient
+motor.motor_asyncio.AsyncIOMotorClient = mongomock_motor.AsyncMongoMockClient
+
+import httpx  # noqa: E402
+import server as server_module  # noqa: E402
+
+
+@pytest.fixture(scope="session")
+def anyio_backend():
+    return "asyncio"
+
+
+@pytest.fixture(scope="session")
+async def event_loop_lease(anyio_backend):
+    # Module-level semaphores and queues in the app bind to the first loop
+    # that uses them, so every async test shares one loop.
+    yield
+
+
+@pytest.fixture
+def server():
+    return server_module
+
+
+@pytest.fixture
+async def db(event_loop_lease):
+    for name in await server_module.db.list_collection_names():
+        await server_module.db.drop_collection(name)
+    yield server_module.db
+
+
+@pytest.fixture
+async def api(db):
+    app = server_module.app
+    async with app.router.lifespan_context(app):
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+            yield client
+
+
+async def register_user(api, email: str = "user@example.com") -> dict:
+    res = await api.post("/api/auth/register", json={"email": email, "password": "secret-pw", "name": "Test"})
+    assert res.status_code == 200, res.text
+    return {"Authorization": f"Bearer {res.json()['access_token']}"}
+
+
+async def upload_scan(api, headers: dict, image: Optional[bytes] = None, background: bool = False) -> dict:
+    res = await api.post(
+        "/api/process-medical-image",
+        headers=headers,
+        files={"file": ("scan.png", image or png_bytes(), "image/png")},
+        data={"scan_type": "xray", "background": str(background).lower()},
+    )
+    assert res.status_code in (200, 202), res.text
+    return res.json()
+
+
+def png_bytes(size=(320, 256), seed: int = 0) -> bytes:
+    import io
+
+    import numpy as np
+    from PIL import Image
+
+    rng = np.random.default_rng(seed)
+    pixels = rng.integers(0, 256, size=(size[1], size[0]), dtype=np.uint8)
+    buf = io.BytesIO()
+    Image.fromarray(pixels, "L").convert("RGB").save(buf, format="PNG")
+    return buf.getvalue()
@@ -0,0 +1,63 @@
+import asyncio
+
+import pytest
+
+from tests.conftest import register_user
+
+pytestmark = pytest.mark.anyio
+
+
+def make_sink(server, **overrides):
+    # A long flush interval keeps everything buffered until shutdown.
+    options = {"max_batch": 50, "flush_interval": 60, "max_pending": 10000, "block_timeout": 1}
+    return server.ActivityLogSink(**{**options, **overrides})
+
+
+async def test_stop_flushes_every_buffered_event(server, db):
+    sink = make_sink(server)
+    sink.start()
+    for i in range(1234):
+        await sink.log("buffered", seq=i)
+    assert await db.developer_logs.count_documents({}) < 1234
+
+    await sink.stop()
+    assert await db.developer_logs.count_documents({"action": "buffered"}) == 1234
+    assert sorted(await db.developer_logs.distinct("seq")) == list(range(1234))
+    assert sink.flushed == 1234
+    assert sink.dropped == 0
+
+
+async def test_events_logged_during_shutdown_are_kept(server, db):
+    sink = make_sink(server, max_pending=100)
+    sink.start()
+    logged = 0
+
+    async def producer():
+        nonlocal logged
+        for i in range(500):
+            await sink.log("racing", seq=i)
+            logged += 1
+            await asyncio.sleep(0)
+
+    task = asyncio.create_task(producer())
+    await asyncio.sleep(0.01)
+    await sink.stop()
+    await task
+
+    assert await db.developer_logs.count_documents({"action": "racing"}) == logged == 500
+    assert sink.dropped == 0
+
+
+async def test_app_shutdown_flushes_the_activity_log(server, db, monkeypatch):
+    import httpx
+
+    monkeypatch.setattr(server.activity_log, "flush_interval", 60)
+    app = server.app
+    async with app.router.lifespan_context(app):
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://test") as api:
+            for n in range(5):
+                await register_user(api, f"user{n}@example.com")
+        assert await db.developer_logs.count_documents({}) == 0, "still buffered before shutdown"
+
+    assert await db.developer_logs.count_documents({"action": "user_registered"}) == 5
+    assert server.activity_log.stats()["dropped"] == 0
@@ -0,0 +1,77 @@
+import numpy as np
+import pytest
+from PIL import Image
+
+from tests.conftest import png_bytes, register_user, upload_scan
+
+pytestmark = pytest.mark.anyio
+
+PATHOLOGIES = ["Atelectasis", "Effusion", "Pneumonia"]
+
+
+def fake_resize(gray: np.ndarray) -> np.ndarray:
+    # skimage isn't needed to exercise the cache; any 224x224 float input will do.
+    return np.asarray(Image.fromarray(gray).resize((224, 224)), dtype=np.float32)
+
+
+def registry_with_weights(server, fingerprint: str):
+    def load():
+        forward = lambda batch: np.full((len(batch), len(PATHOLOGIES)), 0.2, dtype=np.float32)  # noqa: E731
+        return server.XrayRunner("eager", forward, PATHOLOGIES), {"weights_fingerprint": fingerprint}
+
+    registry = server.ModelRegistry()
+    registry.register("xray", load)
+    registry.get("xray")
+    return registry
+
+
+@pytest.fixture
+def local_ml(server, monkeypatch):
+    monkeypatch.setenv("USE_LOCAL_ML", "true")
+    monkeypatch.setitem(server.AnalysisPipeline.STAGES, "xray_input", (("grayscale",), fake_resize, False))
+    server.analysis_cache.memory.clear()
+    yield
+    server.analysis_cache.memory.clear()
+
+
+async def test_model_id_tracks_loaded_weights(server, monkeypatch):
+    monkeypatch.setattr(server, "model_registry", server.ModelRegistry())
+    assert "@unverified:" in server.local_ml_model_id()
+    monkeypatch.setattr(server, "model_registry", registry_with_weights(server, "aaaa"))
+    first = server.local_ml_model_id()
+    monkeypatch.setattr(server, "model_registry", registry_with_weights(server, "bbbb"))
+    assert server.local_ml_model_id() != first
+    assert server.XRAY_WEIGHTS in first
+
+
+async def test_replaced_weights_miss_the_cache(api, db, server, monkeypatch, local_ml):
+    headers = await register_user(api)
+    image = png_bytes(seed=11)
+    monkeypatch.setattr(server, "model_registry", registry_with_weights(server, "aaaa"))
+
+    first = await upload_scan(api, headers, image)
+    assert first["analysis_tier"] == "local"
+    assert "@aaaa:" in first["analysis_model"]
+    assert (await upload_scan(api, headers, image))["analysis_tier"] == "cache"
+
+    # Same XRAY_WEIGHTS name, different file contents.
+    monkeypatch.setattr(server, "model_registry", registry_with_weights(server, "bbbb"))
+    replaced = await upload_scan(api, headers, image)
+    assert replaced["analysis_tier"] == "local"
+    assert "@bbbb:" in replaced["analysis_model"]
+
+    await server.analysis_cache.prepare()
+    models = await db.analysis_cache.distinct("model_id")
+    assert models == [replaced["analysis_model"]]
+
+
+async def test_unfingerprinted_weights_are_not_cached(api, db, server, monkeypatch, local_ml):
+    headers = await register_user(api)
+    registry = registry_with_weights(server, "aaaa")
+    registry.timings["xray"].pop("weights_fingerprint")
+    monkeypatch.setattr(server, "model_registry", registry)
+
+    image = png_bytes(seed=12)
+    assert (await upload_scan(api, headers, image))["analysis_tier"] == "local"
+    assert (await upload_scan(api, headers, image))["analysis_tier"] == "local"
+    assert await db.analysis_cache.count_documents({}) == 0
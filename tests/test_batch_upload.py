@@ -0,0 +1,83 @@
+import json
+
+import pytest
+
+from tests.conftest import png_bytes, register_user
+
+pytestmark = pytest.mark.anyio
+
+
+def study(*names: str) -> list:
+    """Multipart files for a batch: good PNGs plus the named kinds of bad upload."""
+    bad = {
+        "notes.txt": (b"not an image", "text/plain"),
+        "fake.png": (b"GIF89a" + b"\0" * 64, "image/png"),
+        "truncated.png": (png_bytes(seed=40)[:200], "image/png"),
+    }
+    files = []
+    for i, name in enumerate(names):
+        content, content_type = bad.get(name) or (png_bytes(seed=30 + i), "image/png")
+        files.append(("files", (name, content, content_type)))
+    return files
+
+
+async def upload_study(api, headers: dict, files: list, **data):
+    form = {"scan_type": "xray", **{key: str(value).lower() for key, value in data.items()}}
+    return await api.post("/api/process-medical-images", headers=headers, files=files, data=form)
+
+
+async def test_bad_images_are_rejected_per_item(api, db):
+    headers = await register_user(api)
+    res = await upload_study(api, headers, study("a.png", "notes.txt", "b.png", "fake.png", "truncated.png"))
+    assert res.status_code == 200, res.text
+    items = res.json()["items"]
+
+    assert [item["index"] for item in items] == [0, 1, 2, 3, 4]
+    assert [item["file_name"] for item in items] == ["a.png", "notes.txt", "b.png", "fake.png", "truncated.png"]
+    assert [item["status"] for item in items] == ["completed", "rejected", "completed", "rejected", "rejected"]
+    assert items[1]["error"] == items[3]["error"] == "Only JPEG, PNG, and WEBP images are allowed"
+    assert items[4]["error"] == "Could not decode image"
+    for item in items:
+        assert (item["scan"] is None) == (item["status"] == "rejected")
+    assert items[0]["scan"]["doctor_view"]
+
+    assert await db.scans.count_documents({}) == 2
+    assert (await api.get("/api/stats", headers=headers)).json()["total_scans"] == 2
+
+
+async def test_batch_size_is_capped(api, server, monkeypatch):
+    headers = await register_user(api)
+    monkeypatch.setattr(server, "MAX_BATCH_FILES", 2)
+    res = await upload_study(api, headers, study("a.png", "b.png", "c.png"))
+    assert res.status_code == 400
+    assert res.json()["detail"] == "At most 2 images per batch"
+
+
+async def test_background_batch_returns_202_and_completes(api, db):
+    headers = await register_user(api)
+    res = await upload_study(api, headers, study("a.png", "notes.txt", "b.png"), background=True)
+    assert res.status_code == 202, res.text
+    items = res.json()["items"]
+    assert [item["status"] for item in items] == ["processing", "rejected", "processing"]
+
+    for item in (items[0], items[2]):
+        status = await api.get(f"/api/scans/{item['scan']['id']}/status", params={"wait": 5}, headers=headers)
+        assert status.json()["status"] == "completed"
+
+
+async def test_stream_sends_one_ndjson_line_per_file(api, db):
+    headers = await register_user(api)
+    res = await upload_study(api, headers, study("a.png", "notes.txt", "b.png", "c.png"), stream=True)
+    assert res.status_code == 200, res.text
+    assert res.headers["content-type"].startswith("application/x-ndjson")
+
+    lines = res.text.splitlines()
+    assert len(lines) == 4
+    items = [json.loads(line) for line in lines]
+    # Rejections are known before any analysis runs, so they come first.
+    assert items[0]["index"] == 1 and items[0]["status"] == "rejected"
+    assert sorted(item["index"] for item in items[1:]) == [0, 2, 3]
+    assert all(item["status"] == "completed" for item in items[1:])
+
+    stored = await db.scans.find({}, {"_id": 0, "id": 1, "status": 1}).to_list(None)
+    assert {scan["id"]: scan["status"] for scan in stored} == {item["scan"]["id"]: "completed" for item in items[1:]}
@@ -0,0 +1,170 @@
+import asyncio
+import hashlib
+
+import pytest
+
+from tests.conftest import png_bytes, register_user, upload_scan
+
+pytestmark = pytest.mark.anyio
+
+
+async def blob_exists(server, key: str) -> bool:
+    return await server.blob_store.size(key) is not None
+
+
+async def test_shared_blob_survives_until_last_scan_is_deleted(api, db, server):
+    headers = await register_user(api)
+    first = await upload_scan(api, headers)
+    second = await upload_scan(api, headers)
+    key = (await db.scans.find_one({"id": first["id"]}))["image_sha256"]
+    assert (await db.scans.find_one({"id": second["id"]}))["image_sha256"] == key
+    assert (await db.blob_refs.find_one({"_id": key}))["refs"] == 2
+
+    await api.delete(f"/api/scans/{first['id']}", headers=headers)
+    assert await blob_exists(server, key)
+    assert (await api.get(f"/api/scans/{second['id']}/image", headers=headers)).status_code == 200
+
+    await api.delete(f"/api/scans/{second['id']}", headers=headers)
+    assert not await blob_exists(server, key)
+    assert await db.blob_refs.find_one({"_id": key}) is None
+
+
+async def test_identical_upload_during_delete_keeps_its_image(api, db, server, monkeypatch):
+    headers = await register_user(api)
+    image = png_bytes(seed=7)
+    old = await upload_scan(api, headers, image)
+    key = (await db.scans.find_one({"id": old["id"]}))["image_sha256"]
+
+    # Hold the byte deletion open so the re-upload lands in the middle of it.
+    delete = server.blob_store.delete
+    deleting = asyncio.Event()
+
+    async def slow_delete(blob_key):
+        deleting.set()
+        await asyncio.sleep(0.2)
+        await delete(blob_key)
+
+    monkeypatch.setattr(server.blob_store, "delete", slow_delete)
+    removal = asyncio.create_task(api.delete(f"/api/scans/{old['id']}", headers=headers))
+    await deleting.wait()
+    new = await upload_scan(api, headers, image)
+    assert (await removal).status_code == 200
+
+    assert (await db.scans.find_one({"id": new["id"]}))["image_sha256"] == key
+    assert await blob_exists(server, key)
+    res = await api.get(f"/api/scans/{new['id']}/image", headers=headers)
+    assert res.status_code == 200
+    assert (await db.blob_refs.find_one({"_id": key}))["refs"] == 1
+
+
+async def test_concurrent_deletes_and_uploads_never_strand_a_scan(api, db, server):
+    headers = await register_user(api)
+    image = png_bytes(seed=3)
+    scans = [await upload_scan(api, headers, image) for _ in range(4)]
+
+    results = await asyncio.gather(
+        *(api.delete(f"/api/scans/{scan['id']}", headers=headers) for scan in scans),
+        *(upload_scan(api, headers, image) for _ in range(4)),
+    )
+    survivors = results[4:]
+    for scan in survivors:
+        res = await api.get(f"/api/scans/{scan['id']}/image", headers=headers)
+        assert res.status_code == 200
+    key = (await db.scans.find_one({"id": survivors[0]["id"]}))["image_sha256"]
+    assert (await db.blob_refs.find_one({"_id": key}))["refs"] == len(survivors)
+
+
+async def test_blob_from_before_reference_counting_is_released(api, db, server):
+    headers = await register_user(api)
+    scan = await upload_scan(api, headers)
+    key = (await db.scans.find_one({"id": scan["id"]}))["image_sha256"]
+    await db.blob_refs.delete_many({})
+    legacy = await upload_scan(api, headers)  # same bytes, counted from zero
+    await db.blob_refs.update_one({"_id": key}, {"$set": {"refs": 1}})
+
+    await api.delete(f"/api/scans/{legacy['id']}", headers=headers)
+    assert await blob_exists(server, key), "the uncounted scan still uses it"
+    await api.delete(f"/api/scans/{scan['id']}", headers=headers)
+    assert not await blob_exists(server, key)
+
+
+
+def record_puts(server, monkeypatch, fail_on: int = 0) -> list:
+    """Record the keys uploads store; optionally fail the ``fail_on``-th put."""
+    put = server.blob_store.put
+    keys = []
+
+    async def recording_put(data, content_type="image/jpeg"):
+        keys.append(hashlib.sha256(data).hexdigest())
+        if len(keys) == fail_on:
+            raise OSError("disk full")
+        return await put(data, content_type)
+
+    monkeypatch.setattr(server.blob_store, "put", recording_put)
+    return keys
+
+
+async def assert_released(db, server, keys: list):
+    assert keys
+    for key in keys:
+        assert not await blob_exists(server, key)
+        assert await db.blob_refs.find_one({"_id": key}) is None
+
+
+async def test_failed_scan_insert_releases_its_blobs(api, db, server, monkeypatch):
+    headers = await register_user(api)
+    keys = record_puts(server, monkeypatch)
+    collection = type(db.scans)
+    insert_one = collection.insert_one
+
+    async def failing_insert_one(self, document, *args, **kwargs):
+        if self.name == "scans":
+            raise RuntimeError("insert failed")
+        return await insert_one(self, document, *args, **kwargs)
+
+    monkeypatch.setattr(collection, "insert_one", failing_insert_one)
+    with pytest.raises(RuntimeError):
+        await upload_scan(api, headers, png_bytes(seed=11))
+    assert len(keys) == 2
+    await assert_released(db, server, keys)
+
+
+async def test_failed_thumbnail_store_releases_the_image(api, db, server, monkeypatch):
+    headers = await register_user(api)
+    keys = record_puts(server, monkeypatch, fail_on=2)
+    with pytest.raises(OSError):
+        await upload_scan(api, headers, png_bytes(seed=12))
+    await assert_released(db, server, keys)
+
+
+async def test_batch_keeps_the_inserted_scans_when_some_inserts_fail(api, db, server, monkeypatch):
+    headers = await register_user(api)
+    await db.scans.insert_one({"id": "taken", "user_id": "someone-else"})
+    new_scan_doc = server.new_scan_doc
+
+    def colliding_scan_doc(user_id, scan_type, file_name, *args):
+        scan_doc = new_scan_doc(user_id, scan_type, file_name, *args)
+        if file_name == "dup.png":
+            scan_doc["id"] = "taken"
+        return scan_doc
+
+    monkeypatch.setattr(server, "new_scan_doc", colliding_scan_doc)
+    names = ["a.png", "dup.png", "b.png"]
+    res = await api.post(
+        "/api/process-medical-images",
+        headers=headers,
+        files=[("files", (name, png_bytes(seed=20 + i), "image/png")) for i, name in enumerate(names)],
+        data={"scan_type": "xray"},
+    )
+    assert res.status_code == 200, res.text
+    items = res.json()["items"]
+    assert [item["status"] for item in items] == ["completed", "rejected", "completed"]
+    assert items[1]["error"] == "Could not store scan"
+
+    stored = await db.scans.find({"user_id": {"$ne": "someone-else"}}).to_list(None)
+    assert sorted(scan["file_name"] for scan in stored) == ["a.png", "b.png"]
+    assert (await api.get("/api/stats", headers=headers)).json()["total_scans"] == 2
+    kept = {scan["image_sha256"] for scan in stored} | {scan["thumbnail_sha256"] for scan in stored}
+    assert {ref["_id"] for ref in await db.blob_refs.find({}).to_list(None)} == kept
+    for key in kept:
+        assert await blob_exists(server, key)
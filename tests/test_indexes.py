@@ -0,0 +1,128 @@
+import os
+import uuid
+
+import pytest
+
+from tests.conftest import RealMotorClient
+
+pytestmark = pytest.mark.anyio
+
+
+def fake_plan(command: dict, indexes: dict) -> dict:
+    """Stand-in for MongoDB's query planner, which mongomock lacks.
+
+    A query gets an IXSCAN when an existing index's leading key is
+    constrained by the filter and the filter satisfies the index's partial
+    filter; otherwise it's a COLLSCAN, as on a real server.
+    """
+    query = command["filter"]
+    for name, info in indexes.get(command["find"], {}).items():
+        leading = list(info["key"])[0][0]
+        partial = info.get("partialFilterExpression", {})
+        if leading in query and all(query.get(field) == value for field, value in partial.items()):
+            return {"queryPlanner": {"winningPlan": {
+                "stage": "LIMIT", "inputStage": {"stage": "FETCH", "inputStage": {"stage": "IXSCAN", "indexName": name}},
+            }}}
+    return {"queryPlanner": {"winningPlan": {"stage": "COLLSCAN"}, "rejectedPlans": []}}
+
+
+@pytest.fixture
+def planner(server, db, monkeypatch):
+    explained = []
+
+    async def command(spec, *args, **kwargs):
+        if isinstance(spec, dict) and "explain" in spec:
+            explained.append(spec["explain"]["find"])
+            collection = spec["explain"]["find"]
+            existing = await db[collection].index_information()
+            # mongomock doesn't keep partialFilterExpression; take it from the declaration.
+            for index in server.MONGO_INDEXES.get(collection, []):
+                if index.document["name"] in existing and "partialFilterExpression" in index.document:
+                    existing[index.document["name"]]["partialFilterExpression"] = index.document["partialFilterExpression"]
+            return fake_plan(spec["explain"], {collection: existing})
+        return await real_command(spec, *args, **kwargs)
+
+    real_command = db.command
+    monkeypatch.setattr(db, "command", command)
+    return explained
+
+
+async def test_ensure_indexes_declares_every_index(server, db):
+    await server.ensure_indexes()
+    await server.ensure_indexes()  # idempotent
+
+    for collection, indexes in server.MONGO_INDEXES.items():
+        existing = await db[collection].index_information()
+        for index in indexes:
+            spec = index.document
+            assert spec["name"] in existing, f"{collection}.{spec['name']}"
+            info = existing[spec["name"]]
+            assert [tuple(key) for key in info["key"]] == list(spec["key"].items())
+            for option in ("unique", "sparse", "expireAfterSeconds"):
+                assert info.get(option) == spec.get(option), f"{collection}.{spec['name']} {option}"
+
+
+async def test_unique_indexes_reject_duplicates(server, db):
+    from pymongo.errors import DuplicateKeyError
+
+    await server.ensure_indexes()
+    await db.users.insert_one({"id": "u1", "email": "a@example.com"})
+    with pytest.raises(DuplicateKeyError):
+        await db.users.insert_one({"id": "u2", "email": "a@example.com"})
+    await db.user_stats.insert_one({"user_id": "u1"})
+    with pytest.raises(DuplicateKeyError):
+        await db.user_stats.insert_one({"user_id": "u1"})
+
+
+async def test_every_route_query_is_index_backed(server, db, planner):
+    await server.ensure_indexes()
+    assert await server.check_query_plans() == []
+    assert set(planner) == {command["find"] for _, command in server._query_shapes()}
+
+
+async def test_missing_index_is_reported_as_collscan(server, db, planner):
+    await server.ensure_indexes()
+    await db.users.drop_index("id_unique")
+    await db.scans.drop_index("processing")
+    assert await server.check_query_plans() == ["get_current_user: users by id", "scan jobs: recovery"]
+
+
+async def test_startup_check_fails_loudly(server, db, planner, monkeypatch):
+    monkeypatch.setenv("MONGO_QUERY_PLAN_CHECK", "true")
+    await server.bootstrap_database()  # indexes present: passes
+
+    monkeypatch.setattr(server, "MONGO_INDEXES", {**server.MONGO_INDEXES, "users": []})
+    await db.users.drop_indexes()
+    with pytest.raises(RuntimeError, match="login: users by email"):
+        await server.bootstrap_database()
+
+
+def test_winning_plan_stages_ignores_rejected_plans(server):
+    explain = {
+        "queryPlanner": {
+            "winningPlan": {"stage": "FETCH", "inputStage": {"stage": "IXSCAN", "indexName": "id_unique"}},
+            "rejectedPlans": [{"stage": "COLLSCAN"}],
+        },
+    }
+    assert server._winning_plan_stages(explain) == ["FETCH", "IXSCAN"]
+
+    # Slot-based engine and sharded explains nest the plan differently.
+    sbe = {"queryPlanner": {"winningPlan": {"queryPlan": {"stage": "COLLSCAN"}, "slotBasedPlan": {}}}}
+    assert "COLLSCAN" in server._winning_plan_stages(sbe)
+    sharded = {"queryPlanner": {"winningPlan": {"stage": "SINGLE_SHARD", "shards": [
+        {"winningPlan": {"stage": "IXSCAN"}}, {"winningPlan": {"stage": "COLLSCAN"}},
+    ]}}}
+    assert server._winning_plan_stages(sharded) == ["SINGLE_SHARD", "IXSCAN", "COLLSCAN"]
+
+
+@pytest.mark.skipif(not os.environ.get("MONGO_TEST_URL"), reason="set MONGO_TEST_URL to check plans on a real mongod")
+async def test_query_plans_on_a_real_mongod(server, monkeypatch, event_loop_lease):
+    client = RealMotorClient(os.environ["MONGO_TEST_URL"])
+    database = client[f"medivision_plans_{uuid.uuid4().hex[:8]}"]
+    monkeypatch.setattr(server, "db", database)
+    try:
+        await server.ensure_indexes()
+        assert await server.check_query_plans() == []
+    finally:
+        await client.drop_database(database.name)
+        client.close()
@@ -0,0 +1,164 @@
+import asyncio
+import base64
+import itertools
+import random
+import time
+import uuid
+from datetime import datetime, timezone
+
+import pytest
+
+from tests.conftest import png_bytes
+
+pytestmark = pytest.mark.anyio
+
+DAY = 86400
+
+
+class SimulatedClock:
+    """Epoch-seconds clock that only moves when told to."""
+
+    def __init__(self, now: float):
+        self.now = now
+
+    def __call__(self) -> float:
+        return self.now
+
+
+@pytest.fixture(params=["collection", "blob"])
+def archive(request, server, monkeypatch):
+    # rehydrate_scans reads through the module-level archive.
+    archive = server.ScanArchive(request.param)
+    monkeypatch.setattr(server, "scan_archive", archive)
+    return archive
+
+
+def iso(epoch: float) -> str:
+    return datetime.fromtimestamp(epoch, timezone.utc).isoformat()
+
+
+def synthetic_history(server, user_id: str, start: float, count: int, history_days: int) -> list:
+    """Scans spread over ``history_days`` either side of ``start``, in every stored form."""
+    rng = random.Random(0)
+    quality = server.analyze_locally_with_pil(png_bytes((128, 128)), "mri")
+    statuses = ("completed",) * 6 + ("failed", "processing")
+    docs = []
+    for i in range(count):
+        doc = {
+            "id": str(uuid.uuid4()), "user_id": user_id, "scan_type": "mri", "file_name": f"sim-{i}.png",
+            "status": statuses[i % len(statuses)], "attempts": 1,
+            "created_at": iso(start + rng.uniform(-history_days, history_days) * DAY),
+        }
+        if doc["status"] == "completed":
+            doc["analysis_tier"] = "local"
+            if i % 3 == 0:
+                doc.update(doctor_view=quality["doctor_view"], patient_view=quality["patient_view"])
+                doc["image_base64"] = base64.b64encode(rng.randbytes(256)).decode("ascii")
+            else:
+                doc["report"] = server.compact_report(quality if i % 3 == 1 else {
+                    "doctor_view": quality["doctor_view"], "patient_view": quality["patient_view"]
+                })
+        elif doc["status"] == "failed":
+            doc["last_error"] = "simulated failure"
+        docs.append(doc)
+    return sorted(docs, key=lambda doc: doc["created_at"])
+
+
+async def test_retention_replayed_on_simulated_clock(server, db, archive):
+    """Step a year and a quarter of retention; after every pass exactly the
+    completed/failed scans past the cutoff are archived, each rehydrates to
+    what the API served before archival, and expired legacy logs are gone."""
+    history_days, step_days, archive_after_days, log_ttl_days = 360, 30, 90, 60
+    user_id = "lifecycle-simulation"
+    start = time.time()
+    clock = SimulatedClock(start)
+    policies = {
+        "scans": {"archive_after_days": archive_after_days},
+        "developer_logs": {"expire_after_days": log_ttl_days, "ttl_field": "logged_at", "legacy_field": "timestamp"},
+    }
+    manager = server.LifecycleManager(policies, archive, interval=0, batch_size=50, clock=clock)
+
+    docs = synthetic_history(server, user_id, start, 240, history_days)
+    logs = [
+        {"id": str(uuid.uuid4()), "action": "simulated", "user_id": user_id, "timestamp": iso(start + day * DAY)}
+        for day in range(-history_days, history_days, 5)
+    ]
+    response_fields = server.SCAN_RESPONSE_FIELDS | {"image_base64"}
+
+    def served(doc: dict) -> dict:
+        return server.expand_scan({k: v for k, v in doc.items() if k in response_fields})
+
+    expected = {doc["id"]: served(dict(doc)) for doc in docs}
+    inserted = logs_inserted = 0
+    for step in range(0, history_days + archive_after_days + 1, step_days):
+        clock.now = start + step * DAY
+        now_iso = iso(clock.now)
+        arrived = list(itertools.takewhile(lambda doc: doc["created_at"] <= now_iso, docs[inserted:]))
+        if arrived:
+            await db.scans.insert_many([dict(doc) for doc in arrived])
+            inserted += len(arrived)
+        arrived_logs = list(itertools.takewhile(lambda log: log["timestamp"] <= now_iso, logs[logs_inserted:]))
+        if arrived_logs:
+            await db.developer_logs.insert_many([dict(log) for log in arrived_logs])
+            logs_inserted += len(arrived_logs)
+
+        await manager.run_once(user_id)
+
+        scan_cutoff = iso(clock.now - archive_after_days * DAY)
+        stored = {s["id"]: s for s in await db.scans.find({"user_id": user_id}, {"_id": 0}).to_list(None)}
+        for doc in docs[:inserted]:
+            should_archive = doc["status"] in server.ARCHIVABLE_STATUSES and doc["created_at"] < scan_cutoff
+            assert bool(stored[doc["id"]].get("archived_at")) == should_archive, f"day {step}: {doc['id']}"
+        for scan in await server.rehydrate_scans(list(stored.values()), response_fields):
+            assert served(scan) == expected[scan["id"]], f"day {step}: {scan['id']} does not rehydrate"
+        log_cutoff = iso(clock.now - log_ttl_days * DAY)
+        remaining = await db.developer_logs.find({"user_id": user_id}, {"_id": 0, "timestamp": 1}).to_list(None)
+        assert all(log["timestamp"] >= log_cutoff for log in remaining), f"day {step}: expired logs remain"
+
+    assert manager.totals["archived"] == sum(1 for doc in docs if doc["status"] in server.ARCHIVABLE_STATUSES)
+    assert 0 < manager.totals["archive_bytes"] < manager.totals["bytes_reclaimed"]
+
+
+async def test_pass_stops_when_its_lease_is_taken_over(server, db, archive):
+    start = time.time()
+    clock = SimulatedClock(start)
+    policies = {"scans": {"archive_after_days": 90}}
+    first = server.LifecycleManager(policies, archive, interval=3600, batch_size=10, clock=clock)
+    second = server.LifecycleManager(policies, archive, interval=3600, batch_size=10, clock=clock)
+    second.owner = "other-host:1"
+    await db.scans.insert_many(synthetic_history(server, "lease-user", start - 400 * DAY, 40, 10))
+
+    assert await first._acquire_lease()
+    assert not await second._acquire_lease()
+    clock.now += 3600  # first's pass outlives its lease
+    assert await second._acquire_lease()
+
+    assert (await first.archive_scans(clock.now - 90 * DAY, clock.now))["archived"] == 0
+    assert (await second.archive_scans(clock.now - 90 * DAY, clock.now))["archived"] > 0
+
+
+async def test_overlapping_passes_keep_every_archive(server, db, archive, monkeypatch):
+    start = time.time()
+    policies = {"scans": {"archive_after_days": 90}}
+    docs = synthetic_history(server, "overlap-user", start - 400 * DAY, 40, 10)
+    await db.scans.insert_many([dict(doc) for doc in docs])
+
+    # Yield between the archive write and the stub update so the passes interleave.
+    put = archive.put
+
+    async def slow_put(scan, data):
+        ref = await put(scan, data)
+        await asyncio.sleep(0)
+        return ref
+
+    monkeypatch.setattr(archive, "put", slow_put)
+    managers = [server.LifecycleManager(policies, archive, interval=0, batch_size=5) for _ in range(2)]
+    reports = await asyncio.gather(*(m.archive_scans(start - 90 * DAY, start) for m in managers))
+
+    archivable = [doc for doc in docs if doc["status"] in server.ARCHIVABLE_STATUSES]
+    assert sum(report["archived"] for report in reports) == len(archivable)
+    stored = await db.scans.find({"archived_at": {"$ne": None}}, {"_id": 0}).to_list(None)
+    assert len(stored) == len(archivable)
+    for scan in await server.rehydrate_scans(stored):
+        assert "archive" not in scan
+        assert scan.get("report") or scan.get("doctor_view") or scan.get("last_error"), scan["id"]
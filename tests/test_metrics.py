@@ -0,0 +1,116 @@
+import pytest
+
+from tests.conftest import register_user
+
+PROTECTED_HEALTH_ROUTES = ["/api/health/analysis", "/api/health/auth", "/api/health/activity-log", "/api/health/lifecycle"]
+
+
+def samples(text: str) -> dict:
+    """``{series: value}`` for every non-comment line of Prometheus text output."""
+    series = {}
+    for line in text.splitlines():
+        if line and not line.startswith("#"):
+            name, value = line.rsplit(" ", 1)
+            series[name] = float(value)
+    return series
+
+
+def test_histogram_renders_cumulative_buckets(server):
+    registry = server.MetricsRegistry("test")
+    histogram = registry.histogram("latency_seconds", "Request latency", ("route",), buckets=(0.1, 1, 0.5))
+    for value in (0.05, 0.1, 0.3, 0.7, 2.0):
+        histogram.observe(value, "/a")
+    histogram.observe(0.2, '/b"\n')
+
+    text = registry.render()
+    lines = text.splitlines()
+    assert lines[:2] == ["# HELP test_latency_seconds Request latency", "# TYPE test_latency_seconds histogram"]
+    values = samples(text)
+    assert [values[f'test_latency_seconds_bucket{{route="/a",le="{le}"}}'] for le in ("0.1", "0.5", "1", "+Inf")] == [2, 3, 4, 5]
+    assert values['test_latency_seconds_sum{route="/a"}'] == pytest.approx(3.15)
+    assert values['test_latency_seconds_count{route="/a"}'] == 5
+    # Label values are escaped.
+    assert values['test_latency_seconds_count{route="/b\\"\\n"}'] == 1
+
+
+def test_counter_and_collected_gauges(server):
+    registry = server.MetricsRegistry("test")
+    counter = registry.counter("events_total", "Events", ("kind",))
+    counter.inc("a")
+    counter.inc("a", amount=2)
+    counter.inc("b")
+    registry.collect("cache", lambda: {"hits": 3, "ratio": 0.5, "enabled": True, "name": "lru", "memory": {"bytes": 10}})
+    registry.collect("broken", lambda: 1 / 0)
+
+    text = registry.render()
+    assert "# TYPE test_events_total counter" in text
+    assert "# TYPE test_cache_hits gauge" in text
+    assert samples(text) == {
+        'test_events_total{kind="a"}': 3,
+        'test_events_total{kind="b"}': 1,
+        "test_cache_hits": 3,
+        "test_cache_ratio": 0.5,
+        "test_cache_enabled": 1,
+        "test_cache_memory_bytes": 10,
+    }
+
+
+def test_timers_are_no_ops_when_metrics_are_disabled(server, monkeypatch):
+    histogram = server.MetricsRegistry("test").histogram("stage_seconds", "Stage time", ("stage",))
+    monkeypatch.setattr(server, "METRICS_ENABLED", False)
+    with histogram.time("decode"):
+        pass
+    assert samples("\n".join(histogram.render())) == {}
+
+    monkeypatch.setattr(server, "METRICS_ENABLED", True)
+    with histogram.time("decode"):
+        pass
+    assert samples("\n".join(histogram.render()))['test_stage_seconds_count{stage="decode"}'] == 1
+
+
+@pytest.mark.anyio
+async def test_metrics_route(api, server, monkeypatch):
+    assert (await api.get("/metrics")).status_code == 404
+
+    monkeypatch.setattr(server, "METRICS_ENABLED", True)
+    headers = await register_user(api)
+    assert (await api.get("/api/auth/me", headers=headers)).status_code == 200
+
+    res = await api.get("/metrics")
+    assert res.status_code == 200
+    assert res.headers["content-type"].startswith("text/plain; version=0.0.4")
+    values = samples(res.text)
+    assert values['medivision_http_request_seconds_count{method="GET",route="/api/auth/me",status="200"}'] >= 1
+    assert "medivision_analysis_executor_max_workers" in values
+    assert "medivision_principal_cache_token_hits" in values
+
+
+@pytest.mark.anyio
+async def test_metrics_route_checks_the_token(api, server, monkeypatch):
+    monkeypatch.setattr(server, "METRICS_ENABLED", True)
+    monkeypatch.setattr(server, "METRICS_TOKEN", "scrape-secret")
+
+    assert (await api.get("/metrics")).status_code == 401
+    assert (await api.get("/metrics", headers={"Authorization": "Bearer wrong"})).status_code == 401
+    res = await api.get("/metrics", headers={"Authorization": "Bearer scrape-secret"})
+    assert res.status_code == 200
+    assert "# TYPE medivision_http_request_seconds histogram" in res.text
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize("path", PROTECTED_HEALTH_ROUTES)
+async def test_component_health_needs_the_metrics_token(api, server, monkeypatch, path):
+    monkeypatch.setattr(server, "METRICS_TOKEN", "scrape-secret")
+    assert (await api.get(path)).status_code == 401
+    user_headers = await register_user(api)
+    assert (await api.get(path, headers=user_headers)).status_code == 401
+    res = await api.get(path, headers={"Authorization": "Bearer scrape-secret"})
+    assert res.status_code == 200
+    assert isinstance(res.json(), dict)
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize("path", ["/api/health", "/api/health/ready"])
+async def test_liveness_and_readiness_stay_public(api, server, monkeypatch, path):
+    monkeypatch.setattr(server, "METRICS_TOKEN", "scrape-secret")
+    assert (await api.get(path)).status_code == 200
@@ -0,0 +1,45 @@
+import pytest
+
+from tests.conftest import register_user
+
+pytestmark = pytest.mark.anyio
+
+
+async def current_user_id(api, headers: dict) -> str:
+    res = await api.get("/api/auth/me", headers=headers)
+    assert res.status_code == 200, res.text
+    return res.json()["id"]
+
+
+async def test_login_rehash_invalidates_the_cached_user(api, server, monkeypatch):
+    headers = await register_user(api, "rehash@example.com")
+    user_id = await current_user_id(api, headers)
+    assert server.principal_cache.users.get(user_id) is not None
+
+    monkeypatch.setattr(server.password_hasher, "needs_rehash", lambda password_hash: True)
+    res = await api.post("/api/auth/login", json={"email": "rehash@example.com", "password": "secret-pw"})
+    assert res.status_code == 200, res.text
+    assert server.principal_cache.users.get(user_id) is None
+    assert await current_user_id(api, headers) == user_id
+
+
+async def test_invalidated_user_is_looked_up_again(api, db, server):
+    headers = await register_user(api, "gone@example.com")
+    user_id = await current_user_id(api, headers)
+    await db.users.delete_one({"id": user_id})
+    assert await current_user_id(api, headers) == user_id  # still cached
+
+    server.principal_cache.invalidate_user(user_id)
+    assert (await api.get("/api/auth/me", headers=headers)).status_code == 401
+
+
+async def test_trusted_claims_cannot_be_revoked(api, db, server, monkeypatch):
+    cache = server.PrincipalCache(max_entries=100, ttl_seconds=60, trust_token_claims=True)
+    monkeypatch.setattr(server, "principal_cache", cache)
+    headers = await register_user(api, "trusted@example.com")
+    user_id = await current_user_id(api, headers)
+
+    await db.users.delete_one({"id": user_id})
+    cache.invalidate_user(user_id)
+    assert await current_user_id(api, headers) == user_id
+    assert cache.stats()["user_misses"] == 0
@@ -0,0 +1,146 @@
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from tests.conftest import png_bytes
+
+pytestmark = pytest.mark.anyio
+
+
+class FakeOpenAI(BaseHTTPRequestHandler):
+    """Minimal ``/v1/responses`` endpoint with injectable latency and errors."""
+
+    delay = 0.0
+    status = 200
+    requests = 0
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers["Content-Length"]))
+        type(self).requests += 1
+        time.sleep(self.delay)
+        if self.status != 200:
+            body = json.dumps({"error": {"message": "injected failure", "type": "server_error"}}).encode()
+        else:
+            text = json.dumps({"doctor_view": {"summary": "cloud"}, "patient_view": {"summary": "cloud"}})
+            body = json.dumps({
+                "id": "resp_1", "object": "response", "created_at": 0, "model": "fake",
+                "status": "completed", "parallel_tool_calls": False, "tool_choice": "auto", "tools": [],
+                "output": [{
+                    "id": "msg_1", "type": "message", "role": "assistant", "status": "completed",
+                    "content": [{"type": "output_text", "text": text, "annotations": []}],
+                }],
+            }).encode()
+        self.send_response(self.status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+@pytest.fixture
+async def fake_openai(server, monkeypatch, event_loop_lease):
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), FakeOpenAI)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    FakeOpenAI.delay, FakeOpenAI.status, FakeOpenAI.requests = 0.0, 200, 0
+    monkeypatch.setenv("MOCK_AI", "0")
+    monkeypatch.setenv("OPENAI_API_KEY", "test-key")
+    monkeypatch.setenv("OPENAI_BASE_URL", f"http://127.0.0.1:{httpd.server_port}/v1")
+    monkeypatch.setenv("OPENAI_MAX_RETRIES", "0")
+    monkeypatch.setattr(server, "_openai_client", None)
+    try:
+        yield FakeOpenAI
+    finally:
+        if server._openai_client is not None:
+            await server._openai_client.close()
+        httpd.shutdown()
+        httpd.server_close()
+
+
+def make_router(server, timeout=2.0, hedge_after=0.0, failures=2, reset=30.0):
+    breaker = server.CircuitBreaker(failure_threshold=failures, reset_seconds=reset)
+    return server.ProviderRouter(timeout=timeout, hedge_after=hedge_after, breaker=breaker)
+
+
+async def test_cloud_success_is_served_by_cloud(server, fake_openai):
+    router = make_router(server)
+    analysis, model_id, tier = await router.route(png_bytes(), "xray")
+    assert tier == "cloud"
+    assert model_id == server.cloud_model_id()
+    assert analysis["doctor_view"]["summary"] == "cloud"
+    assert router.breaker.state == "closed"
+
+
+async def test_slow_cloud_call_times_out_to_local_fallback(server, fake_openai):
+    fake_openai.delay = 1.5
+    router = make_router(server, timeout=0.2)
+    started = time.monotonic()
+    analysis, model_id, tier = await router.route(png_bytes(), "xray")
+    assert tier == "local_fallback"
+    assert model_id == server.LOCAL_PIL_MODEL_ID
+    assert time.monotonic() - started < 1.0
+    assert router.timeouts == 1
+    assert router.breaker.failures == 1
+
+
+async def test_open_circuit_skips_the_cloud(server, fake_openai):
+    fake_openai.status = 500
+    router = make_router(server, failures=2, reset=30.0)
+    for _ in range(2):
+        _, _, tier = await router.route(png_bytes(), "xray")
+        assert tier == "local_fallback"
+    assert router.breaker.state == "open"
+    calls = fake_openai.requests
+
+    _, _, tier = await router.route(png_bytes(), "xray")
+    assert tier == "local_circuit_open"
+    assert fake_openai.requests == calls
+
+
+async def test_half_open_trial_closes_circuit_on_success(server, fake_openai):
+    fake_openai.status = 500
+    router = make_router(server, failures=1, reset=0.1)
+    await router.route(png_bytes(), "xray")
+    assert router.breaker.state == "open"
+    fake_openai.status = 200
+    time.sleep(0.15)
+    _, _, tier = await router.route(png_bytes(), "xray")
+    assert tier == "cloud"
+    assert router.breaker.state == "closed"
+
+
+async def test_slow_cloud_is_hedged_by_local_analysis(server, fake_openai):
+    fake_openai.delay = 0.6
+    router = make_router(server, timeout=5.0, hedge_after=0.05)
+    started = time.monotonic()
+    _, model_id, tier = await router.route(png_bytes(), "xray")
+    assert tier == "local_hedge"
+    assert model_id == server.LOCAL_PIL_MODEL_ID
+    assert time.monotonic() - started < 0.5
+    assert router.hedged == 1
+
+
+async def test_failed_hedge_does_not_fail_the_cloud_fallback(server, fake_openai, monkeypatch):
+    fake_openai.delay = 0.3
+    fake_openai.status = 500
+    real_analyze_locally = server.analyze_locally
+    calls = []
+
+    async def flaky_analyze_locally(image_bytes, scan_kind, pipeline=None):
+        calls.append(scan_kind)
+        if len(calls) == 1:
+            raise RuntimeError("hedge crashed")
+        return await real_analyze_locally(image_bytes, scan_kind, pipeline)
+
+    monkeypatch.setattr(server, "analyze_locally", flaky_analyze_locally)
+    router = make_router(server, timeout=5.0, hedge_after=0.05)
+    analysis, model_id, tier = await router.route(png_bytes(), "xray")
+    assert tier == "local_fallback"
+    assert model_id == server.LOCAL_PIL_MODEL_ID
+    assert analysis["doctor_view"]
+    assert len(calls) == 2
@@ -0,0 +1,131 @@
+import io
+import time
+
+import numpy as np
+import pytest
+from PIL import Image, ImageFilter, ImageStat
+
+SHAPES = [(1, 1), (2, 5), (3, 3), (37, 53), (256, 256), (512, 300)]
+BENCHMARK_SIZES = [256, 512, 1024, 2048, 4096]
+
+
+def legacy_metrics(image: Image.Image) -> dict:
+    """The ImageStat / FIND_EDGES pipeline compute_quality_metrics replaced."""
+    width, height = image.size
+    pixel_count = max(1, width * height)
+    stats = ImageStat.Stat(image)
+    edges = image.filter(ImageFilter.FIND_EDGES)
+    return {
+        "mean_brightness": float(stats.mean[0]),
+        "std_dev": float(stats.stddev[0]),
+        "edge_density": sum(1 for px in edges.getdata() if px > 30) / pixel_count,
+        "histogram": image.histogram(),
+    }
+
+
+def legacy_findings(image_bytes: bytes, scan_kind: str) -> tuple:
+    image = Image.open(io.BytesIO(image_bytes)).convert("L")
+    metrics = legacy_metrics(image)
+    findings = [
+        f"Analyzed locally using image-statistics pipeline ({scan_kind.replace('_', ' ').upper()}).",
+        f"Mean grayscale brightness: {metrics['mean_brightness']:.1f}/255.",
+        f"Contrast estimate (std dev): {metrics['std_dev']:.1f}.",
+        f"Edge-density estimate: {metrics['edge_density']:.3f}.",
+    ]
+    return metrics, findings
+
+
+def laplacian_variance(gray: np.ndarray) -> float:
+    height, width = gray.shape
+    values = [
+        int(gray[y - 1, x]) + int(gray[y + 1, x]) + int(gray[y, x - 1]) + int(gray[y, x + 1]) - 4 * int(gray[y, x])
+        for y in range(1, height - 1)
+        for x in range(1, width - 1)
+    ]
+    if not values:
+        return 0.0
+    mean = sum(values) / len(values)
+    return sum((v - mean) ** 2 for v in values) / len(values)
+
+
+def sample(shape: tuple, kind: str, seed: int = 0) -> np.ndarray:
+    if kind == "noise":
+        return np.random.default_rng(seed).integers(0, 256, shape, dtype=np.uint8)
+    if kind == "gradient":
+        return (np.add.outer(np.arange(shape[0]), np.arange(shape[1])) * 7 % 256).astype(np.uint8)
+    if kind == "flat":
+        return np.full(shape, 128, dtype=np.uint8)
+    return ((np.indices(shape).sum(axis=0) % 2) * 255).astype(np.uint8)  # checkerboard
+
+
+@pytest.mark.parametrize("kind", ["noise", "gradient", "flat", "checkerboard"])
+@pytest.mark.parametrize("shape", SHAPES)
+def test_metrics_match_the_pil_pipeline(server, shape, kind):
+    gray = sample(shape, kind)
+    metrics = server.compute_quality_metrics(gray)
+    legacy = legacy_metrics(Image.fromarray(gray))
+
+    assert (metrics["height"], metrics["width"]) == shape
+    assert metrics["mean_brightness"] == pytest.approx(legacy["mean_brightness"], abs=1e-9)
+    assert metrics["std_dev"] == pytest.approx(legacy["std_dev"], abs=1e-6)
+    assert metrics["edge_density"] == legacy["edge_density"]
+    assert metrics["histogram"] == legacy["histogram"]
+
+
+@pytest.mark.parametrize("shape", [(1, 1), (2, 5), (3, 3), (4, 7), (37, 53)])
+def test_sharpness_is_the_laplacian_variance(server, shape):
+    gray = sample(shape, "noise", seed=5)
+    assert server.compute_quality_metrics(gray)["sharpness"] == pytest.approx(laplacian_variance(gray), rel=1e-12, abs=1e-12)
+
+
+def test_blur_lowers_sharpness(server):
+    gray = sample((128, 128), "noise", seed=2)
+    blurred = np.asarray(Image.fromarray(gray).filter(ImageFilter.GaussianBlur(2)))
+    assert server.compute_quality_metrics(blurred)["sharpness"] < server.compute_quality_metrics(gray)["sharpness"] / 10
+
+
+@pytest.mark.parametrize("mode", ["L", "RGB", "RGBA"])
+@pytest.mark.parametrize("seed", [0, 1, 2])
+def test_report_findings_match_the_pil_report(server, mode, seed):
+    pixels = np.random.default_rng(seed).integers(0, 256, (97, 131, 3), dtype=np.uint8)
+    pixels[:, :40] //= 5  # a dark band, so the observations aren't all alike
+    buf = io.BytesIO()
+    Image.fromarray(pixels).convert(mode).save(buf, format="PNG")
+    image_bytes = buf.getvalue()
+
+    analysis = server.analyze_locally_with_pil(image_bytes, "chest_xray")
+    legacy, findings = legacy_findings(image_bytes, "chest_xray")
+    doctor_view = analysis["doctor_view"]
+    assert doctor_view["findings"][:4] == findings
+    assert doctor_view["findings"][4].startswith("Sharpness estimate (Laplacian variance): ")
+
+    expected = server.build_quality_report({**legacy, "sharpness": 0.0}, "chest_xray")["doctor_view"]
+    assert doctor_view["observations"] == expected["observations"]
+    assert doctor_view["confidence_level"] == expected["confidence_level"]
+
+
+def best_of(fn, repeat: int) -> float:
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - started)
+    return min(timings)
+
+
+def test_vectorized_metrics_beat_the_pil_pipeline(server, capsys):
+    rows = []
+    for size in BENCHMARK_SIZES:
+        gray = sample((size, size), "noise", seed=size)
+        image = Image.fromarray(gray)
+        repeat = 3 if size <= 1024 else 1
+        legacy = best_of(lambda: legacy_metrics(image), repeat)
+        vectorized = best_of(lambda: server.compute_quality_metrics(gray), repeat)
+        rows.append((size, legacy, vectorized))
+
+    with capsys.disabled():
+        print("\nquality metrics    size   legacy ms   numpy ms   speedup")
+        for size, legacy, vectorized in rows:
+            print(f"{'':18} {size:5d} {legacy * 1000:11.1f} {vectorized * 1000:10.1f} {legacy / vectorized:8.1f}x")
+    for size, legacy, vectorized in rows:
+        assert vectorized < legacy, f"{size}px: {vectorized * 1000:.1f}ms vs {legacy * 1000:.1f}ms"
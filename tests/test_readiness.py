@@ -0,0 +1,60 @@
+import orjson
+import pytest
+
+pytestmark = pytest.mark.anyio
+
+
+def fake_loader():
+    return (lambda batch: batch), {"import_torch_seconds": 0.0}
+
+
+def failing_loader():
+    raise ImportError("No module named 'torch'")
+
+
+@pytest.fixture(params=["thread", "process"])
+def local_models(request, server, monkeypatch):
+    executor = server.AnalysisExecutor(max_workers=1, max_concurrency=1, kind=request.param)
+    registry = server.ModelRegistry()
+    monkeypatch.setattr(server, "analysis_executor", executor)
+    monkeypatch.setattr(server, "model_registry", registry)
+    monkeypatch.setattr(server, "MODEL_LOAD_MODE", "eager")
+    monkeypatch.setenv("USE_LOCAL_ML", "true")
+    yield registry
+    executor.shutdown()
+
+
+async def readiness(server) -> tuple:
+    res = await server.readiness_check()
+    return res.status_code, orjson.loads(res.body)
+
+
+async def test_not_ready_until_warmup_finishes(server, db, local_models):
+    local_models.register("xray", fake_loader)
+    status, body = await readiness(server)
+    assert status == 503
+    assert body["checks"]["xray_model"] == "loading"
+
+
+async def test_ready_after_warmup(server, db, local_models):
+    warmups = []
+    local_models.register("xray", fake_loader, warmup=warmups.append)
+    await server.warm_local_models()
+
+    status, body = await readiness(server)
+    assert status == 200, body
+    assert body["checks"]["xray_model"] == "ok"
+    assert "warmup_seconds" in body["models"]["xray"]["timings"]
+    if server.analysis_executor.kind == "thread":
+        assert warmups
+
+
+async def test_failed_warmup_is_reported_not_loading(server, db, local_models):
+    local_models.register("xray", failing_loader)
+    await server.warm_local_models()
+
+    status, body = await readiness(server)
+    # The PIL analyzer still serves scans, so a missing model doesn't block traffic.
+    assert status == 200, body
+    assert body["checks"]["xray_model"].startswith("failed: ")
+    assert "torch" in body["models"]["xray"]["error"]
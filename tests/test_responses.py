@@ -0,0 +1,181 @@
+import gzip
+import json
+
+import bson
+import httpx
+import numpy as np
+import pytest
+from fastapi import FastAPI
+from fastapi.responses import JSONResponse, PlainTextResponse, Response, StreamingResponse
+
+from tests.conftest import register_user, upload_scan
+
+pytestmark = pytest.mark.anyio
+
+PAYLOAD = {"items": [{"id": i, "finding": "No acute cardiopulmonary abnormality"} for i in range(100)]}
+
+
+@pytest.fixture
+async def compressed(server):
+    inner = FastAPI()
+
+    @inner.get("/big")
+    async def big():
+        return JSONResponse(PAYLOAD, headers={"ETag": '"abc"', "Vary": "Origin"})
+
+    @inner.get("/weak")
+    async def weak():
+        return JSONResponse(PAYLOAD, headers={"ETag": 'W/"abc"'})
+
+    @inner.get("/small")
+    async def small():
+        return JSONResponse({"ok": True})
+
+    @inner.get("/stream")
+    async def stream():
+        async def lines():
+            for item in PAYLOAD["items"]:
+                yield json.dumps(item) + "\n"
+        return StreamingResponse(lines(), media_type="text/plain")
+
+    @inner.get("/image")
+    async def image():
+        return Response(b"\xff\xd8\xff" + b"\0" * 4096, media_type="image/jpeg")
+
+    @inner.get("/not-modified")
+    async def not_modified():
+        return PlainTextResponse("", status_code=304)
+
+    app = server.CompressionMiddleware(inner, minimum_size=1024, level=6)
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://test") as client:
+        yield client
+
+
+async def get(client, path: str, accept_encoding: str = "gzip") -> httpx.Response:
+    async with client.stream("GET", path, headers={"Accept-Encoding": accept_encoding}) as res:
+        res.raw_body = b"".join([chunk async for chunk in res.aiter_raw()])
+    return res
+
+
+async def test_large_json_is_gzipped_with_a_weak_etag(compressed):
+    res = await get(compressed, "/big")
+    assert res.headers["content-encoding"] == "gzip"
+    assert int(res.headers["content-length"]) == len(res.raw_body)
+    assert json.loads(gzip.decompress(res.raw_body)) == PAYLOAD
+    # The bytes differ from the identity response, so a strong ETag can't be kept.
+    assert res.headers["etag"] == 'W/"abc"'
+    assert res.headers["vary"] == "Origin, Accept-Encoding"
+
+    res = await get(compressed, "/weak")
+    assert res.headers["etag"] == 'W/"abc"'
+    assert res.headers["vary"] == "Accept-Encoding"
+
+
+@pytest.mark.parametrize("accept_encoding", ["", "identity", "gzip;q=0", "gzip; q=0.0, identity", "br;q=0", "gzip;q=abc"])
+async def test_gzip_needs_to_be_acceptable(compressed, accept_encoding):
+    res = await get(compressed, "/big", accept_encoding)
+    assert "content-encoding" not in res.headers
+    assert res.headers["etag"] == '"abc"'
+    assert json.loads(res.raw_body) == PAYLOAD
+
+
+@pytest.mark.parametrize("accept_encoding", ["gzip", "GZIP", "deflate, gzip;q=0.5", "identity;q=0, gzip;q=1.0"])
+async def test_gzip_with_a_positive_q_is_used(compressed, accept_encoding, server, monkeypatch):
+    monkeypatch.setattr(server, "brotli", None)
+    res = await get(compressed, "/big", accept_encoding)
+    assert res.headers["content-encoding"] == "gzip"
+
+
+@pytest.mark.parametrize("path", ["/small", "/stream", "/image", "/not-modified"])
+async def test_small_streamed_binary_and_empty_responses_pass_through(compressed, path):
+    res = await get(compressed, path)
+    assert "content-encoding" not in res.headers
+    assert "vary" not in res.headers
+
+
+async def test_scan_list_answers_if_none_match_with_304(api, db):
+    headers = await register_user(api)
+    await upload_scan(api, headers)
+    await upload_scan(api, headers)
+
+    first = await api.get("/api/scans", headers=headers)
+    etag = first.headers["etag"]
+    assert etag.startswith('W/"')
+    assert first.headers["cache-control"] == "private, no-cache"
+
+    for if_none_match in (etag, f'W/"other", {etag}', "*"):
+        res = await api.get("/api/scans", headers={**headers, "If-None-Match": if_none_match})
+        assert res.status_code == 304
+        assert res.content == b""
+        assert res.headers["etag"] == etag
+
+    res = await api.get("/api/scans", headers={**headers, "If-None-Match": 'W/"other"'})
+    assert res.status_code == 200
+    assert res.json() == first.json()
+
+    await upload_scan(api, headers)
+    res = await api.get("/api/scans", headers={**headers, "If-None-Match": etag})
+    assert res.status_code == 200
+    assert res.headers["etag"] != etag
+
+
+async def test_single_scan_answers_if_none_match_with_304(api, db):
+    headers = await register_user(api)
+    scan = await upload_scan(api, headers)
+    first = await api.get(f"/api/scans/{scan['id']}", headers=headers)
+    res = await api.get(f"/api/scans/{scan['id']}", headers={**headers, "If-None-Match": first.headers["etag"]})
+    assert res.status_code == 304
+
+
+def stored(report: dict) -> dict:
+    """What reading the report back from Mongo returns."""
+    return bson.decode(bson.encode({"report": report}))["report"]
+
+
+@pytest.mark.parametrize("seed", [0, 1, 2])
+def test_quality_report_round_trips_through_its_template(server, seed):
+    gray = np.random.default_rng(seed).integers(0, 256, (64, 80), dtype=np.uint8)
+    analysis = server.quality_analysis(server.compute_quality_metrics(gray), "chest_xray")
+
+    report = server.compact_report(analysis)
+    assert report["template"] == "quality:v1"
+    expanded = server.expand_report(stored(report))
+    assert expanded == {"doctor_view": analysis["doctor_view"], "patient_view": analysis["patient_view"]}
+
+
+def test_xray_report_round_trips_through_its_template(server):
+    pathologies = ["Atelectasis", "Cardiomegaly", "Effusion", "Pneumonia", "Nodule", "Mass"]
+    probs = np.array([0.05, 0.61, 0.33, 0.12, 0.27, 0.02], dtype=np.float32)
+    analysis = server.xray_analysis(probs, pathologies)
+
+    report = server.compact_report(analysis)
+    assert report["template"] == "xray:v1"
+    expanded = server.expand_report(stored(report))
+    assert expanded == {"doctor_view": analysis["doctor_view"], "patient_view": analysis["patient_view"]}
+
+
+def test_free_text_report_round_trips_through_zlib(server):
+    analysis = {
+        "doctor_view": {"findings": ["Right lower lobe opacity " * 20], "confidence_level": "moderate", "score": 0.73},
+        "patient_view": {"summary": "Something the doctor should look at. ünïcode ✓", "next_steps": []},
+    }
+    report = server.compact_report(analysis)
+    assert report["encoding"] == "zlib"
+    assert len(report["data"]) < len(json.dumps(analysis))
+    assert server.expand_report(stored(report)) == analysis
+
+    # An unknown template id (e.g. a cloud report) is stored as text too.
+    report = server.compact_report({**analysis, "report": {"template": "unknown:v9", "params": {}}})
+    assert report["encoding"] == "zlib"
+    assert server.expand_report(stored(report)) == analysis
+
+
+async def test_stored_scans_are_served_expanded(api, db):
+    headers = await register_user(api)
+    scan = await upload_scan(api, headers)
+    doc = await db.scans.find_one({"id": scan["id"]})
+    assert "report" in doc and "doctor_view" not in doc
+
+    res = await api.get(f"/api/scans/{scan['id']}", headers=headers)
+    assert res.json()["doctor_view"] == scan["doctor_view"]
+    assert res.json()["patient_view"] == scan["patient_view"]
@@ -0,0 +1,104 @@
+import asyncio
+import time
+
+import pytest
+
+from tests.conftest import register_user, upload_scan
+
+pytestmark = pytest.mark.anyio
+
+
+async def wait_for_status(db, scan_id: str, timeout: float = 5.0) -> str:
+    deadline = time.monotonic() + timeout
+    while True:
+        scan = await db.scans.find_one({"id": scan_id})
+        if scan["status"] != "processing" or time.monotonic() > deadline:
+            return scan["status"]
+        await asyncio.sleep(0.05)
+
+
+async def test_background_upload_completes(api, db):
+    headers = await register_user(api)
+    scan = await upload_scan(api, headers, background=True)
+    assert scan["status"] == "processing"
+    res = await api.get(f"/api/scans/{scan['id']}/status", params={"wait": 5}, headers=headers)
+    assert res.json()["status"] == "completed"
+
+
+async def test_recover_picks_up_scan_once_its_lease_expires(api, db, server):
+    headers = await register_user(api)
+    scan = await upload_scan(api, headers)
+    # As if the process died mid-analysis right after taking the inline lease.
+    await db.scans.update_one(
+        {"id": scan["id"]},
+        {"$set": {"status": "processing", "lease_until": time.time() + 0.3}, "$unset": {"report": ""}},
+    )
+
+    queue = server.ScanJobQueue(workers=1, max_attempts=3, backoff_seconds=0.01)
+    queue.start()
+    try:
+        assert await queue.recover() == 1
+        assert await wait_for_status(db, scan["id"]) == "completed"
+        assert queue.completed == 1
+    finally:
+        await queue.stop()
+
+
+async def test_claim_retries_after_another_workers_lease(api, db, server):
+    headers = await register_user(api)
+    scan = await upload_scan(api, headers)
+    await db.scans.update_one(
+        {"id": scan["id"]},
+        {"$set": {"status": "processing", "lease_until": time.time() + 0.3}, "$unset": {"report": ""}},
+    )
+
+    queue = server.ScanJobQueue(workers=1, max_attempts=3, backoff_seconds=0.01)
+    queue.start()
+    try:
+        queue.enqueue(scan["id"])
+        assert await wait_for_status(db, scan["id"]) == "completed"
+    finally:
+        await queue.stop()
+
+
+async def test_status_long_poll_releases_its_waiter(api, db, server):
+    headers = await register_user(api)
+    scan = await upload_scan(api, headers)
+    await db.scans.update_one(
+        {"id": scan["id"]}, {"$set": {"status": "processing", "lease_until": time.time() + 3600}}
+    )
+
+    res = await api.get(f"/api/scans/{scan['id']}/status", params={"wait": 0.2}, headers=headers)
+    assert res.json()["status"] == "processing"
+    assert scan["id"] not in server.scan_jobs._waiters
+
+    deleting = asyncio.create_task(
+        api.get(f"/api/scans/{scan['id']}/status", params={"wait": 5}, headers=headers)
+    )
+    await asyncio.sleep(0.1)
+    await db.scans.delete_one({"id": scan["id"]})
+    assert (await deleting).status_code == 404
+    assert scan["id"] not in server.scan_jobs._waiters
+    assert scan["id"] not in server.scan_jobs._waiter_counts
+
+
+async def test_early_poller_leaving_keeps_other_waiters_notified(api, db, server):
+    headers = await register_user(api)
+    scan = await upload_scan(api, headers)
+    await db.scans.update_one(
+        {"id": scan["id"]}, {"$set": {"status": "processing", "lease_until": time.time() + 3600}}
+    )
+
+    long_poll = asyncio.create_task(
+        api.get(f"/api/scans/{scan['id']}/status", params={"wait": 5}, headers=headers)
+    )
+    short = await api.get(f"/api/scans/{scan['id']}/status", params={"wait": 0.1}, headers=headers)
+    assert short.json()["status"] == "processing"
+    assert scan["id"] in server.scan_jobs._waiters
+
+    started = time.monotonic()
+    await db.scans.update_one({"id": scan["id"]}, {"$set": {"status": "completed"}})
+    server.scan_jobs._notify(scan["id"])
+    assert (await long_poll).json()["status"] == "completed"
+    assert time.monotonic() - started < 0.5
+    assert scan["id"] not in server.scan_jobs._waiters
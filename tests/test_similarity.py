@@ -0,0 +1,155 @@
+import random
+import uuid
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+from tests.conftest import png_bytes, register_user, upload_scan
+
+
+def flip_bits(value: int, count: int, rng: random.Random) -> int:
+    for bit in rng.sample(range(64), count):
+        value ^= 1 << bit
+    return value
+
+
+def clustered_hashes(rng: random.Random, centers: int = 20, per_center: int = 40) -> list:
+    """Hashes scattered 0..20 bits around a few centers, so every radius has matches."""
+    hashes = []
+    for _ in range(centers):
+        center = rng.getrandbits(64)
+        hashes.append(center)
+        hashes.extend(flip_bits(center, rng.randint(0, 20), rng) for _ in range(per_center))
+    return hashes
+
+
+def brute_force(entries: list, value: int, max_distance: int) -> list:
+    distances = [((stored ^ value).bit_count(), scan_id) for scan_id, stored in entries]
+    return sorted(match for match in distances if match[0] <= max_distance)
+
+
+def test_hamming_search_matches_brute_force(server):
+    rng = random.Random(0)
+    hashes = clustered_hashes(rng)
+    # Some scans share a hash exactly (re-uploads of the same image).
+    entries = [(f"scan-{i}", value) for i, value in enumerate(hashes + hashes[:50])]
+    index = server.HammingIndex()
+    for scan_id, value in entries:
+        index.add(scan_id, value)
+    assert len(index) == len(entries)
+
+    queries = [flip_bits(rng.choice(hashes), rng.randint(0, 8), rng) for _ in range(100)] + [rng.getrandbits(64)]
+    for value in queries:
+        for max_distance in range(server.HammingIndex.MAX_DISTANCE + 1):
+            assert index.search(value, max_distance) == brute_force(entries, value, max_distance)
+
+
+def test_hamming_search_after_removals(server):
+    rng = random.Random(1)
+    entries = [(f"scan-{i}", value) for i, value in enumerate(clustered_hashes(rng, centers=5))]
+    entries += [("twin-a", entries[0][1]), ("twin-b", entries[0][1])]
+    index = server.HammingIndex()
+    for scan_id, value in entries:
+        index.add(scan_id, value)
+
+    removed = set(rng.sample(range(len(entries)), len(entries) // 2)) | {len(entries) - 1}
+    for position in removed:
+        index.remove(*entries[position])
+    index.remove("never-added", 12345)
+    kept = [entry for position, entry in enumerate(entries) if position not in removed]
+    assert len(index) == len(kept)
+
+    for scan_id, value in kept[:40]:
+        for max_distance in (0, 3, 8, 15):
+            assert index.search(value, max_distance) == brute_force(kept, value, max_distance)
+
+
+def test_search_caps_the_radius(server):
+    index = server.HammingIndex()
+    index.add("far", (1 << 20) - 1)  # 20 bits from zero
+    index.add("near", (1 << 15) - 1)
+    assert index.search(0, 64) == [(15, "near")]
+
+
+async def insert_scans(db, user_id: str, hashes: list) -> list:
+    created_at = datetime.now(timezone.utc)
+    docs = [
+        {
+            "id": str(uuid.uuid4()),
+            "user_id": user_id,
+            "scan_type": "xray",
+            "file_name": f"scan-{i}.png",
+            "status": "completed",
+            "dhash": f"{value:016x}" if value is not None else None,
+            "created_at": (created_at - timedelta(seconds=i)).isoformat(),
+        }
+        for i, value in enumerate(hashes)
+    ]
+    await db.scans.insert_many([dict(doc) for doc in docs])
+    return docs
+
+
+@pytest.mark.anyio
+async def test_similarity_index_loads_and_tracks_a_users_scans(db, server):
+    rng = random.Random(2)
+    hashes = clustered_hashes(rng, centers=5, per_center=30)
+    docs = await insert_scans(db, "alice", hashes + [None])
+    await insert_scans(db, "bob", hashes[:20])
+    entries = [(doc["id"], int(doc["dhash"], 16)) for doc in docs if doc["dhash"]]
+
+    index = server.SimilarityIndex(max_users=10, ttl_seconds=60)
+    query = docs[0]
+    matches = await index.similar("alice", query["dhash"], 10, exclude=query["id"])
+    expected = [match for match in brute_force(entries, hashes[0], 10) if match[1] != query["id"]]
+    assert matches == expected
+    assert index.loads == 1
+
+    added = flip_bits(hashes[0], 1, rng)
+    index.add("alice", "new-scan", f"{added:016x}")
+    index.remove("alice", docs[1]["id"], docs[1]["dhash"])
+    entries = [entry for entry in entries if entry[0] != docs[1]["id"]] + [("new-scan", added)]
+    assert await index.similar("alice", query["dhash"], 10) == brute_force(entries, hashes[0], 10)
+    assert index.loads == 1
+
+
+@pytest.mark.anyio
+async def test_similar_route_returns_the_users_nearest_scans(api, db, server):
+    headers = await register_user(api)
+    user_id = (await api.get("/api/auth/me", headers=headers)).json()["id"]
+    rng = random.Random(3)
+    center = rng.getrandbits(64)
+    hashes = [center] + [flip_bits(center, distance, rng) for distance in (0, 1, 3, 6, 9, 12, 30)]
+    docs = await insert_scans(db, user_id, hashes + [None])
+    await insert_scans(db, "someone-else", [center])
+
+    res = await api.get(f"/api/scans/{docs[0]['id']}/similar", params={"max_distance": 9}, headers=headers)
+    assert res.status_code == 200, res.text
+    body = res.json()
+    assert body["indexed"] is True
+    assert [(item["distance"], item["scan"]["id"]) for item in body["items"]] == [
+        (distance, doc["id"]) for doc, distance in zip(docs[1:6], (0, 1, 3, 6, 9))
+    ]
+    assert body["items"][2]["similarity"] == round(1 - 3 / 64, 4)
+    assert set(body["items"][0]["scan"]) == set(server.SCAN_SUMMARY_FIELDS)
+
+    res = await api.get(f"/api/scans/{docs[0]['id']}/similar", params={"max_distance": 15, "limit": 2}, headers=headers)
+    assert [item["scan"]["id"] for item in res.json()["items"]] == [docs[1]["id"], docs[2]["id"]]
+
+    res = await api.get(f"/api/scans/{docs[-1]['id']}/similar", headers=headers)
+    assert res.json() == {"items": [], "indexed": False}
+    other = await db.scans.find_one({"user_id": "someone-else"})
+    assert (await api.get(f"/api/scans/{other['id']}/similar", headers=headers)).status_code == 404
+    res = await api.get(f"/api/scans/{docs[0]['id']}/similar", params={"max_distance": 16}, headers=headers)
+    assert res.status_code == 422
+
+
+@pytest.mark.anyio
+async def test_reuploaded_image_is_its_own_nearest_neighbour(api, db):
+    headers = await register_user(api)
+    image = png_bytes(seed=50)
+    first = await upload_scan(api, headers, image)
+    await upload_scan(api, headers, png_bytes(seed=51))
+    second = await upload_scan(api, headers, image)
+
+    res = await api.get(f"/api/scans/{second['id']}/similar", params={"max_distance": 0}, headers=headers)
+    assert [(item["distance"], item["scan"]["id"]) for item in res.json()["items"]] == [(0, first["id"])]
@@ -0,0 +1,67 @@
+import uuid
+
+import pytest
+
+pytestmark = pytest.mark.anyio
+
+
+@pytest.fixture
+async def stats_db(server, db):
+    await server.ensure_indexes()
+    return db
+
+
+async def add_scan(server, db, user_id: str, scan_type: str = "xray", status: str = "processing"):
+    """Insert a scan and count it, the way the upload path does."""
+    await db.scans.insert_one({"id": str(uuid.uuid4()), "user_id": user_id, "scan_type": scan_type,
+                               "status": status, "created_at": "2026-01-01T00:00:00+00:00"})
+    await server.record_scan_stats(user_id, scan_type, status=status)
+
+
+async def test_rebuild_recomputes_from_scans(server, stats_db):
+    for status in ("completed", "completed", "failed"):
+        await add_scan(server, stats_db, "u1", status=status)
+    await add_scan(server, stats_db, "u1", scan_type="mri")
+    await stats_db.user_stats.update_one({"user_id": "u1"}, {"$set": {"total_scans": 99}})
+
+    assert await server.check_user_stats() == ["u1"]
+    assert await server.rebuild_user_stats() == 1
+    assert await server.check_user_stats() == []
+    stats = await stats_db.user_stats.find_one({"user_id": "u1"})
+    assert stats["total_scans"] == 4
+    assert stats["by_status"] == {"processing": 1, "completed": 2, "failed": 1}
+
+
+async def test_rebuild_keeps_increment_that_races_the_aggregation(server, stats_db, monkeypatch):
+    for _ in range(3):
+        await add_scan(server, stats_db, "u1", status="completed")
+    compute = server.compute_user_stats
+    raced = []
+
+    async def compute_then_upload(user_id=None):
+        computed = await compute(user_id)
+        if not raced:
+            # An upload lands after the aggregation read db.scans but before the rebuild writes.
+            raced.append(True)
+            await add_scan(server, stats_db, "u1")
+        return computed
+
+    monkeypatch.setattr(server, "compute_user_stats", compute_then_upload)
+    await server.rebuild_user_stats("u1")
+
+    stats = await stats_db.user_stats.find_one({"user_id": "u1"})
+    assert stats["total_scans"] == 4
+    assert stats["by_status"]["processing"] == 1
+    assert await server.check_user_stats() == []
+
+
+async def test_rebuild_seeds_users_without_a_stats_document(server, stats_db):
+    await stats_db.scans.insert_one({"id": "s1", "user_id": "legacy", "scan_type": "xray", "status": "completed"})
+    assert await stats_db.user_stats.find_one({"user_id": "legacy"}) is None
+
+    await server.rebuild_user_stats("legacy")
+    await server.record_scan_stats("legacy", "xray")
+
+    stats = await stats_db.user_stats.find_one({"user_id": "legacy"})
+    assert stats["total_scans"] == 2
+    assert stats["version"] == 2